@@ -1,3 +1,6 @@
+import collections
+
+import numpy
 import pandas
 
 
@@ -18,96 +21,149 @@ def movingAvgCross(df):
         return False
 
 
+class MovingAverageCross:
+    '''
+    Incremental short/long moving averages of one symbol's daily closes
+
+    Keeps the last `long` closes with running sums, so each new bar is O(1)
+    instead of recomputing rolling means over a year of history. The state
+    is JSON serializable (to_dict/from_dict) so daily runs only need the
+    bars since the last run.
+
+    update() returns 'golden' when the short MA crosses above the long MA,
+    'death' when it crosses below and None otherwise.
+    '''
+
+    def __init__(self, short=50, long=200):
+        self.short = short
+        self.long = long
+        self.prices = collections.deque(maxlen=long)
+        self.short_sum = 0.0
+        self.long_sum = 0.0
+        self.last_date = None
+        self.above = None  # short MA > long MA, None until we have `long` bars
+        self.updates = 0
+
+    def update(self, date, price):
+        '''
+        Adds a daily close. Bars older than the last one are ignored and a bar
+        with the same date replaces the last one (e.g. today's bar seen intraday)
+
+        Input:
+            date: bar date as str 'yyyymmdd' (anything that sorts by date works)
+            price: close price
+        Output: 'golden', 'death' or None
+        '''
+        price = float(price)
+        if self.last_date is not None and date < self.last_date:
+            return None
+        if date == self.last_date:
+            old = self.prices[-1]
+            self.prices[-1] = price
+            self.long_sum += price - old
+            self.short_sum += price - old
+        else:
+            if len(self.prices) == self.long:
+                self.long_sum -= self.prices[0]
+            if len(self.prices) >= self.short:
+                self.short_sum -= self.prices[-self.short]
+            self.prices.append(price)
+            self.long_sum += price
+            self.short_sum += price
+            self.last_date = date
+
+        self.updates += 1
+        if self.updates % self.long == 0:
+            # Keep the running sums from drifting with float rounding
+            self.resum()
+
+        if len(self.prices) < self.long:
+            return None
+        was_above = self.above
+        self.above = self.shortMA() > self.longMA()
+        if was_above is None or was_above == self.above:
+            return None
+        return 'golden' if self.above else 'death'
+
+    def resum(self):
+        prices = list(self.prices)
+        self.long_sum = sum(prices)
+        self.short_sum = sum(prices[-self.short:])
+
+    def shortMA(self):
+        if len(self.prices) < self.short:
+            return None
+        return self.short_sum / self.short
+
+    def longMA(self):
+        if len(self.prices) < self.long:
+            return None
+        return self.long_sum / self.long
+
+    def isGolden(self):
+        '''
+        Same as movingAvgCross: True if the short MA is above the long MA
+        '''
+        return bool(self.above)
+
+    def to_dict(self):
+        return {'short': self.short, 'long': self.long, 'prices': list(self.prices),
+                'last_date': self.last_date, 'above': self.above, 'updates': self.updates}
+
+    @classmethod
+    def from_dict(cls, state):
+        ma = cls(state['short'], state['long'])
+        ma.prices.extend(state['prices'])
+        ma.last_date = state['last_date']
+        ma.above = state['above']
+        ma.updates = state.get('updates', 0)
+        ma.resum()
+        return ma
+
+
 def calcTotalReturn(start, end, dividends):
     return (end - start + dividends)/start
 
 
-def compositeValueRank(df):
+# Value factors ranked by compositeValueRank, lower is better for all of them
+VALUE_FACTORS = ['P/E', 'EV/EBITDA', 'EV/S', 'EV/FCF']
+
+
+def compositeValueRank(df, factors=None, weights=None):
     '''
     Ranks a pandas.dataframe by Composite Value
 
-    Input: Dataframe with following columns:
+    Input: Dataframe with following columns (or the ones given in factors):
         - P/E
         - EV/EBITDA
         - EV/S
         - EV/FCF
+        factors: (optional) list of columns to score, lower values are better
+        weights: (optional) list of weights, one per factor (default all equal)
     Output: Dataframe same as input but with new columns scoring each value factor 0 to 100
         A row with a P/E in the lowest percentile will get a P/E Score of 100, and with a
         EV/S in the highest percentile will get a EV/S Score of 0, and so on. Any column that
         does not have a value (i.e. a company with no EPS will not have a P/E) will get an average
-        score of 50. The final column is the Value Score which is a simple average of the 4 other scores
+        score of 50. The final column is the Value Score which is the (weighted) average of the
+        other scores
     '''
-    df['P/E Score'] = None
-    df['EV/EBITDA Score'] = None
-    df['EV/S Score'] = None
-    df['EV/FCF Score'] = None
-    df['Value Score'] = None
-
-    # P/E Score
-    # Note: Need to check column type as pandas.dataframe throws exception
-    # when comparing different type such as str and float. If a column
-    # has a mix of floats and str, then the column type is object i.e.
-    # we know that we are missing some values and we can check if values
-    # are 'N/A'. If not object type, then we know there's no missing values
-    if df['P/E'].dtype == 'object':
-        df_missing = df[df['P/E'].isnull()]
-        df_good = df[df['P/E'].notnull()]
-        for i, row in df_missing.iterrows():
-            df.at[i, 'P/E Score'] = 50
-        for i, row in df_good.iterrows():
-            df.at[i, 'P/E Score'] = 100 - \
-                pandas.qcut(df_good['P/E'], 100, labels=False)[i]
-    else:
-        for i, row in df.iterrows():
-            df.at[i, 'P/E Score'] = 100 - \
-                pandas.qcut(df['P/E'], 100, labels=False)[i]
-
-    # EV/EBITDA Score
-    if df['EV/EBITDA'].dtype == 'object':
-        df_missing = df[df['EV/EBITDA'].isnull()]
-        df_good = df[df['EV/EBITDA'].notnull()]
-        for i, row in df_missing.iterrows():
-            df.at[i, 'EV/EBITDA Score'] = 50
-        for i, row in df_good.iterrows():
-            df.at[i, 'EV/EBITDA Score'] = 100 - \
-                pandas.qcut(df_good['EV/EBITDA'], 100, labels=False)[i]
-    else:
-        for i, row in df.iterrows():
-            df.at[i, 'EV/EBITDA Score'] = 100 - \
-                pandas.qcut(df['EV/EBITDA'], 100, labels=False)[i]
-
-    # EV/S Score
-    if df['EV/S'].dtype == 'object':
-        df_missing = df[df['EV/S'].isnull()]
-        df_good = df[df['EV/S'].notnull()]
-        for i, row in df_missing.iterrows():
-            df.at[i, 'EV/S Score'] = 50
-        for i, row in df_good.iterrows():
-            df.at[i, 'EV/S Score'] = 100 - \
-                pandas.qcut(df_good['EV/S'], 100, labels=False)[i]
-    else:
-        for i, row in df.iterrows():
-            df.at[i, 'EV/S Score'] = 100 - \
-                pandas.qcut(df['EV/S'], 100, labels=False)[i]
-
-    # EV/FCF Score
-    if df['EV/FCF'].dtype == 'object':
-        df_missing = df[df['EV/FCF'].isnull()]
-        df_good = df[df['EV/FCF'].notnull()]
-        for i, row in df_missing.iterrows():
-            df.at[i, 'EV/FCF Score'] = 50
-        for i, row in df_good.iterrows():
-            df.at[i, 'EV/FCF Score'] = 100 - \
-                pandas.qcut(df_good['EV/FCF'], 100, labels=False)[i]
-    else:
-        for i, row in df.iterrows():
-            df.at[i, 'EV/FCF Score'] = 100 - \
-                pandas.qcut(df['EV/FCF'], 100, labels=False)[i]
+    factors = VALUE_FACTORS if factors is None else factors
+    weights = [1] * len(factors) if weights is None else weights
+    if len(weights) != len(factors):
+        raise ValueError('Need one weight per factor')
 
-    # Value Score
-    for i, row in df.iterrows():
-        df.at[i, 'Value Score'] = (
-            row['P/E Score'] + row['EV/EBITDA Score'] + row['EV/S Score'] + row['EV/FCF Score'])/4
+    value_score = 0
+    for factor, weight in zip(factors, weights):
+        # Percentile buckets are computed once over the tickers that have
+        # a value, everyone else gets the average score of 50
+        values = pandas.to_numeric(df[factor], errors='coerce')
+        good = values.notnull()
+        scores = numpy.full(len(df), 50, dtype=numpy.int64)
+        if good.any():
+            scores[good.values] = 100 - pandas.qcut(values[good], 100, labels=False).values
+        df[factor + ' Score'] = scores
+        value_score = value_score + weight * scores
 
+    df['Value Score'] = value_score / float(sum(weights))
     df = df.sort_values('Value Score', ascending=False)
     return df
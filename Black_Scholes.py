@@ -1,7 +1,270 @@
 import argparse
 import datetime
-import math
-import scipy.stats
+import sys
+
+import numpy
+import pandas
+from scipy.special import ndtr
+
+
+SQRT_2PI = numpy.sqrt(2*numpy.pi)
+# Batch mode columns, named like the CLI arguments. Missing columns fall back
+# to the CLI value, e.g. a single --risk for every contract
+BATCH_COLUMNS = ['strike', 'stock', 'risk', 'vol', 'date', 'div',
+                 'shares_out', 'warrants_out', 'warrants_per_share']
+BATCH_REQUIRED = ['strike', 'stock', 'risk', 'vol', 'date', 'div']
+GREEKS = ['delta', 'gamma', 'vega', 'theta', 'rho']
+
+
+def years_until(exp_date, today=None):
+    """
+    Years from today until an expiration date given as str 'mm-dd-yyyy'
+    """
+    exp_date_obj = datetime.datetime.strptime(exp_date, "%m-%d-%Y").date()
+    today = datetime.datetime.now().date() if today is None else today
+    return (exp_date_obj - today).days/365.2425
+
+
+def price_euro_calls(stock_price, strike_price, vol, years, risk_free_rate, div):
+    """
+    Black Scholes value of European calls, broadcasting over numpy arrays
+
+    Every argument can be a float or an array, e.g. a column of vols against
+    a row of strikes gives the whole vol x strike price surface in one call.
+    Expired calls (years <= 0) are worth their intrinsic value.
+
+    Returns:
+        numpy array (or float for all scalar arguments) of call prices
+    """
+    return call_greeks(stock_price, strike_price, vol, years, risk_free_rate, div)['price']
+
+
+def call_greeks(stock_price, strike_price, vol, years, risk_free_rate, div):
+    """
+    Same as price_euro_calls but also returns the greeks, sharing the d1/d2 work
+
+    Returns:
+        dict of numpy arrays (or floats): price, delta, gamma, vega (per 1.00
+        of vol), theta (per year, as time passes) and rho (per 1.00 of rate)
+    """
+    stock_price, strike_price, vol, years, risk_free_rate, div = numpy.broadcast_arrays(
+        *[numpy.asarray(a, dtype=float) for a in
+          (stock_price, strike_price, vol, years, risk_free_rate, div)])
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sqrt_years = numpy.sqrt(years)
+        vol_sqrt_years = vol * sqrt_years
+        d1 = (numpy.log(stock_price/strike_price) +
+              (risk_free_rate - div + vol**2/2) * years) / vol_sqrt_years
+        d2 = d1 - vol_sqrt_years
+        div_discount = numpy.exp(-div*years)
+        rate_discount = numpy.exp(-risk_free_rate*years)
+        n_d1 = ndtr(d1)
+        n_d2 = ndtr(d2)
+        pdf_d1 = numpy.exp(-d1**2/2)/SQRT_2PI
+        discounted_strike = strike_price * rate_discount
+        call_price = stock_price * div_discount * n_d1 - discounted_strike * n_d2
+        delta = div_discount * n_d1
+        gamma = div_discount * pdf_d1 / (stock_price * vol_sqrt_years)
+        vega = stock_price * div_discount * pdf_d1 * sqrt_years
+        theta = (-stock_price * div_discount * pdf_d1 * vol / (2 * sqrt_years)
+                 - risk_free_rate * discounted_strike * n_d2 + div * stock_price * delta)
+        rho = discounted_strike * years * n_d2
+    greeks = {'price': call_price, 'delta': delta, 'gamma': gamma, 'vega': vega,
+              'theta': theta, 'rho': rho}
+    expired = years <= 0
+    if expired.any():
+        greeks['price'] = numpy.where(expired, numpy.maximum(stock_price - strike_price, 0.0),
+                                      call_price)
+        greeks['delta'] = numpy.where(expired, (stock_price > strike_price).astype(float), delta)
+        for name in ('gamma', 'vega', 'theta', 'rho'):
+            greeks[name] = numpy.where(expired, 0.0, greeks[name])
+    if call_price.ndim == 0:
+        return {name: value[()] for name, value in greeks.items()}
+    return greeks
+
+
+def warrant_greeks(stock_price, strike_price, vol, years, risk_free_rate, div,
+                   shares_out=None, warrants_out=None,
+                   warrants_per_share=1, tol=1e-10, max_iter=50):
+    """
+    price_warrants together with its greeks
+
+    Without dilution these are call_greeks divided by warrants_per_share.
+    With dilution the warrant price W solves W = C(S_adj) with
+    S_adj = S*(1 - a) + a*W and a = k/(shares_out + k), so differentiating
+    through the fixed point, with delta/gamma the call's at S_adj:
+        delta_w = delta*(1 - a)/(1 - a*delta)
+        gamma_w = gamma*(1 - a)*((1 - a) + a*delta_w)/(1 - a*delta)**2
+        vega_w, theta_w, rho_w = vega, theta, rho divided by (1 - a*delta)
+
+    Returns:
+        dict of numpy arrays: price, delta, gamma, vega, theta, rho and
+        converged (all True without dilution)
+    """
+    if shares_out is None or warrants_out is None:
+        greeks = call_greeks(stock_price, strike_price, vol, years, risk_free_rate, div)
+        greeks = {name: value/warrants_per_share for name, value in greeks.items()}
+        greeks['converged'] = numpy.ones(numpy.shape(greeks['price']), dtype=bool)
+        return greeks
+
+    warrant_price, converged = solve_dilution(stock_price, strike_price, vol, years,
+                                              risk_free_rate, div, shares_out, warrants_out,
+                                              warrants_per_share, tol, max_iter)
+    warrant_count_adj = numpy.asarray(warrants_out, dtype=float)/warrants_per_share
+    weight = warrant_count_adj/(shares_out + warrant_count_adj)
+    adj_stock_price = numpy.asarray(stock_price, dtype=float)*(1 - weight) + weight*warrant_price
+    greeks = call_greeks(adj_stock_price, strike_price, vol, years, risk_free_rate, div)
+    feedback = 1 - weight*greeks['delta']
+    delta = greeks['delta']*(1 - weight)/feedback
+    return {'price': warrant_price,
+            'delta': delta,
+            'gamma': greeks['gamma']*(1 - weight)*((1 - weight) + weight*delta)/feedback**2,
+            'vega': greeks['vega']/feedback,
+            'theta': greeks['theta']/feedback,
+            'rho': greeks['rho']/feedback,
+            'converged': converged}
+
+
+def solve_dilution(stock_price, strike_price, vol, years, risk_free_rate, div,
+                   shares_out, warrants_out, warrants_per_share=1, tol=1e-10, max_iter=50):
+    """
+    Dilution adjusted warrant prices, solved for every element at once
+
+    Exercising the warrants dilutes the stock, so the warrant price W has to
+    satisfy W = C(S_adj(W)) where C is the Black Scholes call price and
+        S_adj(W) = (S*shares_out + k*W) / (shares_out + k),  k = warrants_out/warrants_per_share
+    This is solved with Newton's method on f(W) = W - C(S_adj(W)), starting
+    from the undiluted call price. f'(W) = 1 - delta*k/(shares_out + k) > 0,
+    so each step is well defined and it typically converges in a few steps.
+
+    Arguments:
+        tol: stop once every price moves less than this in a step
+        max_iter: max Newton steps
+
+    Returns:
+        (prices, converged) numpy arrays, converged is a bool per element
+    """
+    warrant_count_adj = numpy.asarray(warrants_out, dtype=float)/warrants_per_share
+    weight = warrant_count_adj/(shares_out + warrant_count_adj)
+    stock_price = numpy.asarray(stock_price, dtype=float)
+    call_price = numpy.array(price_euro_calls(stock_price, strike_price, vol, years,
+                                              risk_free_rate, div), dtype=float)
+    shape = numpy.broadcast(call_price, weight).shape
+    call_price = numpy.array(numpy.broadcast_to(call_price, shape))
+    converged = numpy.zeros(shape, dtype=bool)
+    for _ in range(max_iter):
+        adj_stock_price = stock_price*(1 - weight) + weight*call_price
+        greeks = call_greeks(adj_stock_price, strike_price, vol, years, risk_free_rate, div)
+        step = (call_price - greeks['price'])/(1 - greeks['delta']*weight)
+        step = numpy.where(converged, 0.0, step)
+        call_price = call_price - step
+        converged |= numpy.abs(step) < tol
+        if converged.all():
+            break
+    if call_price.ndim == 0:
+        return call_price[()], converged[()]
+    return call_price, converged
+
+
+def price_warrants(stock_price, strike_price, vol, years, risk_free_rate, div,
+                   shares_out=None, warrants_out=None, warrants_per_share=1,
+                   tol=1e-10, max_iter=50):
+    """
+    Vectorized BlackScholes.price_euro_call, broadcasting over numpy arrays
+
+    Without shares_out and warrants_out this is the call price divided by
+    warrants_per_share. With them, the price is adjusted for the dilution
+    from the warrants being exercised with solve_dilution. Elements that
+    didn't converge within max_iter are reported and returned as is.
+    """
+    if shares_out is None or warrants_out is None:
+        return price_euro_calls(stock_price, strike_price, vol, years, risk_free_rate,
+                                div)/warrants_per_share
+    call_price, converged = solve_dilution(stock_price, strike_price, vol, years,
+                                           risk_free_rate, div, shares_out, warrants_out,
+                                           warrants_per_share, tol, max_iter)
+    if not numpy.all(converged):
+        print('Dilution adjustment did not converge for %s of %s prices' %
+              (numpy.size(converged) - numpy.count_nonzero(converged), numpy.size(converged)))
+    return call_price
+
+
+def implied_vols(price, stock_price, strike_price, years, risk_free_rate, div,
+                 shares_out=None, warrants_out=None, warrants_per_share=1,
+                 tol=1e-8, max_iter=100, low=1e-4, high=5.0):
+    """
+    Implied volatility of observed warrant/option prices, solved for every
+    element at once
+
+    Inverts price_warrants (so the dilution adjusted price when shares_out
+    and warrants_out are given) with Newton steps on vol, falling back to
+    bisection whenever a step would leave the [low, high] bracket known to
+    contain the answer. With dilution the vega used is
+    vega/(1 - delta*k/(shares_out + k)), the derivative of the diluted price.
+
+    Arguments:
+        price: observed prices, same units as price_warrants returns
+        tol: stop once the model price is within tol of the observed price
+        low, high: vol bracket searched
+
+    Returns:
+        (vols, converged) numpy arrays. Prices outside what the model gives
+        for vols in [low, high] (e.g. below intrinsic value) are NaN
+    """
+    diluted = shares_out is not None and warrants_out is not None
+    if diluted:
+        warrant_count_adj = numpy.asarray(warrants_out, dtype=float)/warrants_per_share
+        weight = warrant_count_adj/(shares_out + warrant_count_adj)
+
+    def model(vol):
+        '''
+        Model price and its derivative in vol
+        '''
+        if not diluted:
+            greeks = call_greeks(stock_price, strike_price, vol, years, risk_free_rate, div)
+            return greeks['price']/warrants_per_share, greeks['vega']/warrants_per_share
+        warrant_price, _ = solve_dilution(stock_price, strike_price, vol, years, risk_free_rate,
+                                          div, shares_out, warrants_out, warrants_per_share)
+        adj_stock_price = (numpy.asarray(stock_price, dtype=float)*(1 - weight) +
+                           weight*warrant_price)
+        greeks = call_greeks(adj_stock_price, strike_price, vol, years, risk_free_rate, div)
+        return warrant_price, greeks['vega']/(1 - greeks['delta']*weight)
+
+    shape = numpy.broadcast(price, stock_price, strike_price, years, risk_free_rate, div,
+                            warrants_per_share).shape
+    price = numpy.broadcast_to(numpy.asarray(price, dtype=float), shape)
+    low = numpy.full(shape, float(low))
+    high = numpy.full(shape, float(high))
+    # Only prices between the model's prices at the bracket ends have an answer
+    low_price = numpy.broadcast_to(model(low)[0], shape)
+    high_price = numpy.broadcast_to(model(high)[0], shape)
+    solvable = (price >= low_price) & (price <= high_price)
+    converged = solvable & ((numpy.abs(low_price - price) < tol) | (numpy.abs(high_price - price) < tol))
+    vol = numpy.where(numpy.abs(low_price - price) < tol, low, (low + high)/2)
+    vol = numpy.where(numpy.abs(high_price - price) < tol, high, vol)
+
+    for _ in range(max_iter):
+        active = solvable & ~converged
+        if not active.any():
+            break
+        model_price, vega = [numpy.broadcast_to(v, shape) for v in model(vol)]
+        diff = model_price - price
+        converged |= active & (numpy.abs(diff) < tol)
+        # Price goes up with vol, so the answer is below vol if we are too high
+        high = numpy.where(active & (diff > 0), vol, high)
+        low = numpy.where(active & (diff < 0), vol, low)
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            newton = vol - diff/vega
+        bisect = (low + high)/2
+        step = numpy.where((newton > low) & (newton < high), newton, bisect)
+        vol = numpy.where(active & ~converged, step, vol)
+        # A bracket that can't shrink anymore is as close as we can get
+        converged |= active & (high - low < 1e-14)
+
+    vol = numpy.where(solvable, vol, numpy.nan)
+    if vol.ndim == 0:
+        return vol[()], converged[()]
+    return vol, converged
 
 
 class BlackScholes:
@@ -54,9 +317,7 @@ class BlackScholes:
         self.stock_price = stock_price
         self.risk_free_rate = risk_free_rate
         self.vol = vol
-        exp_date_obj = datetime.datetime.strptime(exp_date, "%m-%d-%Y").date()
-        delta = exp_date_obj - datetime.datetime.now().date()
-        self.years = delta.days/365.2425
+        self.years = years_until(exp_date)
         self.div = div
         self.shares_out = shares_out
         self.warrants_out = warrants_out
@@ -68,7 +329,7 @@ class BlackScholes:
         Notice it is not self.stock_price but rather an argument since
         we need to use this function when having an adjusted stock price
         """
-        return (math.log(stock_price/self.strike_price) + \
+        return (numpy.log(stock_price/self.strike_price) + \
                (div_adj_intrest_rate + (var/2)) * self.years) \
                / ((var**.5) * (self.years**.5))
 
@@ -92,58 +353,197 @@ class BlackScholes:
         '''
         Returns the value of a European styled Call/Warrant
         '''
-        div_adj_intrest_rate = self.risk_free_rate - self.div
-        variance = self.vol**2
-        d1 = self.calc_d1(self.stock_price, div_adj_intrest_rate, variance)
-        d2 = self.calc_d2(d1)
-        n_d1 = scipy.stats.norm.cdf(d1)
-        n_d2 = scipy.stats.norm.cdf(d2)
-        call_price = ((self.stock_price * math.exp(-self.div*self.years)) * n_d1) - \
-                     (self.strike_price * math.exp(-self.risk_free_rate*self.years) * n_d2)
-
+        vol = self.vol if vol is None else vol
+        call_price = price_warrants(self.stock_price, self.strike_price, vol, self.years,
+                                    self.risk_free_rate, self.div, self.shares_out,
+                                    self.warrants_out, self.warrants_per_share)
         if self.shares_out is not None and self.warrants_out is not None:
-            # Adjusting for dilution
-            # Loops through adjusting stock price and recalculating call price
-            # until we stop making significant progress
-            while True:
-                last_adj = call_price
-                adj_stock_price = self.dilution_adjustment(call_price)
-                d1 = self.calc_d1(adj_stock_price, div_adj_intrest_rate, variance)
-                d2 = self.calc_d2(d1)
-                n_d1 = scipy.stats.norm.cdf(d1)
-                n_d2 = scipy.stats.norm.cdf(d2)
-                call_price = ((adj_stock_price * math.exp(-self.div*self.years)) * n_d1) - \
-                            (self.strike_price * math.exp(-self.risk_free_rate*self.years) * n_d2)
-                # print(call_price)
-                if round(call_price, 2) == round(last_adj, 2):
-                    break
             print('Black Scholes calculation WITH share dilution:')
-            return call_price
         else:
             print('Black Scholes calculation with no share dilution:')
-            return call_price/self.warrants_per_share
+        return float(call_price)
+
+
+    def greeks(self, vol=None):
+        '''
+        Returns the price and greeks of the Call/Warrant as a dict of floats,
+        dilution adjusted when shares_out and warrants_out were given
+        '''
+        vol = self.vol if vol is None else vol
+        greeks = warrant_greeks(self.stock_price, self.strike_price, vol, self.years,
+                                self.risk_free_rate, self.div, self.shares_out,
+                                self.warrants_out, self.warrants_per_share)
+        return {name: float(value) if name != 'converged' else bool(value)
+                for name, value in greeks.items()}
+
+
+def price_batch(contracts, defaults=None, greeks=False, today=None, year_cache=None):
+    """
+    Prices a DataFrame of contracts (see BATCH_COLUMNS) in one vectorized pass
+
+    Contracts without shares_out/warrants_out are priced without dilution.
+
+    Arguments:
+        defaults: dict of values for columns missing from contracts
+        greeks: also add the delta/gamma/vega/theta/rho columns
+        year_cache: dict of expiry -> years, shared between chunks
+
+    Returns:
+        contracts with a price column (plus the greeks) added
+    """
+    defaults = {} if defaults is None else defaults
+    contracts = contracts.copy()
+    for column in BATCH_COLUMNS:
+        if column not in contracts:
+            value = defaults.get(column)
+            if value is None and column in BATCH_REQUIRED:
+                raise ValueError('Missing %s column, add it or pass --%s' % (column, column))
+            contracts[column] = value
+    contracts['warrants_per_share'] = contracts['warrants_per_share'].fillna(1)
+    today = datetime.datetime.now().date() if today is None else today
+    year_cache = {} if year_cache is None else year_cache
+    for exp_date in contracts['date'].unique():
+        if exp_date not in year_cache:
+            year_cache[exp_date] = years_until(exp_date, today)
+    years = contracts['date'].map(year_cache).to_numpy(dtype=float)
+
+    values = {name: contracts[name].to_numpy(dtype=float) for name in BATCH_COLUMNS if name != 'date'}
+    diluted = ~(numpy.isnan(values['shares_out']) | numpy.isnan(values['warrants_out']))
+    results = {name: numpy.full(len(contracts), numpy.nan) for name in ['price'] + GREEKS}
+    for mask, dilution in ((~diluted, False), (diluted, True)):
+        if not mask.any():
+            continue
+        args = [values['stock'][mask], values['strike'][mask], values['vol'][mask], years[mask],
+                values['risk'][mask], values['div'][mask]]
+        dilution_args = [values['shares_out'][mask], values['warrants_out'][mask]] if dilution \
+            else [None, None]
+        if greeks:
+            subset = warrant_greeks(*args + dilution_args + [values['warrants_per_share'][mask]])
+        else:
+            subset = {'price': price_warrants(*args + dilution_args +
+                                              [values['warrants_per_share'][mask]])}
+        for name, value in subset.items():
+            if name in results:
+                results[name][mask] = value
+    contracts['price'] = results['price']
+    if greeks:
+        for name in GREEKS:
+            contracts[name] = results[name]
+    return contracts
+
+
+def read_contracts(path, chunksize):
+    """
+    Yields DataFrames of at most chunksize contracts from a CSV or Parquet file
+    """
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pandas.read_csv(path, chunksize=chunksize, dtype={'date': str}):
+            yield chunk
+
+
+class ContractWriter:
+    """
+    Appends priced chunks to a CSV (or Parquet) file, '-' for stdout
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        self.writer = None
+        self.header = True
+
+    def write(self, chunk):
+        if self.parquet:
+            import pyarrow
+            import pyarrow.parquet as pq
+            table = pyarrow.Table.from_pandas(chunk, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            out = sys.stdout if self.path == '-' else self.path
+            chunk.to_csv(out, index=False, header=self.header,
+                         mode='w' if self.header else 'a')
+            self.header = False
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def batch(args):
+    """
+    Prices every contract in args.batch, streaming the results to args.out
+    chunk by chunk so files larger than memory work too
+    """
+    if args.batch.endswith('.parquet') or args.out.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            sys.exit('Black_Scholes.py: error: Parquet files need pyarrow (pip install pyarrow)')
+    defaults = {name: getattr(args, name) for name in BATCH_COLUMNS}
+    year_cache = {}
+    today = datetime.datetime.now().date()
+    count = 0
+    with ContractWriter(args.out) as writer:
+        for chunk in read_contracts(args.batch, args.chunksize):
+            try:
+                writer.write(price_batch(chunk, defaults, args.greeks, today, year_cache))
+            except ValueError as e:
+                sys.exit('Black_Scholes.py: error: %s' % e)
+            count += len(chunk)
+    if args.out != '-':
+        print('Priced %s contracts to %s' % (count, args.out))
 
 
 def main(args):
+    if args.batch:
+        batch(args)
+        return
     bs = BlackScholes(args.strike, args.stock, args.risk, args.vol,
                       args.date, args.div, args.shares_out, args.warrants_out,
                       args.warrants_per_share)
     print('$' + str(round(bs.price_euro_call(), 5)))
+    if args.greeks:
+        for name, value in bs.greeks().items():
+            if name not in ('price', 'converged'):
+                print('%s: %s' % (name, round(value, 5)))
     return
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Calculate the value of a European-styled Warrant/Call Option')
-    parser.add_argument('-k', '--strike', type=float, help='Strike Price', required=True)
-    parser.add_argument('-s', '--stock',  type=float, help='Current Stock Price', required=True)
-    parser.add_argument('-r', '--risk', type=float, help='Risk Free Rate', required=True)
-    parser.add_argument('-v', '--vol', type=float, help='Volatility', required=True)
-    parser.add_argument('-d', '--date',  help='Date of expiration in mm-dd-yyyy format', required=True)
-    parser.add_argument('-y', '--div', type=float, help='Yearly Dividend Yield', required=True)
+    parser.add_argument('-k', '--strike', type=float, help='Strike Price')
+    parser.add_argument('-s', '--stock',  type=float, help='Current Stock Price')
+    parser.add_argument('-r', '--risk', type=float, help='Risk Free Rate')
+    parser.add_argument('-v', '--vol', type=float, help='Volatility')
+    parser.add_argument('-d', '--date',  help='Date of expiration in mm-dd-yyyy format')
+    parser.add_argument('-y', '--div', type=float, help='Yearly Dividend Yield')
     parser.add_argument('--shares_out', type=float, help='Shares Outstanding')
     parser.add_argument('--warrants_out', type=float, help='Warrants Outstanding')
     parser.add_argument('--warrants_per_share', type=float, help='How many Warrants per Share', default=1)
-    main(parser.parse_args())
+    parser.add_argument('--greeks', action='store_true', help='Also print delta, gamma, vega, theta and rho')
+    parser.add_argument('--batch', help='CSV or Parquet file of contracts to price, with columns '
+                                        'named like the arguments above (missing columns use the argument)')
+    parser.add_argument('-o', '--out', default='-', help='Where batch results go, CSV or Parquet (default stdout)')
+    parser.add_argument('--chunksize', type=int, default=100000, help='Contracts priced at a time in batch mode')
+    args = parser.parse_args()
+    if not args.batch:
+        missing = [name for name in BATCH_REQUIRED if getattr(args, name) is None]
+        if missing:
+            parser.error('the following arguments are required: %s' %
+                         ', '.join('--' + name for name in missing))
+    main(args)
 
 
 # TODO ##################
@@ -0,0 +1,339 @@
+'''
+Local caches for data requested from IB
+
+FundamentalCache keeps the fundamental data XML (e.g. ReportsFinStatements)
+in SQLite so screens over hundreds of tickers don't have to re-download
+filings that only change once a quarter.
+
+BarCache keeps historical bars so daily runs only request the bars since
+the last one stored instead of a whole year of them.
+
+ContractCache keeps the conId and primary exchange IB resolved each symbol
+to, so requests can name the exact contract instead of having IB look the
+symbol up again every time.
+'''
+import collections
+import datetime
+import re
+import sqlite3
+import threading
+import time
+
+import pandas
+
+
+LAST_MODIFIED_RE = re.compile(r'<LastModified>([^<]*)</LastModified>')
+
+
+# Calendar days in each IB duration unit
+DURATION_DAYS = {'D': 1, 'W': 7, 'M': 30, 'Y': 365}
+# Longest gap requested as "N D", anything older is requested in full
+MAX_GAP_DAYS = 365
+
+
+def durationStart(duration, today=None):
+    '''
+    First date (as 'YYYYMMDD', like daily bar dates) an IB duration string
+    such as "1 Y" or "30 D" reaches back to
+    '''
+    today = datetime.date.today() if today is None else today
+    amount, unit = duration.split()
+    start = today - datetime.timedelta(days=int(amount) * DURATION_DAYS[unit])
+    return start.strftime('%Y%m%d')
+
+
+def gapDuration(last_date, today=None):
+    '''
+    Duration string covering last_date ('YYYYMMDD') through today, so the
+    last stored bar is requested again in case it was still forming.
+    None if the gap is too long to be worth requesting as a gap
+    '''
+    today = datetime.date.today() if today is None else today
+    days = (today - datetime.datetime.strptime(last_date[:8], '%Y%m%d').date()).days + 1
+    if days > MAX_GAP_DAYS:
+        return None
+    return '%d D' % max(days, 1)
+
+
+def lastModified(data):
+    '''
+    Returns the CoGeneralInfo/LastModified date of a fundamental report, or None
+    '''
+    match = LAST_MODIFIED_RE.search(data)
+    return match.group(1) if match else None
+
+
+class FundamentalCache:
+    '''
+    SQLite cache of fundamental reports keyed by contract (symbol, secType,
+    currency) and report type, remembering each report's LastModified date.
+
+    Policy:
+        - Entries younger than ttl seconds are served without asking IB
+        - Older entries are revalidated: the report is requested again and if
+          its LastModified hasn't changed only the timestamp is refreshed.
+          Stale entries can still be used when IB fails to answer (see get)
+        - Once the cache holds more than max_bytes of reports, the least
+          recently used ones are evicted
+
+    Arguments:
+        path {str} -- SQLite file, ':memory:' for a throwaway cache
+        ttl {float} -- seconds a report is considered fresh (default 7 days)
+        max_bytes {int} -- size bound for all cached reports (default 256 MB)
+    '''
+
+    def __init__(self, path, ttl=7*24*60*60, max_bytes=256*1024*1024, clock=time.time):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS fundamentals (
+                               symbol TEXT NOT NULL,
+                               sec_type TEXT NOT NULL,
+                               currency TEXT NOT NULL,
+                               report_type TEXT NOT NULL,
+                               last_modified TEXT,
+                               fetched REAL NOT NULL,
+                               accessed REAL NOT NULL,
+                               size INTEGER NOT NULL,
+                               data TEXT NOT NULL,
+                               PRIMARY KEY (symbol, sec_type, currency, report_type))''')
+        self.db.commit()
+
+    def key(self, contract, report_type):
+        return (contract.symbol, contract.secType, contract.currency, report_type)
+
+    def get(self, contract, report_type, stale=False):
+        '''
+        Returns the cached report for a contract, or None if we don't have one
+        that is still fresh. stale=True returns it no matter how old it is
+        '''
+        now = self.clock()
+        key = self.key(contract, report_type)
+        with self.lock:
+            row = self.db.execute('''SELECT data, fetched FROM fundamentals
+                                     WHERE symbol=? AND sec_type=? AND currency=?
+                                     AND report_type=?''', key).fetchone()
+            if row is None or (not stale and now - row[1] > self.ttl):
+                return None
+            self.db.execute('''UPDATE fundamentals SET accessed=?
+                               WHERE symbol=? AND sec_type=? AND currency=?
+                               AND report_type=?''', (now,) + key)
+            self.db.commit()
+        return row[0]
+
+    def put(self, contract, report_type, data):
+        now = self.clock()
+        key = self.key(contract, report_type)
+        modified = lastModified(data)
+        with self.lock:
+            row = self.db.execute('''SELECT last_modified FROM fundamentals
+                                     WHERE symbol=? AND sec_type=? AND currency=?
+                                     AND report_type=?''', key).fetchone()
+            if row is not None and modified is not None and row[0] == modified:
+                # Revalidated, the report hasn't changed since we cached it
+                self.db.execute('''UPDATE fundamentals SET fetched=?, accessed=?
+                                   WHERE symbol=? AND sec_type=? AND currency=?
+                                   AND report_type=?''', (now, now) + key)
+            else:
+                self.db.execute('''INSERT OR REPLACE INTO fundamentals VALUES
+                                   (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                                key + (modified, now, now, len(data), data))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        '''
+        Drops least recently used reports until we are under max_bytes
+        '''
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM fundamentals').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.db.execute('''SELECT rowid, size FROM fundamentals
+                                  ORDER BY accessed''').fetchall()
+        for rowid, size in rows:
+            if total <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM fundamentals WHERE rowid=?', (rowid,))
+            total -= size
+
+    def size(self):
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM fundamentals').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+BarSeries = collections.namedtuple('BarSeries', ['covered_from', 'first_date', 'last_date', 'fetched'])
+
+
+class BarCache:
+    '''
+    SQLite store of historical bars keyed by contract (symbol, secType,
+    currency), bar size and whatToShow, one row per bar.
+
+    Each series remembers the earliest date it is known to be complete from
+    (covered_from) and when it was last fetched, so a request can be served
+    from the store plus just the bars since the last one:
+        - Series fetched less than ttl seconds ago are served as is
+        - Otherwise only the gap from the last stored bar is requested and
+          merged in (bars of the same date are replaced)
+        - Requests reaching back before covered_from are made in full
+
+    Arguments:
+        path {str} -- SQLite file, ':memory:' for a throwaway cache
+        ttl {float} -- seconds a series is served without asking IB (default 1 hour)
+    '''
+
+    def __init__(self, path, ttl=60*60, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS bar_series (
+                               symbol TEXT NOT NULL,
+                               sec_type TEXT NOT NULL,
+                               currency TEXT NOT NULL,
+                               bar_size TEXT NOT NULL,
+                               what_to_show TEXT NOT NULL,
+                               covered_from TEXT NOT NULL,
+                               fetched REAL NOT NULL,
+                               PRIMARY KEY (symbol, sec_type, currency, bar_size, what_to_show))''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS bars (
+                               symbol TEXT NOT NULL,
+                               sec_type TEXT NOT NULL,
+                               currency TEXT NOT NULL,
+                               bar_size TEXT NOT NULL,
+                               what_to_show TEXT NOT NULL,
+                               date TEXT NOT NULL,
+                               open REAL,
+                               high REAL,
+                               low REAL,
+                               close REAL,
+                               volume REAL,
+                               PRIMARY KEY (symbol, sec_type, currency, bar_size, what_to_show, date))''')
+        self.db.commit()
+
+    def key(self, contract, bar_size, what_to_show):
+        return (contract.symbol, contract.secType, contract.currency, bar_size, what_to_show)
+
+    def series(self, contract, bar_size, what_to_show):
+        '''
+        BarSeries for a contract, or None if nothing is stored
+        '''
+        key = self.key(contract, bar_size, what_to_show)
+        with self.lock:
+            row = self.db.execute('''SELECT covered_from, fetched FROM bar_series
+                                     WHERE symbol=? AND sec_type=? AND currency=?
+                                     AND bar_size=? AND what_to_show=?''', key).fetchone()
+            if row is None:
+                return None
+            first, last = self.db.execute('''SELECT MIN(date), MAX(date) FROM bars
+                                             WHERE symbol=? AND sec_type=? AND currency=?
+                                             AND bar_size=? AND what_to_show=?''', key).fetchone()
+        if last is None:
+            return None
+        return BarSeries(row[0], first, last, row[1])
+
+    def fresh(self, series):
+        return self.clock() - series.fetched <= self.ttl
+
+    def get(self, contract, bar_size, what_to_show, start=None):
+        '''
+        Stored bars from start ('YYYYMMDD', inclusive) on as a dataframe
+        with date, price (the close) and open/high/low/close/volume columns,
+        oldest first, like App.getHistoricalDataFuture returns
+        '''
+        key = self.key(contract, bar_size, what_to_show)
+        with self.lock:
+            rows = self.db.execute('''SELECT date, close, open, high, low, close, volume FROM bars
+                                      WHERE symbol=? AND sec_type=? AND currency=?
+                                      AND bar_size=? AND what_to_show=? AND date >= ?
+                                      ORDER BY date''', key + (start or '',)).fetchall()
+        df = pandas.DataFrame(rows, columns=['date', 'price', 'open', 'high', 'low', 'close', 'volume'])
+        # Bars stored with only a price have no open/high/low/volume
+        return df.astype({c: float for c in df.columns[1:]})
+
+    def put(self, contract, bar_size, what_to_show, df, covered_from=None):
+        '''
+        Merges bars (a dataframe with a date column and price or close,
+        plus any of open/high/low/volume) into the series. covered_from is
+        the date the bars are complete from when they answer a full request
+        '''
+        key = self.key(contract, bar_size, what_to_show)
+        if 'close' not in df.columns:
+            df = df.rename(columns={'price': 'close'})
+        # tolist() so sqlite gets python numbers rather than numpy ones
+        columns = [df[c].tolist() if c in df.columns else [None]*len(df)
+                   for c in ('date', 'open', 'high', 'low', 'close', 'volume')]
+        rows = [key + row for row in zip(*columns)]
+        with self.lock:
+            self.db.executemany('''INSERT OR REPLACE INTO bars VALUES
+                                   (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            row = self.db.execute('''SELECT covered_from FROM bar_series
+                                     WHERE symbol=? AND sec_type=? AND currency=?
+                                     AND bar_size=? AND what_to_show=?''', key).fetchone()
+            if row is not None and (covered_from is None or row[0] < covered_from):
+                covered_from = row[0]
+            if covered_from is None:
+                covered_from = min(df['date']) if len(df) else ''
+            self.db.execute('''INSERT OR REPLACE INTO bar_series VALUES
+                               (?, ?, ?, ?, ?, ?, ?)''', key + (covered_from, self.clock()))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+ContractInfo = collections.namedtuple('ContractInfo', ['conId', 'primaryExchange', 'fetched'])
+
+
+class ContractCache:
+    '''
+    SQLite store of the contract each symbol resolved to, keyed by symbol,
+    secType and currency like the other caches. Entries older than ttl are
+    treated as missing so renamed or relisted symbols get resolved again
+
+    Arguments:
+        path {str} -- SQLite file, ':memory:' for a throwaway cache
+        ttl {float} -- seconds a resolved contract is trusted (default 30 days)
+    '''
+
+    def __init__(self, path, ttl=30*24*60*60, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS contracts (
+                               symbol TEXT NOT NULL,
+                               sec_type TEXT NOT NULL,
+                               currency TEXT NOT NULL,
+                               con_id INTEGER NOT NULL,
+                               primary_exchange TEXT,
+                               fetched REAL NOT NULL,
+                               PRIMARY KEY (symbol, sec_type, currency))''')
+        self.db.commit()
+
+    def get(self, symbol, secType, currency):
+        '''
+        ContractInfo for the symbol, or None if it isn't stored (or is too old)
+        '''
+        with self.lock:
+            row = self.db.execute('''SELECT con_id, primary_exchange, fetched FROM contracts
+                                     WHERE symbol=? AND sec_type=? AND currency=?''',
+                                  (symbol, secType, currency)).fetchone()
+        if row is None or self.clock() - row[2] > self.ttl:
+            return None
+        return ContractInfo(*row)
+
+    def put(self, symbol, secType, currency, conId, primaryExchange):
+        with self.lock:
+            self.db.execute('''INSERT OR REPLACE INTO contracts VALUES
+                               (?, ?, ?, ?, ?, ?)''',
+                            (symbol, secType, currency, conId, primaryExchange, self.clock()))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
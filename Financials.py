@@ -0,0 +1,487 @@
+'''
+Parsing of IB's ReportsFinStatements fundamental data
+
+parse() walks the report once and returns a Financials object with every
+annual and interim period, so callers no longer need to parse the same XML
+once for the quarters and again for the annual reports.
+
+The XML is streamed through ElementTree's incremental (iterparse) parser:
+line items are read straight into each Period and elements are cleared as
+soon as they have been used, so we never build the whole document tree (or a
+dict for every node).
+
+ParsePool spreads the parsing of many reports over worker processes and can
+start on each report as soon as it arrives from IB.
+
+FundamentalsMatrix holds the line items of many reports in a single float
+array (tickers x periods x coaCodes) that can be sliced and saved/memory
+mapped without going through per-period dicts.
+'''
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+import numpy
+import pandas
+
+from coaCodes import coaCode_map
+
+
+ACCEPTED_REPORTS = ["10-K", "10-Q", "Interim Report", "ARS"]
+# Characters of xml handed to the parser at a time
+CHUNK_SIZE = 16 * 1024
+# Reports sent to a worker process at a time
+BATCH_SIZE = 8
+
+# Fixed FundamentalsMatrix column of every coaCode
+COA_CODES = list(coaCode_map)
+COA_INDEX = {code: i for i, code in enumerate(COA_CODES)}
+# Line item name -> its columns. A few names (minority_interest) are used by
+# more than one coaCode, in which case the later code wins like in Period.items
+ITEM_COLUMNS = {}
+for i, code in enumerate(COA_CODES):
+    ITEM_COLUMNS.setdefault(coaCode_map[code], []).append(i)
+
+
+class Period:
+    '''
+    One fiscal period (annual or interim) of a report
+
+    Attributes:
+        period_type: 'Annual' or 'Interim'
+        end_date: period end date as str 'yyyy-mm-dd'
+        fiscal_year: str
+        headers: dict of statement type (INC, BAL, CAS) -> FPHeader fields
+            (source, source_date, statement_date, period_length, period_type, update_type)
+        statements: dict of statement type -> {coaCode: value}
+        items: dict of every line item in the period keyed by coaCodes.coaCode_map
+            names. This is what the Ratios functions take.
+    '''
+
+    def __init__(self, period_type, end_date, fiscal_year):
+        self.period_type = period_type
+        self.end_date = end_date
+        self.fiscal_year = fiscal_year
+        self.headers = {}
+        self.statements = {}
+        self.items = {}
+
+    @property
+    def source(self):
+        '''
+        Source document (10-K, 10-Q, ...) of the period's first statement
+        '''
+        for header in self.headers.values():
+            return header.get('source')
+        return None
+
+    def __repr__(self):
+        return 'Period(%s %s %s, %s items)' % (self.period_type, self.end_date,
+                                               self.source, len(self.items))
+
+
+class Financials:
+    '''
+    All accepted periods of a report, most recent first
+
+    Attributes:
+        annuals: list of annual Periods
+        interims: list of interim (quarterly) Periods
+    '''
+
+    def __init__(self, annuals=None, interims=None):
+        self.annuals = annuals if annuals is not None else []
+        self.interims = interims if interims is not None else []
+
+    def quarters(self, n=4):
+        '''
+        Items of the latest n interim periods, padded with None.
+        Same as App.parseFinancials(data, quarterly=True)
+        '''
+        return tuple(pad([p.items for p in self.interims[:n]], n))
+
+    def years(self, n=2):
+        '''
+        Items of the latest n annual periods, padded with None.
+        Same as App.parseFinancials(data)
+        '''
+        return tuple(pad([p.items for p in self.annuals[:n]], n))
+
+    def toFrame(self):
+        '''
+        Dataframe with a row per period and a column per line item
+        '''
+        rows = []
+        for p in self.annuals + self.interims:
+            row = {'Period': p.period_type, 'End Date': p.end_date,
+                   'Fiscal Year': p.fiscal_year, 'Source': p.source}
+            row.update(p.items)
+            rows.append(row)
+        return pandas.DataFrame(rows)
+
+
+def pad(items, n):
+    return items + [None] * (n - len(items))
+
+
+def parseHeader(header):
+    '''
+    FPHeader element -> dict of the fields we keep
+    '''
+    if header is None:
+        return {'source': None}
+    source = header.find('Source')
+    period_type = header.find('periodType')
+    update_type = header.find('UpdateType')
+    return {'source': source.text if source is not None else None,
+            'source_date': source.get('Date') if source is not None else None,
+            'statement_date': header.findtext('StatementDate'),
+            'period_length': header.findtext('PeriodLength'),
+            'period_type': period_type.text if period_type is not None else None,
+            'update_type': update_type.get('Code') if update_type is not None else None}
+
+
+def readStatement(period, statement_type, header, statement):
+    '''
+    Adds a Statement element's line items to the period
+    statement_type is either INC, BAL, or CAS
+    '''
+    period.headers[statement_type] = header
+    codes = period.statements.setdefault(statement_type, {})
+    items = period.items
+    for line_item in statement.iter('lineItem'):
+        code = line_item.get('coaCode')
+        try:
+            value = float(line_item.text)
+            codes[code] = value
+            items[coaCode_map[code]] = value
+        except (KeyError, TypeError):
+            print('Could not find coaCode!!!')
+            print(code)
+
+
+def iterEvents(data, chunk_size=CHUNK_SIZE):
+    '''
+    Same as ElementTree.iterparse(..., events=('start', 'end')) but takes the
+    xml string itself and feeds it in slices, so no copy of the whole report is made
+    '''
+    parser = XMLPullParser(events=('start', 'end'))
+    for i in range(0, len(data), chunk_size):
+        parser.feed(data[i:i + chunk_size])
+        for event in parser.read_events():
+            yield event
+    parser.close()
+    for event in parser.read_events():
+        yield event
+
+
+def iterPeriods(data, sections=None):
+    '''
+    Streams the accepted periods of a ReportsFinStatements xml
+
+    Periods with a single statement or whose first statement isn't from an
+    accepted report are skipped. Line items of skipped periods are never read.
+
+    Arguments:
+        data {str} -- ReportsFinStatements xml
+        sections {dict} -- optional, filled with the number of FiscalPeriods
+                           seen under each section (AnnualPeriods, InterimPeriods)
+                           and the number of sections under FinancialStatements
+
+    Yields:
+        (str, Period) -- section tag and period, in document order
+    '''
+    if sections is None:
+        sections = {}
+    depth = 0
+    statements_depth = None
+    section = None
+    period = None
+    accepted = False
+    n_statements = 0
+    for event, elem in iterEvents(data):
+        tag = elem.tag
+        if event == 'start':
+            depth += 1
+            if depth == statements_depth:
+                sections['FinancialStatements'] += 1
+            if tag == 'FiscalPeriod':
+                sections[section] = sections.get(section, 0) + 1
+                period = Period(elem.get('Type'), elem.get('EndDate'), elem.get('FiscalYear'))
+                accepted = False
+                n_statements = 0
+            elif tag in ('AnnualPeriods', 'InterimPeriods'):
+                section = tag
+                sections.setdefault(tag, 0)
+            elif tag == 'FinancialStatements':
+                sections[tag] = 0
+                statements_depth = depth + 1
+            continue
+
+        depth -= 1
+        if tag == 'Statement' and period is not None:
+            # A statement is small, read it whole then drop it
+            header = parseHeader(elem.find('FPHeader'))
+            if n_statements == 0:
+                # The first statement decides if we want the period
+                accepted = header['source'] in ACCEPTED_REPORTS
+            n_statements += 1
+            if accepted:
+                readStatement(period, elem.get('Type'), header, elem)
+            elem.clear()
+        elif tag == 'FiscalPeriod':
+            # Periods with a single statement are skipped, we need all three
+            if accepted and n_statements > 1:
+                yield section, period
+            period = None
+            elem.clear()
+        elif tag in ('AnnualPeriods', 'InterimPeriods'):
+            section = None
+            elem.clear()
+        elif depth == 1:
+            # Done with a top level section (CoIDs, Issues, COAMap, ...)
+            elem.clear()
+
+
+def records(data):
+    '''
+    Streams (period, statement type, coaCode, value) records of the accepted
+    periods of a ReportsFinStatements xml
+    '''
+    for _, period in iterPeriods(data):
+        for statement_type, codes in period.statements.items():
+            for code, value in codes.items():
+                yield period, statement_type, code, value
+
+
+def parse(data):
+    '''
+    Parses ReportsFinStatements xml into a Financials object
+    '''
+    sections = {}
+    report = Financials()
+    for section, period in iterPeriods(data, sections):
+        if section == 'AnnualPeriods':
+            report.annuals.append(period)
+        else:
+            report.interims.append(period)
+    if not sections.get('FinancialStatements'):
+        print('No Fundamental Data')
+        return Financials()
+    if not sections.get('AnnualPeriods') or not sections.get('InterimPeriods'):
+        print('ERROR with fundamental data')
+        return Financials()
+    return report
+
+
+def parseBatch(datas):
+    '''
+    Parses a list of reports, run by ParsePool's worker processes
+    '''
+    reports = []
+    for data in datas:
+        try:
+            reports.append(parse(data))
+        except ParseError as e:
+            print('ERROR with fundamental data: %s' % e)
+            reports.append(Financials())
+    return reports
+
+
+class ParsePool:
+    '''
+    Parses reports on a pool of worker processes
+
+    Reports are sent to the workers in batches of batch_size as they are
+    submitted, so parsing overlaps with waiting on IB for the rest of the
+    universe. results() sends the last partial batch and waits for everything.
+
+    Arguments:
+        workers {int} -- worker processes, None for one per cpu and
+                         0 to parse in this process instead
+        batch_size {int} -- reports per task sent to a worker
+    '''
+
+    def __init__(self, workers=None, batch_size=BATCH_SIZE):
+        self.executor = ProcessPoolExecutor(workers) if workers != 0 else None
+        self.batch_size = batch_size
+        self.keys = []
+        self.datas = []
+        self.batches = []  # (keys, future or list of Financials)
+
+    def submit(self, key, data):
+        '''
+        Queues a report to be parsed, key is what results() returns it under
+        '''
+        self.keys.append(key)
+        self.datas.append(data)
+        if len(self.datas) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.datas:
+            return
+        if self.executor is None:
+            self.batches.append((self.keys, parseBatch(self.datas)))
+        else:
+            self.batches.append((self.keys, self.executor.submit(parseBatch, self.datas)))
+        self.keys = []
+        self.datas = []
+
+    def results(self):
+        '''
+        Waits for every submitted report
+
+        Returns:
+            dict -- keys as given to submit and Financials objects as values
+        '''
+        self.flush()
+        reports = {}
+        for keys, batch in self.batches:
+            if self.executor is not None:
+                batch = batch.result()
+            reports.update(zip(keys, batch))
+        return reports
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parseMany(datas, workers=None, batch_size=BATCH_SIZE):
+    '''
+    Parses many reports in parallel
+
+    Arguments:
+        datas {dict} -- keys (e.g. tickers) and ReportsFinStatements xml as values
+
+    Returns:
+        dict -- same keys and Financials objects as values
+    '''
+    with ParsePool(workers, batch_size) as pool:
+        for key, data in datas.items():
+            pool.submit(key, data)
+        return pool.results()
+
+
+class FundamentalsMatrix:
+    '''
+    Line items of many reports as one float64 array
+
+    values[t, p, c] is coaCode COA_CODES[c] of period p of symbols[t], NaN
+    when missing. The first `quarters` periods are the latest interim
+    periods (qtr1 first) followed by the latest `years` annual periods.
+
+    Attributes:
+        symbols: list of tickers, one per row
+        values: float64 array (tickers x periods x len(COA_CODES))
+        end_dates: datetime64[D] array (tickers x periods), NaT when missing
+        quarters: number of interim periods
+        years: number of annual periods
+    '''
+
+    def __init__(self, symbols, values, end_dates, quarters=4, years=2):
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.values = values
+        self.end_dates = end_dates
+        self.quarters = quarters
+        self.years = years
+
+    @classmethod
+    def fromReports(cls, reports, quarters=4, years=2):
+        '''
+        Arguments:
+            reports {dict} -- tickers as keys and Financials objects as values
+                              (e.g. what ParsePool.results() returns)
+        '''
+        symbols = list(reports)
+        shape = (len(symbols), quarters + years)
+        values = numpy.full(shape + (len(COA_CODES),), numpy.nan)
+        end_dates = numpy.full(shape, numpy.datetime64('NaT'), dtype='datetime64[D]')
+        for t, symbol in enumerate(symbols):
+            report = reports[symbol]
+            periods = pad(report.interims[:quarters], quarters) + pad(report.annuals[:years], years)
+            for p, period in enumerate(periods):
+                if period is None:
+                    continue
+                if period.end_date:
+                    end_dates[t, p] = period.end_date
+                row = values[t, p]
+                for codes in period.statements.values():
+                    for code, value in codes.items():
+                        column = COA_INDEX.get(code)
+                        if column is not None:
+                            row[column] = value
+        return cls(symbols, values, end_dates, quarters, years)
+
+    def code(self, code):
+        '''
+        tickers x periods array of a coaCode
+        '''
+        return self.values[:, :, COA_INDEX[code]]
+
+    def item(self, name):
+        '''
+        tickers x periods array of a line item, by its coaCodes.coaCode_map name
+        '''
+        columns = ITEM_COLUMNS[name]
+        result = self.values[:, :, columns[0]]
+        for column in columns[1:]:
+            later = self.values[:, :, column]
+            result = numpy.where(numpy.isnan(later), result, later)
+        return result
+
+    def quarter(self, name, n=1):
+        '''
+        Line item of every ticker in their nth latest quarter (1 is the latest)
+        '''
+        return self.item(name)[:, n - 1]
+
+    def year(self, name, n=1):
+        '''
+        Line item of every ticker in their nth latest annual report
+        '''
+        return self.item(name)[:, self.quarters + n - 1]
+
+    def row(self, symbol):
+        '''
+        periods x coaCodes array of a ticker
+        '''
+        return self.values[self.index[symbol]]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.end_dates.nbytes
+
+    def save(self, path):
+        '''
+        Saves to a directory: values.npy and end_dates.npy (loadable as memory
+        maps) plus meta.json with the symbols and column layout
+        '''
+        os.makedirs(path, exist_ok=True)
+        numpy.save(os.path.join(path, 'values.npy'), self.values)
+        numpy.save(os.path.join(path, 'end_dates.npy'), self.end_dates)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'symbols': self.symbols, 'quarters': self.quarters,
+                       'years': self.years, 'coa_codes': COA_CODES}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Loads a saved matrix, memory mapped unless mmap_mode is None
+        '''
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['coa_codes'] != COA_CODES:
+            raise ValueError('%s was saved with a different coaCode layout' % path)
+        values = numpy.load(os.path.join(path, 'values.npy'), mmap_mode=mmap_mode)
+        end_dates = numpy.load(os.path.join(path, 'end_dates.npy'), mmap_mode=mmap_mode)
+        return cls(meta['symbols'], values, end_dates, meta['quarters'], meta['years'])
@@ -1,31 +1,224 @@
+import array
+import asyncio
 import datetime
+import inspect
+import logging
 import queue
+import socket
 from threading import Thread
+import struct
 import sys
+import threading
 import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import Future
 
+import numpy
 import pandas
-import xmltodict
 
+from ibapi import comm, connection, decoder, reader
 from ibapi.wrapper import EWrapper
 from ibapi.client import EClient
+from ibapi.server_versions import MIN_CLIENT_VER, MAX_CLIENT_VER
 from ibapi.utils import iswrapper
+from ibapi.common import NO_VALID_ID
+from ibapi.errors import CONNECT_FAIL
 from ibapi.contract import Contract
 from ibapi.order import Order
 from ibapi.account_summary_tags import AccountSummaryTags
 
-import coaCodes
+import Cache
+import Financials
+import Pacing
 from ContractSamples import ContractSamples
 
 
+logger = logging.getLogger(__name__)
+
+
+class RequestError(Exception):
+    '''
+    Raised by a request's future when IB answers the request with an error
+    '''
+
+    def __init__(self, reqId, errorCode, errorString):
+        super().__init__('Id: %s Code: %s Msg: %s' % (reqId, errorCode, errorString))
+        self.reqId = reqId
+        self.errorCode = errorCode
+        self.errorString = errorString
+
+
+def isDataError(reqId, errorCode, errorString):
+    '''
+    True if an error from IB means the request failed, False for
+    informational messages such as market data farm connection notices
+    '''
+    if errorCode == 2104 or errorCode == 2106:
+        return False
+    if errorCode == 10167 and 'Displaying delayed market data' in errorString:
+        return False
+    return reqId != -1
+
+
+def resolve(fut, result):
+    if not fut.done():
+        fut.set_result(result)
+
+
+class DataQueue(queue.Queue):
+    '''
+    Queue that also sets a shared event whenever something is put on it,
+    so a consumer watching several queues can block on a single event
+    '''
+
+    def __init__(self, event):
+        super().__init__()
+        self.event = event
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self.event.set()
+
+
+class BarBuffer:
+    '''
+    Columnar buffer for the bars of one historical data request.
+
+    Each field goes straight into its own growable array of doubles as the
+    historicalData callbacks come in, and frame() wraps them in numpy arrays
+    without copying, so long or fine grained requests don't create and hold
+    a python object per bar
+    '''
+    FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self):
+        self.dates = []
+        self.columns = {field: array.array('d') for field in self.FIELDS}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def append(self, bar):
+        self.dates.append(bar.date)
+        for field, column in self.columns.items():
+            column.append(getattr(bar, field))
+
+    def frame(self):
+        '''
+        Dataframe with date, price (the close) and open/high/low/close/volume
+        columns. The float columns share memory with the buffer
+        '''
+        columns = {field: numpy.frombuffer(column, dtype=numpy.float64)
+                   for field, column in self.columns.items()}
+        data = {'date': self.dates, 'price': columns['close']}
+        data.update(columns)
+        return pandas.DataFrame(data, copy=False)
+
+
+class Router(EWrapper):
+    '''
+    EWrapper that routes each callback to a handler instead of patching
+    EWrapper itself. Callbacks whose first argument is a reqId go to the
+    handler registered for that request (if any), so concurrent requests
+    of the same type can each have their own handler. Everything else goes
+    to the global handlers, and unhandled callbacks fall back to EWrapper.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.handlers = {}
+        self.req_handlers = {}
+
+    def register(self, method, reqId=None):
+        name = method.__name__.split('.')[-1]
+        with self.lock:
+            if reqId is None:
+                self.handlers[name] = method
+            else:
+                self.req_handlers.setdefault(reqId, {})[name] = method
+
+    def unregister(self, reqId):
+        with self.lock:
+            self.req_handlers.pop(reqId, None)
+
+    def handler(self, name, reqId=None):
+        with self.lock:
+            if reqId in self.req_handlers and name in self.req_handlers[reqId]:
+                return self.req_handlers[reqId][name]
+            return self.handlers.get(name)
+
+    def error(self, reqId, errorCode, errorString):
+        # Errors always go to the global handler (logging, data_errors_q,
+        # pacing) and then to the request's own handler if it has one
+        handler = self.handler('error')
+        if handler is not None:
+            handler(reqId, errorCode, errorString)
+        else:
+            super().error(reqId, errorCode, errorString)
+        with self.lock:
+            handler = self.req_handlers.get(reqId, {}).get('error')
+        if handler is not None:
+            handler(reqId, errorCode, errorString)
+
+
+def _route(name, keyed):
+    def f(self, *args):
+        reqId = args[0] if keyed and args else None
+        handler = self.handler(name, reqId)
+        if handler is not None:
+            return handler(*args)
+        return getattr(EWrapper, name)(self, *args)
+    f.__name__ = name
+    return f
+
+
+# Generate a routing method for every EWrapper callback
+for _name, _method in inspect.getmembers(EWrapper, inspect.isfunction):
+    if _name.startswith('_') or _name in Router.__dict__ or _name == 'logAnswer':
+        continue
+    _params = list(inspect.signature(_method).parameters)[1:]
+    setattr(Router, _name, _route(_name, bool(_params) and _params[0] in ('reqId', 'tickerId')))
+
+
+# Bars getHistoricalData asks for
+HIST_BAR_SIZE = "1 day"
+HIST_WHAT_TO_SHOW = "MIDPOINT"
+
+
 class App:
     def __init__(self, ip_addr='127.0.0.1', port=7497, clientId=1):
 
         # Wrapper Methods
         def nextValidId(reqId):
             q.put(reqId)
+        # Wrapper Methods End
+
+        self.setup(ip_addr, port, clientId)
+        q = queue.Queue()
+        self.wrap(nextValidId)
+
+        self.client.connect(ip_addr, port, clientId)
+        self._thread = Thread(target=self.client.run)
+        self._thread.start()
+        # Once we get a reqID, we know we can start
+        self._reqId = q.get()
+
+    def setup(self, ip_addr, port, clientId):
+        '''
+        Sets up the wrapper, client and data queues, everything short of connecting
+        '''
+        self.setupWrapper(ip_addr, port, clientId)
+        self.client = Client(self.wrapper)
+        # Shared by every request so we stay within IB's pacing limits
+        self.scheduler = Pacing.Scheduler()
 
+    def setupWrapper(self, ip_addr, port, clientId):
+        '''
+        setup without the client and scheduler, for apps bringing their own
+        '''
+
+        # Wrapper Methods
         def connectionClosed():
             print('CONNECTION HAS CLOSED')
 
@@ -33,108 +226,167 @@ class App:
             if errorCode != 2104 and errorCode != 2106:
                 print("Error. Id: ", reqId, " Code: ",
                       errorCode, " Msg: ", errorString)
-                if errorCode == 10167 and 'Displaying delayed market data' in errorString:
-                    pass
-                elif reqId != -1:
+                if isDataError(reqId, errorCode, errorString):
                     self.data_errors_q.put((errorString, reqId))
                 if 'pacing violation' in errorString:
                     self.slowdown = True
         # Wrapper Methods End
 
-        self.wrapper = EWrapper()
-        self.client = EClient(self.wrapper)
-
-        self.client.connect(ip_addr, port, clientId)
+        self.wrapper = Router()
         self.ip_addr = ip_addr
         self.my_port = port
         self.my_clientId = clientId
+        # Seconds to wait on a batch of data requests, None waits forever
+        self.data_timeout = None
+        # Optional Cache.FundamentalCache consulted before requesting fundamentals
+        self.fund_cache = None
+        # Optional Cache.BarCache, getHistoricalData then only requests new bars
+        self.bar_cache = None
+        # Optional MarketData.MarketDataManager, getPrice is then served from
+        # streaming subscriptions instead of snapshots
+        self.market_data = None
+        # Optional Cache.ContractCache, createContract then fills in the conId
+        # and primary exchange of symbols resolveContractFuture has looked up
+        self.contract_cache = None
+        # Worker processes for Financials.ParsePool, None for one per cpu
+        self.parse_workers = None
+        self._reqId_lock = threading.Lock()
+        # Requests wrapper callbacks make, sent in order by the sender thread
+        self._send_q = queue.Queue()
+        self._sender = None
+        self._sender_lock = threading.Lock()
         self.resetData()
 
         # Wrap wrapper methods
         self.wrap(error)
         self.wrap(connectionClosed)
-        self.wrap(nextValidId)
 
-        q = queue.Queue()
-        self._thread = Thread(target=self.client.run)
-        self._thread.start()
-        # Once we get a reqID, we know we can start
-        self._reqId = q.get()
+    def wrap(self, method, reqId=None):
+        '''
+        Registers a wrapper method, named after the EWrapper callback it handles.
+        If reqId is given it only gets callbacks for that request
+        '''
+        self.wrapper.register(method, reqId)
 
-    def wrap(self, method):
-        def f(wrapper, *args):
-            return method(*args)
-        name = method.__name__.split('.')[-1]
-        setattr(self.wrapper.__class__, name, f)
+    def pace(self, endpoint=None):
+        '''
+        Blocks until the scheduler lets us send a request to the endpoint
+        '''
+        self.scheduler.wait(endpoint)
+
+    def defer(self, method, *args):
+        '''
+        Calls method(*args) on the sender thread, in the order deferred.
+        For requests made from wrapper callbacks, pacing them right there
+        would hold up the decoder thread and every reply behind it
+        '''
+        with self._sender_lock:
+            if self._sender is None:
+                self._sender = Thread(target=self.sendLoop, daemon=True)
+                self._sender.start()
+        self._send_q.put((method, args))
+
+    def sendLoop(self):
+        while True:
+            method, args = self._send_q.get()
+            try:
+                method(*args)
+            except Exception:
+                logger.exception('Deferred request failed')
+
+    def newFuture(self):
+        return Future()
 
     def getReqId(self):
-        reqId = self._reqId
-        self._reqId += 1
+        with self._reqId_lock:
+            reqId = self._reqId
+            self._reqId += 1
         return reqId
 
     def resetData(self):
+        # Set whenever any of the data queues below gets something
+        self.data_event = threading.Event()
+
         # Historical Data
-        self.hist_data_q = queue.Queue()
-        self.hist_data_dict_q = {}
+        self.hist_data_q = DataQueue(self.data_event)
 
         # Fundamental Data
-        self.fundamental_data_q = queue.Queue()
+        self.fundamental_data_q = DataQueue(self.data_event)
         self.slowdown = False
 
         # Price Data
-        self.price_queue = queue.Queue()
-        self.close_price_queue = queue.Queue()
+        self.price_queue = DataQueue(self.data_event)
 
         # Dict to map reqId w/ Symbols
         self.reqId_map = {}
 
         # Errors
-        self.data_errors_q = queue.Queue()
+        self.data_errors_q = DataQueue(self.data_event)
 
     ### Client Functions (with wrapper methods as nested functions) ###
+    # Each request has a *Future variant returning a concurrent.futures.Future,
+    # so many requests can be in flight at once and gathered together. The
+    # plain versions just wait on the future (or feed the App's data queues)
 
-    def getAccounts(self):
+    def getAccountsFuture(self):
 
         def managedAccounts(accountsList):
-            q.put(accountsList)
+            resolve(fut, accountsList)
 
-        q = queue.Queue()
+        fut = self.newFuture()
         self.wrap(managedAccounts)
+        self.pace()
         self.client.reqManagedAccts()
-        return q.get()
+        return fut
 
-    def getPositions(self, account):
+    def getAccounts(self):
+        return self.getAccountsFuture().result()
+
+    def getPositionsFuture(self, account):
 
         def positionMulti(reqId: int, account: str, modelCode: str,
                           contract: Contract, pos: float, avgCost: float):
             positions.append((contract, pos, avgCost))
 
         def positionMultiEnd(reqId: int):
-            q.put(None)
+            self.wrapper.unregister(reqId)
+            resolve(fut, self.getDFPositions(positions))
 
         positions = []
-        q = queue.Queue()
-        self.wrap(positionMulti)
-        self.wrap(positionMultiEnd)
-        self.client.reqPositionsMulti(self.getReqId(), account, "")
-        q.get()
-        return self.getDFPositions(positions)
+        fut = self.newFuture()
+        reqId = self.getReqId()
+        self.wrap(positionMulti, reqId)
+        self.wrap(positionMultiEnd, reqId)
+        self.wrap(self.failOnError(fut), reqId)
+        self.pace()
+        self.client.reqPositionsMulti(reqId, account, "")
+        return fut
 
-    def getOrders(self):
+    def getPositions(self, account):
+        return self.getPositionsFuture(account).result()
+
+    def getOrdersFuture(self):
+        '''
+        Open orders aren't tied to a reqId, so only one of these
+        should be in flight at a time
+        '''
 
         def openOrder(orderId, contract, order, orderState):
             orders.append((contract, order, orderState))
 
         def openOrderEnd():
-            q.put(None)
+            resolve(fut, self.getDFOrders(orders))
 
         orders = []
-        q = queue.Queue()
+        fut = self.newFuture()
         self.wrap(openOrder)
         self.wrap(openOrderEnd)
+        self.pace()
         self.client.reqOpenOrders()
-        q.get()
-        return self.getDFOrders(orders)
+        return fut
+
+    def getOrders(self):
+        return self.getOrdersFuture().result()
 
     def sellPosition(self, ticker, secType, orders, positions):
         pos = self.getPosDetails(ticker, secType, positions)
@@ -151,86 +403,174 @@ class App:
                 print('Placing SELL order for: ' + ticker)
                 self.place_order(contract, order)
 
-    def getHistoricalData(self, contract, duration):
+    def getHistoricalDataFuture(self, contract, duration):
         '''
         Requests historical daily prices
 
+        With a bar_cache, stored bars are reused and only the bars since the
+        last stored one are requested (nothing at all while the series is
+        fresh), then merged into the cache
+
           Input:
             duration: Duration string e.g. "1 Y", "6 M", "3 D", etc
+
+          Output:
+            Future of a dataframe with date, price (the close) and
+            open/high/low/close/volume columns
+        '''
+        cache = self.bar_cache
+        if cache is None:
+            return self.requestHistoricalDataFuture(contract, duration)
+
+        def merge(request):
+            if request.cancelled() or request.exception() is not None:
+                if not fut.done():
+                    fut.set_exception(request.exception() if not request.cancelled()
+                                      else RequestError(fut.reqId, -1, 'Cancelled'))
+                return
+            cache.put(contract, HIST_BAR_SIZE, HIST_WHAT_TO_SHOW, request.result(), covered_from)
+            resolve(fut, cache.get(contract, HIST_BAR_SIZE, HIST_WHAT_TO_SHOW, start))
+
+        fut = self.newFuture()
+        start = Cache.durationStart(duration)
+        series = cache.series(contract, HIST_BAR_SIZE, HIST_WHAT_TO_SHOW)
+        covered_from = None
+        gap = None
+        if series is not None and series.covered_from <= start:
+            if not cache.fresh(series):
+                gap = Cache.gapDuration(series.last_date)
+            else:
+                bars = cache.get(contract, HIST_BAR_SIZE, HIST_WHAT_TO_SHOW, start)
+                # No bars stored in the range counts as a miss
+                if len(bars):
+                    fut.reqId = self.getReqId()
+                    self.reqId_map[fut.reqId] = contract.symbol
+                    resolve(fut, bars)
+                    return fut
+        if gap is None:
+            # Nothing (or not far enough back) stored, get all of it
+            gap = duration
+            covered_from = start
+        request = self.requestHistoricalDataFuture(contract, gap)
+        fut.reqId = request.reqId
+        request.add_done_callback(merge)
+        return fut
+
+    def requestHistoricalDataFuture(self, contract, duration):
+        '''
+        getHistoricalDataFuture without the bar cache, always asks IB
         '''
         def historicalData(reqId: int, bar):
-            self.hist_data_dict_q[reqId].put(bar)
+            bars.append(bar)
 
         def historicalDataEnd(reqId: int, start: str, end: str):
-            dates = []
-            prices = []
-            while not self.hist_data_dict_q[reqId].empty():
-                bar = self.hist_data_dict_q[reqId].get()
-                dates.append(bar.date)
-                prices.append(bar.close)
-            data = {'date': dates, 'price': prices}
-            df = pandas.DataFrame(data=data)
-            self.hist_data_q.put((df, reqId))
-
-        self.wrap(historicalData)
-        self.wrap(historicalDataEnd)
+            self.wrapper.unregister(reqId)
+            resolve(fut, bars.frame())
+
+        bars = BarBuffer()
+        fut = self.newFuture()
         queryTime = datetime.datetime.today().strftime("%Y%m%d %H:%M:%S")
         reqId = self.getReqId()
-        self.client.reqHistoricalData(reqId, contract, queryTime,
-                                      duration, "1 day", "MIDPOINT", 1, 1, False, [])
+        fut.reqId = reqId
+        # Map the reqId before sending so we can't miss a fast answer
         self.reqId_map[reqId] = contract.symbol
-        self.hist_data_dict_q[reqId] = queue.Queue()
+        self.wrap(historicalData, reqId)
+        self.wrap(historicalDataEnd, reqId)
+        self.wrap(self.failOnError(fut), reqId)
+        self.pace('reqHistoricalData')
+        self.client.reqHistoricalData(reqId, contract, queryTime,
+                                      duration, HIST_BAR_SIZE, HIST_WHAT_TO_SHOW, 1, 1, False, [])
+        return fut
 
-    def getPrice(self, contract):
+    def getHistoricalData(self, contract, duration):
+        '''
+        Same as getHistoricalDataFuture but puts (df, reqId) on hist_data_q
+        '''
+        fut = self.getHistoricalDataFuture(contract, duration)
+        fut.add_done_callback(self.queueResult(self.hist_data_q))
+
+    def getPriceFuture(self, contract):
         '''
         Requests last trade price
+
+        With market_data set the price comes from its streaming
+        subscriptions, so contracts it already has are answered from memory
+
+          Output:
+            Future of the last price (delayed last for non-USD), or the
+            previous close if nothing traded. None if IB has neither
         '''
         def tickPrice(reqId, tickType, price: float,
                       attrib):
             if price == -1:
                 # print("No Price Data currently available")
                 pass
-            # Last price
-            elif tickType == 4:
-                self.price_queue.put((price, reqId))
-            # Previous Close Price
-            elif tickType == 9:
-                self.close_price_queue.put((price, reqId))
-            # Delayed Last Price
-            elif tickType == 68:
-                self.price_queue.put((price, reqId))
-            # Delayed Close Price
-            elif tickType == 75:
-                self.close_price_queue.put((price, reqId))
-
-        self.wrap(tickPrice)
+            # Last price or Delayed Last Price
+            elif tickType == 4 or tickType == 68:
+                self.wrapper.unregister(reqId)
+                resolve(fut, price)
+            # Previous Close Price or Delayed Close Price
+            elif tickType == 9 or tickType == 75:
+                close.append(price)
+
+        def tickSnapshotEnd(reqId):
+            # No trades today, lets use the last close price
+            self.wrapper.unregister(reqId)
+            resolve(fut, close[0] if close else None)
+
+        if self.market_data is not None:
+            return self.market_data.priceFuture(contract)
+
+        close = []
+        fut = self.newFuture()
         if contract.currency != 'USD':
+            self.pace()
             self.client.reqMarketDataType(3)
         reqId = self.getReqId()
-        self.client.reqMktData(reqId, contract, "", True, False, [])
+        fut.reqId = reqId
         self.reqId_map[reqId] = contract.symbol
+        self.wrap(tickPrice, reqId)
+        self.wrap(tickSnapshotEnd, reqId)
+        self.wrap(self.failOnError(fut), reqId)
+        self.pace('reqMktData')
+        self.client.reqMktData(reqId, contract, "", True, False, [])
         if contract.currency != 'USD':
             # Go back to live/frozen
+            self.pace()
             self.client.reqMarketDataType(2)
+        return fut
+
+    def getPrice(self, contract):
+        '''
+        Same as getPriceFuture but puts (price, reqId) on price_queue
+        '''
+        fut = self.getPriceFuture(contract)
+        fut.add_done_callback(self.queueResult(self.price_queue))
 
     def findContracts(self, sybmol):
+        self.pace()
         self.client.reqMatchingSymbols(self.getReqId(), sybmol)
 
     def place_order(self, contract, order):
+        self.pace()
         self.client.placeOrder(self.getReqId(), contract, order)
 
-    def getContractDetails(self, symbol, secType, currency=None, exchange=None):
+    def getContractDetailsFuture(self, symbol, secType, currency=None, exchange=None):
 
         def contractDetails(reqId: int, contractDetails):
             contract_details.append(contractDetails)
 
         def contractDetailsEnd(reqId: int):
-            q.put(None)
+            self.wrapper.unregister(reqId)
+            resolve(fut, contract_details)
 
         contract_details = []
-        q = queue.Queue()
-        self.wrap(contractDetails)
-        self.wrap(contractDetailsEnd)
+        fut = self.newFuture()
+        reqId = self.getReqId()
+        fut.reqId = reqId
+        self.wrap(contractDetails, reqId)
+        self.wrap(contractDetailsEnd, reqId)
+        self.wrap(self.failOnError(fut), reqId)
         contract = Contract()
         contract.symbol = symbol
         contract.secType = secType
@@ -238,11 +578,47 @@ class App:
             contract.currency = currency
         if exchange is not None:
             contract.exchange = exchange
-        self.client.reqContractDetails(self.getReqId(), contract)
-        q.get()
-        return contract_details
+        self.pace()
+        self.client.reqContractDetails(reqId, contract)
+        return fut
 
-    def getYield(self, contract, data_type=3):
+    def getContractDetails(self, symbol, secType, currency=None, exchange=None):
+        return self.getContractDetailsFuture(symbol, secType, currency, exchange).result()
+
+    def resolveContractFuture(self, symbol, secType, currency, exchange='SMART'):
+        '''
+        Looks up the contract IB has for a symbol and stores its conId and
+        primary exchange in contract_cache (if set) for createContract
+
+          Output:
+            Future of a Cache.ContractInfo, None if IB has no such contract
+        '''
+        def store(request):
+            if request.cancelled() or request.exception() is not None:
+                if not fut.done():
+                    fut.set_exception(request.exception() if not request.cancelled()
+                                      else RequestError(fut.reqId, -1, 'Cancelled'))
+                return
+            details = request.result()
+            if not details:
+                resolve(fut, None)
+                return
+            # Ambiguous symbols can come back with a listing per currency
+            matches = [d for d in details if d.contract.currency == currency] or details
+            contract = matches[0].contract
+            info = Cache.ContractInfo(contract.conId, contract.primaryExchange, time.time())
+            if self.contract_cache is not None:
+                self.contract_cache.put(symbol, secType, currency, info.conId, info.primaryExchange)
+            resolve(fut, info)
+
+        fut = self.newFuture()
+        request = self.getContractDetailsFuture(symbol, secType, currency, exchange)
+        fut.reqId = request.reqId
+        self.reqId_map[fut.reqId] = symbol
+        request.add_done_callback(store)
+        return fut
+
+    def getYieldFuture(self, contract, data_type=3):
 
         def tickString(reqId, tickType, value: str):
             for val in value.split(';'):
@@ -250,40 +626,89 @@ class App:
                     div.append(float(val.split('=')[1])/100)
             # If ';' in the response, then we know we got the data
             if ';' in value:
-                self.client.cancelMktData(reqId)
-                q.put(None)
+                self.wrapper.unregister(reqId)
+                self.defer(cancel)
+                resolve(fut, div[0] if div else 0)
+
+        def cancel():
+            self.pace()
+            self.client.cancelMktData(reqId)
 
         div = []
-        q = queue.Queue()
-        self.wrap(tickString)
+        fut = self.newFuture()
+        reqId = self.getReqId()
+        fut.reqId = reqId
+        self.wrap(tickString, reqId)
+        self.wrap(self.failOnError(fut), reqId)
         # Switch to live (1) frozen (2) delayed (3) delayed frozen (4).
         # MarketDataTypeEnum.DELAYED
         if contract.currency != 'USD':
+            self.pace()
             self.client.reqMarketDataType(data_type)
-        self.client.reqMktData(self.getReqId(), contract,
-                               "258", False, False, [])
+        self.pace('reqMktData')
+        self.client.reqMktData(reqId, contract, "258", False, False, [])
         if contract.currency != 'USD':
             # Go back to live/frozen
+            self.pace()
             self.client.reqMarketDataType(2)
-        q.get()
-        if div:
-            return div[0]
-        else:
-            return 0
+        return fut
 
-    def getFinStatements(self, contract, data_type):
+    def getYield(self, contract, data_type=3):
+        return self.getYieldFuture(contract, data_type).result()
+
+    def getFinStatementsFuture(self, contract, data_type):
 
         def fundamentalData(reqId, data: str):
-            self.fundamental_data_q.put((data, reqId))
-            self.client.cancelFundamentalData(reqId)
+            # The report is all there is, no cancel needed
+            self.wrapper.unregister(reqId)
+            resolve(fut, data)
 
-        self.wrap(fundamentalData)
+        fut = self.newFuture()
         reqId = self.getReqId()
-        self.client.reqFundamentalData(reqId, contract, data_type, [])
+        fut.reqId = reqId
         self.reqId_map[reqId] = contract.symbol
+        self.wrap(fundamentalData, reqId)
+        self.wrap(self.failOnError(fut), reqId)
+        self.pace('reqFundamentalData')
+        self.client.reqFundamentalData(reqId, contract, data_type, [])
+        return fut
+
+    def getFinStatements(self, contract, data_type):
+        '''
+        Same as getFinStatementsFuture but puts (data, reqId) on fundamental_data_q
+        '''
+        fut = self.getFinStatementsFuture(contract, data_type)
+        fut.add_done_callback(self.queueResult(self.fundamental_data_q))
 
     ### Client Functions End ###
 
+    def failOnError(self, fut):
+        '''
+        Returns an error handler for a request that fails its future.
+        The global error handler has already logged it and put it on
+        data_errors_q for processQueue
+        '''
+        def error(reqId, errorCode: int, errorString: str):
+            if isDataError(reqId, errorCode, errorString):
+                self.wrapper.unregister(reqId)
+                if not fut.done():
+                    fut.set_exception(RequestError(reqId, errorCode, errorString))
+        return error
+
+    def queueResult(self, q):
+        '''
+        Done callback putting a future's (result, reqId) on one of our data queues.
+        Failed requests are skipped since their error is already on data_errors_q
+        '''
+        def done(fut):
+            if fut.exception() is not None:
+                return
+            if fut.result() is None:
+                self.data_errors_q.put(('No data available', fut.reqId))
+            else:
+                q.put((fut.result(), fut.reqId))
+        return done
+
     ### HELPER FUNCTIONS ###
 
     def getDFPositions(self, positions):
@@ -341,6 +766,13 @@ class App:
             contract.strike = strike
         if expiry:
             contract.lastTradeDateOrContractMonth = expiry
+        if self.contract_cache is not None and not (right or strike or expiry):
+            # Send resolved symbols by conId so IB doesn't have to look them up again
+            info = self.contract_cache.get(contract.symbol, secType, contract.currency)
+            if info is not None:
+                contract.conId = info.conId
+                if info.primaryExchange:
+                    contract.primaryExchange = info.primaryExchange
         return contract
 
     def createOptionContract(self, symbol, currency, exchange):
@@ -399,78 +831,402 @@ class App:
             return False
 
     def parseFinancials(self, data, quarterly=False):
-        accepted_reports = ["10-K", "10-Q", "Interim Report", "ARS"]
-
-        fundamental_data = xmltodict.parse(data)
-        if fundamental_data['ReportFinancialStatements']['FinancialStatements'] is None:
-            print('No Fundamental Data')
-            if quarterly:
-                return None, None, None, None
-            return None, None
-        try:
-            coaMap = fundamental_data['ReportFinancialStatements']['FinancialStatements']['COAMap']
-            annuals = fundamental_data['ReportFinancialStatements']['FinancialStatements']['AnnualPeriods']['FiscalPeriod']
-            interims = fundamental_data['ReportFinancialStatements']['FinancialStatements']['InterimPeriods']['FiscalPeriod']
-        except:
-            print('ERROR with fundamental data')
-            print(fundamental_data)
-            return None, None, None, None
-
+        '''
+        Returns the latest 4 quarters (qtr1, qtr2, qtr3, qtr4) if quarterly,
+        otherwise the latest 2 annual reports (current_annual, prev_annual).
+        Use Financials.parse directly to get both from a single parse.
+        '''
+        report = Financials.parse(data)
         if quarterly:
-            qtr1 = None
-            qtr2 = None
-            qtr3 = None
-            qtr4 = None
-            for s in interims:  # loops through each quarterly report
-                parsed = {}
-                if type(s['Statement']) == list and s['Statement'][0]['FPHeader']['Source']['#text'] in accepted_reports:
-                    data = s['Statement']
-                    for item in data:  # loops through income statement, balance sheet, and income statement
-                        # print(item['@Type'])   ---- this is either INC, BAL, or CAS
-                        for i in item['lineItem']:
-                            try:
-                                parsed[coaCodes.coaCode_map[i['@coaCode']]] = float(
-                                    i['#text'])
-                            except KeyError:
-                                print('Could not find coaCode!!!')
-                                print(i['@coaCode'])
-                                print(coaMap)
-                    if qtr1 is None:
-                        qtr1 = parsed
-                    elif qtr2 is None:
-                        qtr2 = parsed
-                    elif qtr3 is None:
-                        qtr3 = parsed
-                    elif qtr4 is None:
-                        qtr4 = parsed
-            return qtr1, qtr2, qtr3, qtr4
-        else:
-            current_annual = None
-            prev_annual = None
-            # only one annual report
-            if type(annuals) != list:
-                if annuals['Statement'][0]['FPHeader']['Source']['#text'] in accepted_reports:
-                    # making it a list to work in the for loop below
-                    annuals = [annuals]
+            return report.quarters()
+        return report.years()
+
+
+# Bytes asked for per socket read
+RECV_SIZE = 1024*1024
+
+
+class Connection(connection.Connection):
+    '''
+    ibapi's Connection, but joining the reads of a recvMsg once instead of
+    concatenating bytes after every 4KB read
+    '''
+
+    def _recvAllMsg(self):
+        chunks = []
+        while self.isConnected():
+            try:
+                buf = self.socket.recv(RECV_SIZE)
+            except socket.timeout:
+                if chunks:
+                    break
+                raise
+            chunks.append(buf)
+            if len(buf) < RECV_SIZE:
+                break
+        return b''.join(chunks)
+
+
+class Reader(reader.EReader):
+    '''
+    EReader keeping the unread bytes in a bytearray with an offset.
+    ibapi's copies the rest of its buffer for every message it takes off,
+    which goes quadratic once IB answers faster than we read, e.g. hundreds
+    of ~70KB fundamental reports arriving together
+    '''
+
+    def run(self):
+        buf = bytearray()
+        pos = 0
+        try:
+            while self.conn.isConnected():
+                data = self.conn.recvMsg()
+                # Only a partial message is ever left over, so this is cheap
+                del buf[:pos]
+                pos = 0
+                buf += data
+                while len(buf) - pos >= 4:
+                    size = struct.unpack_from('!I', buf, pos)[0]
+                    if len(buf) - pos - 4 < size:
+                        break
+                    self.msg_queue.put(bytes(buf[pos + 4:pos + 4 + size]))
+                    pos += 4 + size
+        except Exception:
+            logger.exception('Reader thread stopped')
+
+
+class Client(EClient):
+    '''
+    EClient receiving through Connection and Reader above. connect() is
+    EClient.connect with those two swapped in
+    '''
+
+    def connect(self, host, port, clientId):
+        try:
+            self.host = host
+            self.port = port
+            self.clientId = clientId
+            self.conn = Connection(self.host, self.port)
+            self.conn.connect()
+            self.setConnState(EClient.CONNECTING)
+
+            version = "v%d..%d" % (MIN_CLIENT_VER, MAX_CLIENT_VER)
+            if self.connectionOptions:
+                version = version + " " + self.connectionOptions
+            self.conn.sendMsg(str.encode("API\0", 'ascii') + comm.make_msg(version))
+            self.decoder = decoder.Decoder(self.wrapper, self.serverVersion())
+
+            # sometimes we get news before the server version
+            fields = []
+            while len(fields) != 2:
+                self.decoder.interpret(fields)
+                buf = self.conn.recvMsg()
+                if not self.conn.isConnected():
+                    self.reset()
+                    return
+                fields = comm.read_fields(comm.read_msg(buf)[1]) if buf else []
+
+            server_version, conn_time = fields
+            self.connTime = conn_time
+            self.serverVersion_ = int(server_version)
+            self.decoder.serverVersion = self.serverVersion()
+            self.setConnState(EClient.CONNECTED)
+
+            self.reader = Reader(self.conn, self.msg_queue)
+            self.reader.start()
+            self.startApi()
+            self.wrapper.connectAck()
+        except socket.error:
+            if self.wrapper:
+                self.wrapper.error(NO_VALID_ID, CONNECT_FAIL.code(), CONNECT_FAIL.msg())
+            self.disconnect()
+
+
+class PoolClient:
+    '''
+    Stands in for the EClient of an AppPool. Requests named in ROUTED go
+    out on whichever connection app.scheduler (a Pacing.SchedulerPool)
+    picks for their endpoint. The ones left open until cancelled (streaming
+    market data, keepUpToDate historical data) remember their connection
+    so the cancel follows them, the rest finish on their own and aren't
+    tracked. BROADCAST requests go to every connection and anything else
+    is paced and sent on the first connection, which also answers
+    serverVersion(), isConnected() and the like.
+
+    Streaming (non snapshot) reqMktData also stay on the first connection.
+    Market data lines are per account, so spreading them gains nothing, and
+    a subscription made on one connection right after a cancel on another
+    could reach IB first and be refused for lack of a line
+    '''
+    # Request method -> pacing endpoint
+    ROUTED = {'reqMktData': 'reqMktData',
+              'reqHistoricalData': 'reqHistoricalData',
+              'reqFundamentalData': 'reqFundamentalData',
+              'reqContractDetails': None}
+    CANCELS = {'cancelMktData', 'cancelHistoricalData', 'cancelFundamentalData'}
+    BROADCAST = {'reqMarketDataType', 'disconnect'}
+
+    def __init__(self, app, clients):
+        self.app = app
+        self.clients = clients
+        self.lock = threading.Lock()
+        # reqId -> index of the connection it was sent on, for open requests
+        self.owners = {}
+
+    def isOpen(self, name, args):
+        '''
+        True for requests that stay open until cancelled. args are the
+        request's arguments after the reqId
+        '''
+        if name == 'reqMktData':
+            return not args[2]
+        if name == 'reqHistoricalData':
+            return bool(args[7])
+        return False
+
+    def __getattr__(self, name):
+        clients = self.clients
+        if name in self.ROUTED:
+            def send(reqId, *args):
+                if name == 'reqMktData' and not args[2]:
+                    index = 0
+                    self.app.scheduler.schedulers[0].wait('reqMktData')
                 else:
-                    # No annual reports that are of accepted type
-                    return current_annual, prev_annual
-            for s in annuals:  # loops through each annual report
-                parsed = {}
-                if type(s['Statement']) == list and s['Statement'][0]['FPHeader']['Source']['#text'] in accepted_reports:
-                    data = s['Statement']
-                    for item in data:  # loops through income statement, balance sheet, and income statement
-                        # print(item['@Type'])   ---- this is either INC, BAL, or CAS
-                        for i in item['lineItem']:
-                            try:
-                                parsed[coaCodes.coaCode_map[i['@coaCode']]] = float(
-                                    i['#text'])
-                            except KeyError:
-                                print('Could not find coaCode!!!')
-                                print(i['@coaCode'])
-                                print(coaMap)
-                    if current_annual is None:
-                        current_annual = parsed
-                    elif prev_annual is None:
-                        prev_annual = parsed
-            return current_annual, prev_annual
+                    index = self.app.scheduler.acquire(self.ROUTED[name])
+                if self.isOpen(name, args):
+                    with self.lock:
+                        self.owners[reqId] = index
+                return getattr(clients[index], name)(reqId, *args)
+        elif name in self.CANCELS:
+            def send(reqId, *args):
+                with self.lock:
+                    index = self.owners.pop(reqId, 0)
+                self.app.scheduler.schedulers[index].wait()
+                return getattr(clients[index], name)(reqId, *args)
+        elif name in self.BROADCAST:
+            def send(*args):
+                for scheduler, client in zip(self.app.scheduler.schedulers, clients):
+                    if name != 'disconnect':
+                        scheduler.wait()
+                    getattr(client, name)(*args)
+        elif name.startswith(('req', 'cancel', 'place')):
+            def send(*args):
+                self.app.scheduler.schedulers[0].wait()
+                return getattr(clients[0], name)(*args)
+        else:
+            return getattr(clients[0], name)
+        return send
+
+
+class AppPool(App):
+    '''
+    App spreading its requests over several connections to TWS / IB
+    Gateway, each with its own clientId and reader/decoder thread.
+
+    The connections share one reqId counter and one Router, so every
+    request method and future works as on App. Market data, historical,
+    fundamental and contract details requests go out on the connection
+    with pacing budget left (see PoolClient and Pacing.SchedulerPool), and
+    everything else (accounts, positions, orders) on the first one, since
+    orders belong to the clientId that placed them.
+
+    Arguments:
+        size {int} -- number of connections
+        clientId {int} -- clientId of the first connection, the rest count up from it
+    '''
+
+    def __init__(self, ip_addr='127.0.0.1', port=7497, clientId=1, size=2):
+
+        # Wrapper Methods
+        def nextValidId(reqId):
+            q.put(reqId)
+        # Wrapper Methods End
+
+        self.setupWrapper(ip_addr, port, clientId)
+        q = queue.Queue()
+        self.wrap(nextValidId)
+
+        clients = []
+        self._threads = []
+        for i in range(size):
+            client = Client(self.wrapper)
+            client.connect(ip_addr, port, clientId + i)
+            thread = Thread(target=client.run)
+            thread.start()
+            clients.append(client)
+            self._threads.append(thread)
+        self.scheduler = Pacing.SchedulerPool(size)
+        self.client = PoolClient(self, clients)
+        # Once every connection has sent a reqID, we know we can start
+        self._reqId = max(q.get() for _ in clients)
+
+    def pace(self, endpoint=None):
+        # PoolClient paces each request once it knows which connection sends it
+        pass
+
+
+class StreamConnection:
+    '''
+    Stands in for ibapi's Connection so EClient's request methods write
+    straight to an asyncio stream instead of a blocking socket
+    '''
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def isConnected(self):
+        return not self.writer.is_closing()
+
+    def sendMsg(self, msg):
+        self.writer.write(msg)
+
+    def disconnect(self):
+        self.writer.close()
+
+
+class AsyncFuture(asyncio.Future):
+    # Subclass so the request methods can tag futures with their reqId
+    pass
+
+
+class AsyncApp(App):
+    '''
+    asyncio version of App. The socket is read on the event loop and each
+    message is decoded right there, so wrapper callbacks resolve asyncio
+    futures directly with no reader/decoder threads or queue hand-offs.
+
+    Create with:
+        app = await AsyncApp.create(ip_addr, port, clientId)
+
+    getPrice, getHistoricalData, getFinStatements, getContractDetails,
+    getYield, getAccounts, getPositions and getOrders are coroutines here,
+    so thousands of requests can be gathered with asyncio.gather and the
+    scheduler paces them without blocking the loop.
+    '''
+
+    def __init__(self, ip_addr='127.0.0.1', port=7497, clientId=1):
+        self.setup(ip_addr, port, clientId)
+        self.loop = None
+        self._reader_task = None
+
+    @classmethod
+    async def create(cls, ip_addr='127.0.0.1', port=7497, clientId=1):
+        app = cls(ip_addr, port, clientId)
+        await app.connect()
+        return app
+
+    async def connect(self):
+
+        # Wrapper Methods
+        def nextValidId(reqId):
+            resolve(ready, reqId)
+        # Wrapper Methods End
+
+        self.loop = asyncio.get_running_loop()
+        ready = self.newFuture()
+        self.wrap(nextValidId)
+
+        reader, writer = await asyncio.open_connection(self.ip_addr, self.my_port)
+        self.client.host = self.ip_addr
+        self.client.port = self.my_port
+        self.client.clientId = self.my_clientId
+        self.client.conn = StreamConnection(writer)
+        self.client.setConnState(EClient.CONNECTING)
+        version = "v%d..%d" % (MIN_CLIENT_VER, MAX_CLIENT_VER)
+        writer.write(str.encode("API\0", 'ascii') + comm.make_msg(version))
+
+        # sometimes we get news before the server version
+        fields = []
+        while len(fields) != 2:
+            fields = await self.readFields(reader)
+        server_version, conn_time = fields
+        self.client.serverVersion_ = int(server_version)
+        self.client.connTime = conn_time
+        self.client.decoder = decoder.Decoder(self.wrapper, self.client.serverVersion())
+        self.client.setConnState(EClient.CONNECTED)
+        self.client.startApi()
+
+        self._reader_task = self.loop.create_task(self.readLoop(reader))
+        # Once we get a reqID, we know we can start
+        self._reqId = await ready
+
+    async def readFields(self, reader):
+        size = struct.unpack("!I", await reader.readexactly(4))[0]
+        return comm.read_fields(await reader.readexactly(size))
+
+    async def readLoop(self, reader):
+        try:
+            while True:
+                fields = await self.readFields(reader)
+                self.client.decoder.interpret(fields)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if self.client.isConnected():
+                self.client.disconnect()
+
+    def disconnect(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self.client.disconnect()
+
+    def newFuture(self):
+        return AsyncFuture(loop=self.loop)
+
+    def pace(self, endpoint=None):
+        # Coroutines wait in ready() before building a request, so only
+        # take the token here, blocking would stall the event loop. Extra
+        # messages (the reqMarketDataType pair around delayed data) may
+        # leave the global bucket in debt, later requests wait that out
+        self.scheduler.take(endpoint)
+
+    def defer(self, method, *args):
+        # pace() doesn't block here, so just run it on the loop
+        self.loop.call_soon_threadsafe(method, *args)
+
+    async def ready(self, endpoint=None):
+        '''
+        Waits (without blocking the loop) until the scheduler would let us
+        send a request to the endpoint. The token is taken by pace() as
+        the message goes out, so requests served from a cache don't use one
+        '''
+        delay = self.scheduler.delay(endpoint)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.scheduler.delay(endpoint)
+
+    ### Async Client Functions ###
+
+    async def getAccounts(self):
+        await self.ready()
+        return await self.getAccountsFuture()
+
+    async def getPositions(self, account):
+        await self.ready()
+        return await self.getPositionsFuture(account)
+
+    async def getOrders(self):
+        await self.ready()
+        return await self.getOrdersFuture()
+
+    async def getHistoricalData(self, contract, duration):
+        await self.ready('reqHistoricalData')
+        return await self.getHistoricalDataFuture(contract, duration)
+
+    async def getPrice(self, contract):
+        await self.ready('reqMktData')
+        return await self.getPriceFuture(contract)
+
+    async def getContractDetails(self, symbol, secType, currency=None, exchange=None):
+        await self.ready()
+        return await self.getContractDetailsFuture(symbol, secType, currency, exchange)
+
+    async def getYield(self, contract, data_type=3):
+        await self.ready('reqMktData')
+        return await self.getYieldFuture(contract, data_type)
+
+    async def getFinStatements(self, contract, data_type):
+        await self.ready('reqFundamentalData')
+        return await self.getFinStatementsFuture(contract, data_type)
+
+    ### Async Client Functions End ###
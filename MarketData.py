@@ -0,0 +1,294 @@
+'''
+Streaming market data for a watchlist
+
+App.getPriceFuture normally asks IB for a snapshot, so every lookup is a new
+reqMktData round trip. MarketDataManager instead keeps streaming
+subscriptions open and remembers the latest tick of each kind (last, close,
+bid, ask and their delayed versions) as tickPrice callbacks come in, so
+price lookups for subscribed contracts are answered from memory.
+
+IB only allows so many streaming subscriptions at once (market data lines,
+100 by default). Subscriptions are kept in least recently used order and
+once every line is taken the least recently used one that already has a
+price is cancelled to make room. Contracts that can't get a line yet (every
+line is still waiting on its first tick) wait in a backlog and are
+subscribed as lines free up.
+
+Use it through an App:
+    app.market_data = MarketDataManager(app)
+    app.getPriceFuture(contract)  # now served by the manager
+'''
+import collections
+import threading
+import time
+
+import InteractiveBrokers as ib
+
+
+# Market data lines of a default IB account
+MAX_LINES = 100
+
+# tickPrice tick types we keep, by name
+TICK_FIELDS = {1: 'bid',
+               2: 'ask',
+               4: 'last',
+               9: 'close',
+               66: 'delayed_bid',
+               67: 'delayed_ask',
+               68: 'delayed_last',
+               75: 'delayed_close'}
+LAST_FIELDS = ('last', 'delayed_last')
+CLOSE_FIELDS = ('close', 'delayed_close')
+
+
+class Subscription:
+    '''
+    One streaming reqMktData request and the latest value of each tick field
+    '''
+
+    def __init__(self, reqId, contract):
+        self.reqId = reqId
+        self.contract = contract
+        self.values = {}
+        self.updated = None
+        # Futures waiting on the first price
+        self.waiters = []
+
+    def price(self):
+        '''
+        Last (or delayed last) price, or the previous close if nothing has
+        traded. None until one of them has arrived
+        '''
+        for field in LAST_FIELDS + CLOSE_FIELDS:
+            if field in self.values:
+                return self.values[field]
+        return None
+
+
+class MarketDataManager:
+    '''
+    Streaming subscriptions plus a thread safe last value cache
+
+    Ticks arrive on the App's decoder thread while lookups come from any
+    thread, everything shared goes through one lock which is never held
+    while talking to IB or resolving futures. Requests go out through
+    app.defer so the decoder never waits on pacing.
+
+    Arguments:
+        app {ib.App} -- connected App (or AsyncApp) sending the requests
+        max_lines {int} -- streaming subscriptions kept open at once
+        clock {function} -- time source for Subscription.updated
+    '''
+
+    def __init__(self, app, max_lines=MAX_LINES, clock=time.time):
+        self.app = app
+        self.max_lines = max_lines
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Subscribed, least recently used first
+        self.live = collections.OrderedDict()
+        # Waiting for a line, oldest first
+        self.backlog = collections.OrderedDict()
+
+    def key(self, contract):
+        return (contract.symbol, contract.secType, contract.currency)
+
+    ### Lookups ###
+
+    def lookup(self, key):
+        # Caller holds the lock. Counts as a use for the LRU order
+        sub = self.live.get(key)
+        if sub is not None:
+            self.live.move_to_end(key)
+            return sub
+        return self.backlog.get(key)
+
+    def quote(self, contract):
+        '''
+        Latest value of each tick field (a dict, e.g. {'last': 10.5, 'close': 10.2}),
+        or None if the contract isn't subscribed
+        '''
+        with self.lock:
+            sub = self.live.get(self.key(contract))
+            if sub is None:
+                return None
+            self.live.move_to_end(self.key(contract))
+            return dict(sub.values)
+
+    def price(self, contract):
+        '''
+        Latest price as getPriceFuture would give it, or None if the
+        contract isn't subscribed or has no price yet. Never blocks on IB
+        '''
+        with self.lock:
+            sub = self.live.get(self.key(contract))
+            if sub is None:
+                return None
+            self.live.move_to_end(self.key(contract))
+            return sub.price()
+
+    def priceFuture(self, contract):
+        '''
+        Future of the latest price of the contract, subscribing it first if
+        needed. Resolves right away for contracts that already have a price,
+        otherwise with the first last (or close if nothing traded) tick.
+        Fails with ib.RequestError if IB rejects the subscription
+        '''
+        fut = self.app.newFuture()
+        with self.lock:
+            sub = self.add(contract)
+            fut.reqId = sub.reqId
+            price = sub.price()
+            if price is None:
+                sub.waiters.append(fut)
+            sends, cancels = self.rotate()
+        if price is not None:
+            ib.resolve(fut, price)
+        self.send(sends, cancels)
+        return fut
+
+    ### Subscriptions ###
+
+    def subscribe(self, contract):
+        '''
+        Starts streaming a contract (or queues it until a line is free)
+
+          Output:
+            reqId of the subscription
+        '''
+        with self.lock:
+            sub = self.add(contract)
+            sends, cancels = self.rotate()
+        self.send(sends, cancels)
+        return sub.reqId
+
+    def watch(self, contracts):
+        '''
+        Subscribes a whole watchlist, returns the reqIds
+        '''
+        return [self.subscribe(contract) for contract in contracts]
+
+    def unsubscribe(self, contract):
+        with self.lock:
+            key = self.key(contract)
+            cancels = []
+            if key in self.live:
+                cancels.append(self.live.pop(key))
+            self.backlog.pop(key, None)
+            sends, freed = self.rotate()
+        self.send(sends, cancels + freed)
+
+    def close(self):
+        '''
+        Cancels every subscription
+        '''
+        with self.lock:
+            cancels = list(self.live.values())
+            self.live.clear()
+            self.backlog.clear()
+        self.send([], cancels)
+
+    def add(self, contract):
+        # Caller holds the lock
+        key = self.key(contract)
+        sub = self.lookup(key)
+        if sub is None:
+            sub = Subscription(self.app.getReqId(), contract)
+            self.app.reqId_map[sub.reqId] = contract.symbol
+            self.backlog[key] = sub
+        return sub
+
+    def rotate(self):
+        '''
+        Moves backlogged contracts onto free lines, cancelling the least
+        recently used subscriptions that already have a price to make room.
+        Caller holds the lock
+
+          Output:
+            subscriptions to send and subscriptions to cancel
+        '''
+        sends = []
+        cancels = []
+        while self.backlog:
+            if len(self.live) >= self.max_lines:
+                victim = next((k for k, s in self.live.items() if s.price() is not None), None)
+                if victim is None:
+                    # Every line is still waiting on its first tick
+                    break
+                cancels.append(self.live.pop(victim))
+            key, sub = self.backlog.popitem(last=False)
+            self.live[key] = sub
+            sends.append(sub)
+        return sends, cancels
+
+    def send(self, sends, cancels):
+        '''
+        Hands the requests rotate decided on to the App's sender thread, so
+        ticks never wait on pacing and requests go out in the order decided
+        '''
+        if sends or cancels:
+            self.app.defer(self.transmit, sends, cancels)
+
+    def transmit(self, sends, cancels):
+        for sub in cancels:
+            self.app.wrapper.unregister(sub.reqId)
+            self.app.pace()
+            self.app.client.cancelMktData(sub.reqId)
+        for sub in sends:
+            self.request(sub)
+
+    def request(self, sub):
+        # Wrapper Methods
+        def tickPrice(reqId, tickType, price: float, attrib):
+            field = TICK_FIELDS.get(tickType)
+            if field is None or price == -1:
+                return
+            waiters = []
+            sends = cancels = []
+            with self.lock:
+                sub.values[field] = price
+                sub.updated = self.clock()
+                # TWS sends bid/ask, then last, then close, so a close without
+                # a last means nothing has traded today. Bid and ask alone
+                # don't give a price
+                if sub.waiters and (field in LAST_FIELDS or
+                                    (field in CLOSE_FIELDS and
+                                     not any(f in sub.values for f in LAST_FIELDS))):
+                    waiters, sub.waiters = sub.waiters, []
+                    value = sub.price()
+                if waiters or self.backlog:
+                    # The subscription can now make room for the backlog
+                    sends, cancels = self.rotate()
+            for fut in waiters:
+                ib.resolve(fut, value)
+            self.send(sends, cancels)
+
+        def error(reqId, errorCode: int, errorString: str):
+            if not ib.isDataError(reqId, errorCode, errorString):
+                return
+            self.app.wrapper.unregister(reqId)
+            with self.lock:
+                key = self.key(sub.contract)
+                if self.live.get(key) is sub:
+                    del self.live[key]
+                waiters, sub.waiters = sub.waiters, []
+                sends, cancels = self.rotate()
+            for fut in waiters:
+                if not fut.done():
+                    fut.set_exception(ib.RequestError(reqId, errorCode, errorString))
+            self.send(sends, cancels)
+        # Wrapper Methods End
+
+        app = self.app
+        contract = sub.contract
+        app.wrap(tickPrice, sub.reqId)
+        app.wrap(error, sub.reqId)
+        if contract.currency != 'USD':
+            app.pace()
+            app.client.reqMarketDataType(3)
+        app.pace('reqMktData')
+        app.client.reqMktData(sub.reqId, contract, "", False, False, [])
+        if contract.currency != 'USD':
+            # Go back to live/frozen
+            app.pace()
+            app.client.reqMarketDataType(2)
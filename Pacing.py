@@ -0,0 +1,237 @@
+'''
+Request pacing for the IB API
+
+IB limits how fast each kind of request can be made (reqMktData ~100/s,
+reqHistoricalData ~50/s, reqFundamentalData only ~2/s before pacing
+violations start) on top of a cap on the total number of messages per
+second. Scheduler keeps a token bucket per endpoint plus one global bucket,
+so a request goes out as soon as both buckets allow it instead of waiting
+for the next 1 second chunk.
+
+SchedulerPool does the same for several connections at once, each with
+its own buckets, for ib.AppPool.
+'''
+import threading
+import time
+
+
+# Requests per second for each rate limited endpoint
+DEFAULT_RATES = {'reqMktData': 100,
+                 'reqHistoricalData': 50,
+                 'reqFundamentalData': 2}
+# Max messages per second across every endpoint
+DEFAULT_GLOBAL_RATE = 100
+
+
+class TokenBucket:
+    '''
+    Token bucket allowing `rate` requests per second with bursts of up to
+    `capacity` requests. Not thread safe by itself, Scheduler does the locking.
+    '''
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.last = clock()
+        self.paused_until = 0.0
+
+    def refill(self):
+        now = self.clock()
+        if now > self.last:
+            # Nothing accrues while paused since last is pushed into the future
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+        return now
+
+    def delay(self):
+        '''
+        Seconds until a token is available (0 if one is available now)
+        '''
+        now = self.refill()
+        wait = max(0.0, self.paused_until - now)
+        # Small tolerance so float rounding can't leave us sleeping forever
+        if self.tokens < 1 - 1e-9:
+            start = max(now, self.last)
+            wait = max(wait, start - now + (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        '''
+        Stops handing out tokens for the given number of seconds and
+        empties the bucket so we don't burst right after the pause
+        '''
+        now = self.refill()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = min(self.tokens, 0.0)
+        self.last = self.paused_until
+
+
+class Scheduler:
+    '''
+    Shared rate limiter for every request made through an App
+
+    Arguments:
+        rates {dict} -- requests per second for each endpoint name.
+                        Endpoints not listed are only limited by the global rate
+        global_rate {float} -- max messages per second for all endpoints combined
+    '''
+
+    def __init__(self, rates=None, global_rate=DEFAULT_GLOBAL_RATE,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(global_rate, clock=clock)
+        self.buckets = {}
+        rates = DEFAULT_RATES if rates is None else rates
+        for endpoint, rate in rates.items():
+            self.buckets[endpoint] = TokenBucket(rate, clock=clock)
+
+    def setRate(self, endpoint, rate):
+        with self.lock:
+            self.buckets[endpoint] = TokenBucket(rate, clock=self.clock)
+
+    def _buckets(self, endpoint):
+        buckets = [self.global_bucket]
+        if endpoint in self.buckets:
+            buckets.append(self.buckets[endpoint])
+        return buckets
+
+    def delay(self, endpoint=None):
+        '''
+        Seconds until a request to the endpoint could be sent (0 if it can
+        be sent now), without taking a token
+        '''
+        with self.lock:
+            return max(b.delay() for b in self._buckets(endpoint))
+
+    def take(self, endpoint=None):
+        '''
+        Takes a token for the endpoint (and the global bucket) whether or
+        not one is available. Buckets left in debt make later requests wait
+        it out, so the message still counts against the rates
+        '''
+        with self.lock:
+            for b in self._buckets(endpoint):
+                b.refill()
+                b.take()
+
+    def tryAcquire(self, endpoint=None):
+        '''
+        Takes a token for the endpoint (and the global bucket) if both have
+        one available
+
+        Returns:
+            float -- 0 if the request can be sent now, otherwise how many
+                     seconds to wait before trying again
+        '''
+        with self.lock:
+            buckets = self._buckets(endpoint)
+            delay = max(b.delay() for b in buckets)
+            if delay > 0:
+                return delay
+            for b in buckets:
+                b.take()
+            return 0.0
+
+    def wait(self, endpoint=None):
+        '''
+        Blocks until a request to the endpoint is allowed to be sent
+        '''
+        delay = self.tryAcquire(endpoint)
+        while delay > 0:
+            self.sleep(delay)
+            delay = self.tryAcquire(endpoint)
+
+    def pause(self, endpoint, seconds):
+        '''
+        Backs off an endpoint, e.g. after IB reports a pacing violation
+        '''
+        with self.lock:
+            if endpoint in self.buckets:
+                self.buckets[endpoint].pause(seconds)
+            else:
+                self.global_bucket.pause(seconds)
+
+
+class SchedulerPool:
+    '''
+    One Scheduler per connection of an ib.AppPool, since IB paces each
+    connection (clientId) on its own. acquire() hands out whichever
+    connection can send to the endpoint first, trying them round robin so
+    requests spread over the connections even when all have budget left.
+
+    Has the Scheduler interface too (wait, tryAcquire, pause, setRate),
+    so code written against a single Scheduler keeps working
+
+    Arguments:
+        size {int} -- number of connections
+        rates, global_rate -- per connection limits, as for Scheduler
+    '''
+
+    def __init__(self, size, rates=None, global_rate=DEFAULT_GLOBAL_RATE,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.schedulers = [Scheduler(rates, global_rate, clock, sleep) for _ in range(size)]
+        self.next = 0
+
+    def __len__(self):
+        return len(self.schedulers)
+
+    def tryAcquireAny(self, endpoint=None):
+        '''
+        Takes a token from the first connection (round robin) that has one
+
+        Returns:
+            int -- index of the connection, None if none can send now
+            float -- 0 if one can send now, otherwise seconds until one can
+        '''
+        with self.lock:
+            start = self.next
+            self.next = (self.next + 1) % len(self.schedulers)
+        delays = []
+        for i in range(len(self.schedulers)):
+            index = (start + i) % len(self.schedulers)
+            delay = self.schedulers[index].tryAcquire(endpoint)
+            if delay == 0:
+                return index, 0.0
+            delays.append(delay)
+        return None, min(delays)
+
+    def acquire(self, endpoint=None):
+        '''
+        Blocks until some connection may send to the endpoint
+
+        Returns:
+            int -- index of that connection
+        '''
+        index, delay = self.tryAcquireAny(endpoint)
+        while index is None:
+            self.sleep(delay)
+            index, delay = self.tryAcquireAny(endpoint)
+        return index
+
+    def tryAcquire(self, endpoint=None):
+        return self.tryAcquireAny(endpoint)[1]
+
+    def wait(self, endpoint=None):
+        self.acquire(endpoint)
+
+    def pause(self, endpoint, seconds):
+        '''
+        Backs off the endpoint on every connection, IB's pacing errors
+        don't say which limit was hit
+        '''
+        for scheduler in self.schedulers:
+            scheduler.pause(endpoint, seconds)
+
+    def setRate(self, endpoint, rate):
+        for scheduler in self.schedulers:
+            scheduler.setRate(endpoint, rate)
@@ -3,7 +3,13 @@ Functions for calculating various ratios
 
 Many of the functions take dictionaries as input, which can easily be
 retrieved from TestApp.parseFinancials()
+
+The batch* functions at the bottom compute the same ratios for a whole
+universe at once from a Financials.FundamentalsMatrix, returning NaN
+wherever the scalar function returns None
 '''
+import numpy
+import pandas
 
 
 def getCompanyValues(price, data):
@@ -443,3 +449,214 @@ def calcROIC(qtr1, qtr2, qtr3, qtr4):
         if (ic < 0 and nopat >= 0) or ic > 0:
             return nopat/ic
     return None
+
+
+# Batch versions
+#
+# Each takes a Financials.FundamentalsMatrix (fm) and returns float arrays
+# with one value per ticker (fm.symbols order), NaN where the scalar version
+# returns None. Missing quarters and line items are NaN in the matrix, which
+# plays the role of a missing dict or key. Where the scalar version would
+# raise (KeyError on a missing line item in calcDebtChange/calcROIC, or a
+# division by zero) the batch version treats the value as missing.
+
+def present(x):
+    return ~numpy.isnan(x)
+
+
+def orZero(x):
+    return numpy.where(numpy.isnan(x), 0.0, x)
+
+
+def truthy(x):
+    '''
+    Where a value would pass `if value:`, i.e. present and not 0
+    '''
+    return present(x) & (x != 0)
+
+
+def periodPresent(fm, period):
+    '''
+    Where a ticker has any line item in a period, i.e. its dict would be truthy
+    '''
+    return present(fm.values[:, period]).any(axis=1)
+
+
+def firstPresent(*values):
+    '''
+    Elementwise first non-NaN value, like an if/elif chain of `in` checks
+    '''
+    result = values[-1]
+    for value in reversed(values[:-1]):
+        result = numpy.where(present(value), value, result)
+    return result
+
+
+def safeDivide(a, b):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(b != 0, a / numpy.where(b != 0, b, 1.0), numpy.nan)
+
+
+def batchCompanyValues(prices, fm):
+    '''
+    Batch getCompanyValues from each ticker's latest quarter
+
+    Output:
+        (market caps, firm values, enterprise values) as arrays
+    '''
+    prices = numpy.asarray(prices, dtype=float)
+    mkt_cap = prices * fm.quarter('total_common_shares_outstanding')
+    firm_val = mkt_cap + orZero(fm.quarter('total_debt'))
+    firm_val = firm_val + orZero(fm.quarter('minority_interest'))
+    ev = firm_val - orZero(firstPresent(fm.quarter('cash&equivalents'), fm.quarter('cash')))
+    return mkt_cap, firm_val, ev
+
+
+def batchP_E(prices, fm):
+    prices = numpy.asarray(prices, dtype=float)
+    ttm_eps = 0.0
+    for n in range(1, 5):
+        ttm_eps = ttm_eps + orZero(fm.quarter('diluted_eps_excluding_extraord_items', n))
+    return numpy.where(ttm_eps > 0, prices / numpy.where(ttm_eps > 0, ttm_eps, 1.0), numpy.nan)
+
+
+def batchEV_EBITDA(ev, fm):
+    ev = numpy.asarray(ev, dtype=float)
+    ebitda = 0.0
+    for n in range(1, 5):
+        oi = fm.quarter('operating_income', n)
+        da = firstPresent(fm.quarter('depreciation/amortization', n),
+                          fm.quarter('depreciation/depletion', n),
+                          fm.quarter('amortization', n))
+        ebitda = ebitda + orZero(oi)
+        ebitda = ebitda + numpy.where(present(oi), orZero(da), 0.0)
+    valid = truthy(ev) & (ebitda > 0)
+    return numpy.where(valid, ev / numpy.where(valid, ebitda, 1.0), numpy.nan)
+
+
+def batchP_B(prices, fm):
+    prices = numpy.asarray(prices, dtype=float)
+    bv = (fm.quarter('total_equity') - orZero(fm.quarter('redeemable_preferred_stock'))
+          - orZero(fm.quarter('preferred_stock_non_redeemable')))
+    bv_per_share = orZero(safeDivide(bv, fm.quarter('total_common_shares_outstanding')))
+    valid = bv_per_share > 0
+    return numpy.where(valid, prices / numpy.where(valid, bv_per_share, 1.0), numpy.nan)
+
+
+def batchEV_S(ev, fm):
+    ev = numpy.asarray(ev, dtype=float)
+    ttm_rev = 0.0
+    for n in range(1, 5):
+        ttm_rev = ttm_rev + orZero(fm.quarter('total_revenue', n))
+    valid = truthy(ev) & (ttm_rev > 0)
+    return numpy.where(valid, ev / numpy.where(valid, ttm_rev, 1.0), numpy.nan)
+
+
+def batchEV_FCF(ev, fm):
+    ev = numpy.asarray(ev, dtype=float)
+    ttm_fcf = 0.0
+    for n in range(1, 5):
+        cfo = fm.quarter('cash_from_operating_activities', n)
+        ttm_fcf = ttm_fcf + orZero(cfo)
+        ttm_fcf = ttm_fcf + numpy.where(present(cfo), orZero(fm.quarter('capital_expenditures', n)), 0.0)
+    valid = truthy(ev) & (ttm_fcf > 0)
+    return numpy.where(valid, ev / numpy.where(valid, ttm_fcf, 1.0), numpy.nan)
+
+
+def batchDivPayout(fm, quarters=2):
+    '''
+    Batch getDivPayout over the latest `quarters` quarters (never NaN)
+    '''
+    div = numpy.zeros(len(fm.symbols))
+    for n in range(1, quarters + 1):
+        div = div + orZero(fm.quarter('dps_common_stock_primary_issue', n))
+    return div
+
+
+def batchNOA(fm, n):
+    oa = (fm.year('total_assets', n) - orZero(fm.year('short_term_investments', n))
+          - orZero(fm.year('long_term_investments', n)))
+    ol = (fm.year('total_liabilities', n) - orZero(fm.year('notes_payable/short_term_debt', n))
+          - orZero(fm.year('current_port_of_lt_debt/capital_leases', n))
+          - orZero(fm.year('total_long_term_debt', n)))
+    return numpy.where(truthy(oa) & truthy(ol), oa - ol, numpy.nan)
+
+
+def batchChangeInNOA(fm):
+    noa = batchNOA(fm, 1)
+    noa_prev = batchNOA(fm, 2)
+    valid = truthy(noa) & truthy(noa_prev)
+    return numpy.where(valid, (noa - noa_prev) / numpy.where(valid, noa_prev, 1.0), numpy.nan)
+
+
+def batchOneYearGrowth(fm):
+    eps = fm.year('diluted_eps_excluding_extraord_items', 1)
+    prev_eps = fm.year('diluted_eps_excluding_extraord_items', 2)
+    return safeDivide(eps - prev_eps, numpy.abs(prev_eps))
+
+
+def batchDebtToEquity(fm):
+    return safeDivide(fm.quarter('total_liabilities'), fm.quarter('total_equity'))
+
+
+def batchDebtChange(fm):
+    debt = fm.year('total_debt', 1)
+    prev_debt = fm.year('total_debt', 2)
+    valid = truthy(debt) & truthy(prev_debt)
+    return numpy.where(valid, (debt - prev_debt) / numpy.where(valid, prev_debt, 1.0), numpy.nan)
+
+
+def batchROIC(fm):
+    def nopat(n):
+        oi = fm.quarter('operating_income', n)
+        ebt = fm.quarter('net_income_before_taxes', n)
+        eat = fm.quarter('net_income_after_taxes', n)
+        valid = periodPresent(fm, n - 1) & truthy(oi) & truthy(ebt) & truthy(eat)
+        tax_rate = (ebt - eat) / numpy.where(valid, ebt, 1.0)
+        return valid, oi * (1 - tax_rate)
+
+    def investedCapital(n):
+        ic = 0.0
+        for name in ('total_long_term_debt', 'current_port_of_lt_debt/capital_leases',
+                     'notes_payable/short_term_debt', 'minority_interest', 'total_equity'):
+            ic = ic + orZero(fm.quarter(name, n))
+        cash = firstPresent(fm.quarter('cash_and_short_term_investments', n),
+                            fm.quarter('cash&equivalents', n), fm.quarter('cash', n))
+        return ic - orZero(cash)
+
+    valid, total = nopat(1)
+    valid = valid & periodPresent(fm, 1)
+    for n in range(2, 5):
+        has_qtr, qtr_nopat = nopat(n)
+        total = numpy.where(has_qtr, total + qtr_nopat, total)
+    ic = (investedCapital(1) + investedCapital(2)) / 2
+    valid = valid & (((ic < 0) & (total >= 0)) | (ic > 0))
+    return numpy.where(valid, total / numpy.where(valid, ic, 1.0), numpy.nan)
+
+
+def batchRatios(prices, fm):
+    '''
+    Every ratio for every ticker of a FundamentalsMatrix
+
+    Input:
+        prices: array-like of prices in fm.symbols order
+        fm: Financials.FundamentalsMatrix
+    Output:
+        pandas.DataFrame indexed by symbol, NaN where a ratio isn't available
+    '''
+    mkt_cap, firm_val, ev = batchCompanyValues(prices, fm)
+    return pandas.DataFrame({'Market Cap': mkt_cap,
+                             'Firm Value': firm_val,
+                             'Enterprise Value': ev,
+                             'P/E': batchP_E(prices, fm),
+                             'EV/EBITDA': batchEV_EBITDA(ev, fm),
+                             'EV/S': batchEV_S(ev, fm),
+                             'EV/FCF': batchEV_FCF(ev, fm),
+                             'P/B': batchP_B(prices, fm),
+                             'Dividend': batchDivPayout(fm),
+                             'Change in NOA': batchChangeInNOA(fm),
+                             'EPS Growth': batchOneYearGrowth(fm),
+                             'Debt to Equity': batchDebtToEquity(fm),
+                             '1yr Debt Change': batchDebtChange(fm),
+                             'ROIC': batchROIC(fm)},
+                            index=fm.symbols)
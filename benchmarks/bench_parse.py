@@ -0,0 +1,88 @@
+'''
+Benchmark of the fundamental statement parser
+
+Compares Financials.parse (streaming iterparse) against the previous
+xmltodict based parser on data/sample_financialStatement.xml, timing both
+and measuring their peak memory with tracemalloc.
+
+python benchmarks/bench_parse.py [--number 200] [--file report.xml]
+'''
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+import xmltodict
+
+import coaCodes
+import Financials
+
+
+def listify(node):
+    if node is None:
+        return []
+    if type(node) != list:
+        return [node]
+    return node
+
+
+def legacyParse(data):
+    '''
+    The xmltodict parser Financials.parse replaced, kept to compare against
+    '''
+    statements = xmltodict.parse(data)['ReportFinancialStatements']['FinancialStatements']
+    report = Financials.Financials()
+    for key, periods in (('AnnualPeriods', report.annuals), ('InterimPeriods', report.interims)):
+        for fiscal_period in listify(statements[key]['FiscalPeriod']):
+            stmts = fiscal_period['Statement']
+            if type(stmts) != list:
+                continue
+            if stmts[0]['FPHeader']['Source']['#text'] not in Financials.ACCEPTED_REPORTS:
+                continue
+            period = Financials.Period(fiscal_period.get('@Type'), fiscal_period.get('@EndDate'),
+                                       fiscal_period.get('@FiscalYear'))
+            for statement in stmts:
+                codes = period.statements.setdefault(statement['@Type'], {})
+                for i in listify(statement.get('lineItem')):
+                    try:
+                        value = float(i['#text'])
+                        codes[i['@coaCode']] = value
+                        period.items[coaCodes.coaCode_map[i['@coaCode']]] = value
+                    except KeyError:
+                        pass
+            periods.append(period)
+    return report
+
+
+def peakMemory(func, data):
+    tracemalloc.start()
+    func(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fundamental statement parser benchmark')
+    parser.add_argument('--file', default=os.path.join(ROOT, 'data', 'sample_financialStatement.xml'))
+    parser.add_argument('--number', type=int, default=200, help='Parses per timing run')
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        data = f.read()
+
+    results = {}
+    for name, func in (('xmltodict', legacyParse), ('iterparse', Financials.parse)):
+        best = min(timeit.repeat(lambda: func(data), number=args.number, repeat=5))
+        results[name] = (best / args.number, peakMemory(func, data))
+        print('%-10s %8.3f ms/report  peak %8.1f KB' % (name, results[name][0] * 1e3,
+                                                     results[name][1] / 1024.0))
+    print('speedup    %8.1fx' % (results['xmltodict'][0] / results['iterparse'][0]))
+    print('memory     %8.1fx less' % (float(results['xmltodict'][1]) / results['iterparse'][1]))
+
+
+if __name__ == '__main__':
+    main()
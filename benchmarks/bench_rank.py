@@ -0,0 +1,87 @@
+'''
+Benchmark of Algorithms.compositeValueRank
+
+Times the ranking on random universes of growing size, next to the previous
+per-row qcut implementation (O(n^2), so only run up to --legacy_max tickers),
+and checks both give the same scores.
+
+python benchmarks/bench_rank.py [--sizes 100 1000 10000 20000] [--legacy_max 1000]
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy
+import pandas
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Algorithms
+
+
+FACTORS = ['P/E', 'EV/EBITDA', 'EV/S', 'EV/FCF']
+
+
+def legacyCompositeValueRank(df):
+    '''
+    compositeValueRank before it was vectorized, kept to compare against
+    '''
+    for factor in FACTORS:
+        df[factor + ' Score'] = None
+    df['Value Score'] = None
+    for factor in FACTORS:
+        df_missing = df[df[factor].isnull()]
+        df_good = df[df[factor].notnull()]
+        for i, row in df_missing.iterrows():
+            df.at[i, factor + ' Score'] = 50
+        for i, row in df_good.iterrows():
+            df.at[i, factor + ' Score'] = 100 - \
+                pandas.qcut(df_good[factor], 100, labels=False)[i]
+    for i, row in df.iterrows():
+        df.at[i, 'Value Score'] = (
+            row['P/E Score'] + row['EV/EBITDA Score'] + row['EV/S Score'] + row['EV/FCF Score'])/4
+    return df.sort_values('Value Score', ascending=False)
+
+
+def universe(n, seed=0):
+    '''
+    n tickers with ~20% of each factor missing (None, like main.setRatios gives)
+    '''
+    rng = numpy.random.RandomState(seed)
+    df = pandas.DataFrame({'Symbol': ['T%s' % i for i in range(n)]})
+    for factor in FACTORS:
+        values = rng.lognormal(2, 1, n)
+        df[factor] = pandas.Series([None if m else v for m, v in zip(rng.rand(n) < .2, values)],
+                                   dtype=object)
+    return df
+
+
+def timeIt(func, df):
+    start = time.perf_counter()
+    result = func(df.copy())
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compositeValueRank benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 20000])
+    parser.add_argument('--legacy_max', type=int, default=1000,
+                        help='Largest universe to run the legacy implementation on')
+    args = parser.parse_args()
+
+    print('%8s %12s %12s' % ('tickers', 'vectorized', 'legacy'))
+    for n in args.sizes:
+        df = universe(n)
+        new_time, new = timeIt(Algorithms.compositeValueRank, df)
+        legacy = '-'
+        if n <= args.legacy_max:
+            legacy_time, old = timeIt(legacyCompositeValueRank, df)
+            columns = [f + ' Score' for f in FACTORS] + ['Value Score']
+            old = old.sort_index()[columns].astype(float)
+            assert (old.values == new.sort_index()[columns].values).all(), 'Scores differ'
+            legacy = '%10.3f s' % legacy_time
+        print('%8s %10.3f s %12s' % (n, new_time, legacy))
+
+
+if __name__ == '__main__':
+    main()
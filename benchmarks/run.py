@@ -0,0 +1,426 @@
+'''
+Benchmark suite for the screening pipelines
+
+Times the building blocks (loadTickers, parsing, every Ratios function in
+its per ticker and batch form, compositeValueRank, historical bar
+accumulation, moving average crosses, Black Scholes) and whole ratios()/
+factorSort()/alphaInFactors()/movingAvgCross() runs against
+tools/fake_tws.py serving the recorded sample statement, over universes of
+10 to 10000 tickers.
+
+Each benchmark is timed asv style: the run is repeated until it takes at
+least 0.2 s, and the best of --repeat such measurements is kept. Results are
+compared with the stored baseline (benchmarks/baseline.json) and anything
+slower than --threshold times its baseline is reported as a regression.
+Baselines are machine specific, re-record them with --save after changing
+machines.
+
+python benchmarks/run.py [--sizes 10 100 1000 10000] [-k Ratios] [--save] [--check]
+'''
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+import numpy
+import pandas
+from ibapi.common import BarData
+
+import Algorithms as algo
+import Black_Scholes as bs
+import Financials
+import InteractiveBrokers as ib
+import main
+import Pacing
+import Ratios
+from tools import fake_tws
+
+
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+SIZES = [10, 100, 1000, 10000]
+# Whole pipelines parse every report on each run, so by default they stop
+# at 1000 tickers (use --pipeline_max 10000 for the full range)
+PIPELINE_MAX = 1000
+
+Benchmark = collections.namedtuple('Benchmark', ['name', 'setup', 'max_size', 'pipeline'])
+BENCHMARKS = []
+
+
+def benchmark(name=None, max_size=None, pipeline=False):
+    '''
+    Registers setup(n), which prepares a universe of n tickers and returns
+    the function to time
+    '''
+    def register(setup):
+        BENCHMARKS.append(Benchmark(name or setup.__name__, setup, max_size, pipeline))
+        return setup
+    return register
+
+
+### Recorded data ###
+
+_cache = {}
+
+
+def cached(key, make):
+    if key not in _cache:
+        _cache[key] = make()
+    return _cache[key]
+
+
+def tickers(n):
+    return ['T%05d' % i for i in range(n)]
+
+
+def reportXml(n):
+    '''
+    Variants of data/sample_financialStatement.xml for n tickers
+    '''
+    variants = cached('xml', fake_tws.fundamentalVariants)
+    return {t: variants[i % len(variants)] for i, t in enumerate(tickers(n))}
+
+
+def reports(n):
+    parsed = cached('reports', lambda: [Financials.parse(x) for x in fake_tws.fundamentalVariants()])
+    return {t: parsed[i % len(parsed)] for i, t in enumerate(tickers(n))}
+
+
+def prices(n):
+    return [fake_tws.lastPrice(t) for t in tickers(n)]
+
+
+def matrix(n):
+    return Financials.FundamentalsMatrix.fromReports(reports(n))
+
+
+def app():
+    '''
+    App connected to a fake TWS answering instantly and without pacing
+    limits, shared by every pipeline benchmark
+    '''
+    def connect():
+        tws = fake_tws.FakeTWS().start()
+        app = ib.App('127.0.0.1', tws.port, 1)
+        app.scheduler = Pacing.Scheduler(rates={}, global_rate=1e9)
+        app.data_timeout = 60
+        return tws, app
+    return cached('app', connect)[1]
+
+
+def close():
+    if 'app' in _cache:
+        tws, app = _cache.pop('app')
+        app.client.disconnect()
+        tws.stop()
+
+
+### Benchmarks ###
+
+@benchmark('main.loadTickers')
+def loadTickers(n):
+    f = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+    with f:
+        for i, t in enumerate(tickers(n)):
+            # Some share classes and foreign listings like the real lists
+            f.write(t + ('.B' if i % 50 == 1 else '$CAD' if i % 50 == 2 else '') + '\n')
+    return lambda: main.loadTickers(f.name)
+
+
+@benchmark('Financials.parse', max_size=1000)
+def parseFinancials(n):
+    datas = list(reportXml(n).values())
+    return lambda: [Financials.parse(d) for d in datas]
+
+
+@benchmark('Financials.parseMany', max_size=1000)
+def parseMany(n):
+    datas = reportXml(n)
+    return lambda: Financials.parseMany(datas)
+
+
+@benchmark('Financials.FundamentalsMatrix')
+def fundamentalsMatrix(n):
+    rs = reports(n)
+    return lambda: Financials.FundamentalsMatrix.fromReports(rs)
+
+
+def scalarRatio(name, func, args):
+    '''
+    Times a per ticker Ratios function over the universe, with
+    args(price, quarters, years) giving its arguments for one ticker
+    '''
+    def setup(n):
+        calls = [args(p, r.quarters(), r.years()) for p, r in zip(prices(n), reports(n).values())]
+        return lambda: [func(*a) for a in calls]
+    benchmark('Ratios.' + name)(setup)
+
+
+def batchRatio(name, func, args):
+    '''
+    Times a batch Ratios function, with args(prices, ev, fm) giving its arguments
+    '''
+    def setup(n):
+        fm = matrix(n)
+        ev = Ratios.batchCompanyValues(prices(n), fm)[2]
+        call = args(prices(n), ev, fm)
+        return lambda: func(*call)
+    benchmark('Ratios.' + name)(setup)
+
+
+def ev(price, quarters):
+    return Ratios.getCompanyValues(price, quarters[0])[2]
+
+
+for _name, _args in [('getCompanyValues', lambda p, q, y: (p, q[0])),
+                     ('getP_E', lambda p, q, y: (p,) + q),
+                     ('getEV_EBITDA', lambda p, q, y: (ev(p, q),) + q),
+                     ('getP_B', lambda p, q, y: (p, q[0])),
+                     ('getEV_S', lambda p, q, y: (ev(p, q),) + q),
+                     ('getEV_FCF', lambda p, q, y: (ev(p, q),) + q),
+                     ('getDivPayout', lambda p, q, y: q[:2]),
+                     ('calcChangeInNOA', lambda p, q, y: y),
+                     ('calcOneYearGrowth', lambda p, q, y: y),
+                     ('calcDebtToEquity', lambda p, q, y: q[:1]),
+                     ('calcDebtChange', lambda p, q, y: y),
+                     ('calcROIC', lambda p, q, y: q)]:
+    scalarRatio(_name, getattr(Ratios, _name), _args)
+
+for _name, _args in [('batchCompanyValues', lambda p, e, fm: (p, fm)),
+                     ('batchP_E', lambda p, e, fm: (p, fm)),
+                     ('batchEV_EBITDA', lambda p, e, fm: (e, fm)),
+                     ('batchP_B', lambda p, e, fm: (p, fm)),
+                     ('batchEV_S', lambda p, e, fm: (e, fm)),
+                     ('batchEV_FCF', lambda p, e, fm: (e, fm)),
+                     ('batchDivPayout', lambda p, e, fm: (fm,)),
+                     ('batchChangeInNOA', lambda p, e, fm: (fm,)),
+                     ('batchOneYearGrowth', lambda p, e, fm: (fm,)),
+                     ('batchDebtToEquity', lambda p, e, fm: (fm,)),
+                     ('batchDebtChange', lambda p, e, fm: (fm,)),
+                     ('batchROIC', lambda p, e, fm: (fm,)),
+                     ('batchRatios', lambda p, e, fm: (p, fm))]:
+    batchRatio(_name, getattr(Ratios, _name), _args)
+
+
+@benchmark('main.setRatios')
+def setRatios(n):
+    rs = reports(n)
+    df = pandas.DataFrame({'Symbol': tickers(n), 'Price': prices(n)})
+    for column in ['Market Cap', 'Enterprise Value', 'P/E', 'EV/EBITDA', 'EV/S', 'EV/FCF']:
+        df[column] = None
+    return lambda: main.setRatios(df.copy(), rs)
+
+
+@benchmark('Algorithms.compositeValueRank')
+def compositeValueRank(n):
+    df = pandas.DataFrame({'Symbol': tickers(n)})
+    ratios = Ratios.batchRatios(prices(n), matrix(n))
+    rng = numpy.random.RandomState(0)
+    for factor in algo.VALUE_FACTORS:
+        # The recorded reports only have 16 distinct values per factor
+        df[factor] = ratios[factor].values * rng.lognormal(0, .5, n)
+    return lambda: algo.compositeValueRank(df.copy())
+
+
+@benchmark('InteractiveBrokers.BarBuffer', max_size=1000)
+def barBuffer(n):
+    # A year of daily bars for each ticker, as the historicalData callbacks get them
+    requests = []
+    for t in tickers(n):
+        bars = []
+        for b in fake_tws.bars(t, '1 Y'):
+            bar = BarData()
+            bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume = b
+            bars.append(bar)
+        requests.append(bars)
+
+    def run():
+        for bars in requests:
+            buffer = ib.BarBuffer()
+            for bar in bars:
+                buffer.append(bar)
+            buffer.frame()
+    return run
+
+
+@benchmark('Algorithms.movingAvgCross')
+def movingAvgCross(n):
+    frames = [pandas.DataFrame({'price': [b[4] for b in fake_tws.bars(t, '1 Y')]})
+              for t in tickers(n)]
+    return lambda: [algo.movingAvgCross(df) for df in frames]
+
+
+@benchmark('Algorithms.MovingAverageCross')
+def movingAverageCrossUpdate(n):
+    '''
+    A daily run: one new bar for each ticker's year of kept state
+    '''
+    states = {}
+    for t in tickers(n):
+        ma = algo.MovingAverageCross()
+        for date, _, _, _, close, _ in fake_tws.bars(t, '1 Y'):
+            ma.update(date, close)
+        states[t] = ma.to_dict()
+    tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).strftime('%Y%m%d')
+
+    def update():
+        for t, state in states.items():
+            algo.MovingAverageCross.from_dict(state).update(tomorrow, 10.0)
+    return update
+
+
+def warrantContracts(n):
+    rng = numpy.random.RandomState(0)
+    stock = rng.uniform(5, 50, n)
+    return stock, stock * rng.uniform(.7, 1.3, n), rng.uniform(.1, 1.5, n)
+
+
+@benchmark('BlackScholes.price_euro_call', max_size=1000)
+def priceEuroCall(n):
+    expiry = (datetime.date.today() + datetime.timedelta(days=700)).strftime('%m-%d-%Y')
+    warrants = [bs.BlackScholes(k, s, .03, v, expiry, .01, 30, 4)
+                for s, k, v in zip(*warrantContracts(n))]
+    return lambda: [w.price_euro_call() for w in warrants]
+
+
+@benchmark('Black_Scholes.price_warrants')
+def priceWarrants(n):
+    stock, strikes, vols = warrantContracts(n)
+    return lambda: bs.price_warrants(stock, strikes, vols, 2, .03, .01, 30, 4)
+
+
+@benchmark('main.ratios', pipeline=True)
+def ratiosPipeline(n):
+    a, ts = app(), tickers(n)
+    return lambda: main.ratios(a, ts, None)
+
+
+@benchmark('main.factorSort', pipeline=True)
+def factorSortPipeline(n):
+    a, ts = app(), tickers(n)
+    return lambda: main.factorSort(a, ts, True, None, None)
+
+
+@benchmark('main.alphaInFactors', pipeline=True)
+def alphaInFactorsPipeline(n):
+    a, ts = app(), tickers(n)
+    return lambda: main.alphaInFactors(a, ts, None, None)
+
+
+@benchmark('main.movingAvgCross', pipeline=True)
+def movingAvgCrossPipeline(n):
+    a, ts = app(), tickers(n)
+    state_f = os.path.join(tempfile.mkdtemp(), 'ma_state.json')
+    positions = pandas.DataFrame(columns=['symbol', 'secType', 'currency', 'pos', 'avg_cost'])
+    orders = pandas.DataFrame(columns=['symbol', 'secType', 'action', 'quantity', 'status'])
+    # First run backfills a year per ticker, the timed runs are the daily updates
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        main.movingAvgCross(a, positions, orders, ts, False, state_f)
+    return lambda: main.movingAvgCross(a, positions, orders, ts, False, state_f)
+
+
+### Runner ###
+
+def measure(func, repeat):
+    '''
+    Best seconds per call, asv style
+    '''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def loadBaseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def saveBaseline(path, results):
+    baseline = loadBaseline(path)
+    baseline.update(results)
+    with open(path, 'w') as f:
+        json.dump({'machine': {'python': platform.python_version(),
+                               'platform': platform.platform(),
+                               'processor': platform.processor() or platform.machine(),
+                               'cpus': os.cpu_count()},
+                   'results': dict(sorted(baseline.items()))}, f, indent=2)
+        f.write('\n')
+
+
+def run(benchmarks, sizes, repeat, pipeline_max, baseline, threshold):
+    '''
+    Returns the results as {'name[n]': seconds} and the regressed keys
+    '''
+    results = {}
+    regressions = []
+    print('%-36s %7s %12s %12s %7s' % ('benchmark', 'tickers', 'seconds', 'baseline', 'ratio'))
+    for b in benchmarks:
+        max_size = pipeline_max if b.pipeline else b.max_size
+        for n in sizes:
+            if max_size is not None and n > max_size:
+                continue
+            key = '%s[%s]' % (b.name, n)
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                seconds = measure(b.setup(n), repeat)
+            results[key] = seconds
+            line = '%-36s %7s %12.6f' % (b.name, n, seconds)
+            if key in baseline:
+                ratio = seconds / baseline[key]
+                line += ' %12.6f %6.2fx' % (baseline[key], ratio)
+                if ratio > threshold:
+                    regressions.append(key)
+                    line += '  REGRESSION'
+            print(line)
+            sys.stdout.flush()
+    return results, regressions
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Benchmark suite for the screening pipelines')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Universe sizes')
+    parser.add_argument('-k', '--filter', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3, help='Measurements per benchmark, the best is kept')
+    parser.add_argument('--pipeline_max', type=int, default=PIPELINE_MAX,
+                        help='Largest universe to run the full pipelines on')
+    parser.add_argument('--no_pipelines', action='store_true', help='Skip the runs against the fake TWS')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='Slowdown against the baseline reported as a regression')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='Exit with 1 if anything regressed')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks and exit')
+    args = parser.parse_args()
+
+    benchmarks = [b for b in BENCHMARKS
+                  if (args.filter is None or args.filter in b.name) and
+                  not (args.no_pipelines and b.pipeline)]
+    if args.list:
+        for b in benchmarks:
+            print(b.name)
+        return 0
+    try:
+        results, regressions = run(benchmarks, args.sizes, args.repeat, args.pipeline_max,
+                                   loadBaseline(args.baseline), args.threshold)
+    finally:
+        close()
+    if args.save:
+        saveBaseline(args.baseline, results)
+        print('Saved %s results to %s' % (len(results), args.baseline))
+    if regressions:
+        print('Regressions (> %sx baseline): %s' % (args.threshold, ', '.join(regressions)))
+        if args.check:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -1,25 +1,32 @@
 import argparse
 import datetime
+import json
 import pathlib
 import queue
 import sys
 import time
 import xml.etree.ElementTree as ET
 
+import numpy
 import pandas
 
 import InteractiveBrokers as ib
 import Algorithms as algo
+import Cache
+import Financials
+import MarketData
 import Ratios
 from ContractSamples import ContractSamples
-from Black_Scholes import BlackScholes
+import Black_Scholes as bs
 
 
 def short_portfolio(app, tickers, input_f, out_f):
     tickers = tickers[:5]
     print(tickers)
     ticker_data, issue_tickers = getPriceData(app, tickers)
-    fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers)
+    with Financials.ParsePool(app.parse_workers) as parser:
+        fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers, parser)
+        reports = parser.results()
 
     # Create our dataframe with price and fundamental data
     symbols = []
@@ -38,9 +45,9 @@ def short_portfolio(app, tickers, input_f, out_f):
     print(df)
 
     for i, row in df.iterrows():
-        qtr1, qtr2, qtr3, qtr4 = app.parseFinancials(
-            row['Data'], quarterly=True)
-        current_annual, prev_annual = app.parseFinancials(row['Data'])
+        report = reports[row['Symbol']]
+        qtr1, qtr2, qtr3, qtr4 = report.quarters()
+        current_annual, prev_annual = report.years()
 
         df.at[i, 'Debt to Equity'] = Ratios.calcDebtToEquity(qtr1)
         df.at[i, '1yr Debt Change'] = Ratios.calcDebtChange(
@@ -69,7 +76,9 @@ def alphaInFactors(app, tickers, input_f, out_f):
     prices = []
 
     ticker_data, issue_tickers = getPriceData(app, tickers)
-    fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers)
+    with Financials.ParsePool(app.parse_workers) as parser:
+        fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers, parser)
+        reports = parser.results()
 
     # Create our dataframe with price and fundamental data
     symbols = []
@@ -89,30 +98,9 @@ def alphaInFactors(app, tickers, input_f, out_f):
     print("Price Data:")
     print(df)
 
-    # Loop through dataframe and update specific values
-    for i, row in df.iterrows():
-        qtr1, qtr2, qtr3, qtr4 = app.parseFinancials(
-            row['Data'], quarterly=True)
-        # Getting annual reports also
-        current_annual, prev_annual = app.parseFinancials(row['Data'])
-
-        df.at[i, 'Dividend'] = Ratios.getDivPayout(qtr1, qtr2)
-
-        # Numerators
-        df.at[i, 'Market Cap'], ev = Ratios.getCompanyValues(row['Price'], qtr1)[
-            ::2]
-        df.at[i, 'Enterprise Value'] = ev
-
-        df.at[i, 'P/E'] = Ratios.getP_E(row['Price'], qtr1, qtr2, qtr3, qtr4)
-        df.at[i, 'EV/EBITDA'] = Ratios.getEV_EBITDA(ev, qtr1, qtr2, qtr3, qtr4)
-        df.at[i, 'EV/S'] = Ratios.getEV_S(ev, qtr1, qtr2, qtr3, qtr4)
-        df.at[i, 'EV/FCF'] = Ratios.getEV_FCF(ev, qtr1, qtr2, qtr3, qtr4)
-
-        df.at[i, 'Change in NOA'] = Ratios.calcChangeInNOA(
-            current_annual, prev_annual)
-        df.at[i, 'EPS Growth'] = Ratios.calcOneYearGrowth(
-            current_annual, prev_annual)
-        df.at[i, 'Debt to Equity'] = Ratios.calcDebtToEquity(qtr1)
+    # Dividend, numerators, value factors, growth, earnings quality
+    # and leverage for every ticker at once
+    setRatios(df, reports)
 
     # Drop rows where we don't have market cap or EV
     df = df.dropna(subset=['Market Cap', 'Enterprise Value'])
@@ -174,13 +162,19 @@ def alphaInFactors(app, tickers, input_f, out_f):
     return
 
 
-def ratios(app, tickers, out_f):
+def ratios(app, tickers, out_f, all_periods=False):
     """
     Ratio Calculator
+
+    If all_periods, also shows (and saves to out_f + '_periods') the line
+    items of every annual and interim period in each ticker's report, not
+    just the 4 quarters the ratios use
     """
 
     ticker_data, issue_tickers = getPriceData(app, tickers)
-    fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers)
+    with Financials.ParsePool(app.parse_workers) as parser:
+        fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers, parser)
+        reports = parser.results()
 
     # Create our dataframe with price and fundamental data
     symbols = []
@@ -198,21 +192,15 @@ def ratios(app, tickers, out_f):
             'P/B': None, 'EV/S': None, 'EV/FCF': None}
     df = pandas.DataFrame(data=data).dropna(subset=['Price', 'Data'])
 
-    # Loop through dataframe and update specific values
-    for i, row in df.iterrows():
-        qtr1, qtr2, qtr3, qtr4 = app.parseFinancials(
-            row['Data'], quarterly=True)
-
-        # Numerators
-        df.at[i, 'Market Cap'], df.at[i, 'Firm Value'], ev = Ratios.getCompanyValues(
-            row['Price'], qtr1)
-        df.at[i, 'Enterprise Value'] = ev
+    # Numerators and ratios for every ticker at once
+    setRatios(df, reports)
 
-        df.at[i, 'P/E'] = Ratios.getP_E(row['Price'], qtr1, qtr2, qtr3, qtr4)
-        df.at[i, 'EV/EBITDA'] = Ratios.getEV_EBITDA(ev, qtr1, qtr2, qtr3, qtr4)
-        df.at[i, 'EV/S'] = Ratios.getEV_S(ev, qtr1, qtr2, qtr3, qtr4)
-        df.at[i, 'EV/FCF'] = Ratios.getEV_FCF(ev, qtr1, qtr2, qtr3, qtr4)
-        df.at[i, 'P/B'] = Ratios.getP_B(row['Price'], qtr1)
+    periods = []
+    if all_periods:
+        for symbol in df['Symbol']:
+            period_df = reports[symbol].toFrame()
+            period_df.insert(0, 'Symbol', symbol)
+            periods.append(period_df)
 
     df = df.drop(columns=['Data'])
     print('Results:')
@@ -222,6 +210,13 @@ def ratios(app, tickers, out_f):
     if out_f:
         saveResults(df, out_f)
 
+    if periods:
+        period_df = pandas.concat(periods, ignore_index=True, sort=False)
+        print('All Periods:')
+        print(period_df)
+        if out_f:
+            saveResults(period_df, out_f + '_periods')
+
     print('Tickers missing price data: (%s)' % len(issue_tickers))
     print(issue_tickers)
     print('Tickers missing fundamental data: (%s)' % len(data_issue_tickers))
@@ -240,42 +235,89 @@ def warrants(app, tickers, warrants_out):
 
     # Take user input for vol?
     vols = [.2, .3, .35, .4, .5, .6]
-    data = {'Volatility': vols}
+    # Last two rows are each warrant's market price and the vol it implies
+    data = {'Volatility': vols + ['Market', 'Implied Vol']}
 
     ticker_data, issue_tickers = getPriceData(app, tickers)
-    fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers)
+    with Financials.ParsePool(app.parse_workers) as parser:
+        fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers, parser)
+        reports = parser.results()
+
+    # Fire off warrant and dividend yield lookups for every ticker at once
+    # and then gather them, rather than one round trip after another
+    details_futures = {}
+    yield_futures = {}
+    for key in ticker_data:
+        details_futures[key] = app.getContractDetailsFuture(
+            key, "WAR", exchange='SMART', currency='USD')
+        contract = app.createContract(key, "STK", "USD", "SMART", "ISLAND")
+        yield_futures[key] = app.getYieldFuture(contract)
 
     for key, val in ticker_data.items():
         # Find the warrant
-        contract_details = app.getContractDetails(
-            key, "WAR", exchange='SMART', currency='USD')
+        try:
+            contract_details = details_futures[key].result()
+        except ib.RequestError as e:
+            print('No warrants found for %s: %s' % (key, e.errorString))
+            continue
         underlying_price = float(val)
         # Get dividend yield
-        contract = app.createContract(key, "STK", "USD", "SMART", "ISLAND")
-        div = app.getYield(contract)
+        try:
+            div = yield_futures[key].result()
+        except ib.RequestError:
+            div = 0
         # Find share count from financials
-        qtr1 = app.parseFinancials(fund_ticker_data[key], quarterly=True)[0]
+        qtr1 = reports[key].quarters()[0]
         shares_out = qtr1['total_common_shares_outstanding']
 
+        # TODO: Get this from t-bill near expiry date?
+        risk = .03
+
+        headers = []
+        strikes = []
+        years = []
+        warrants_per_share = []
+        price_futures = []
         for c in contract_details:
             contract = c.contract
-            strike = contract.strike
+            price_futures.append(app.getPriceFuture(contract))
             # right = contract.right
-            warrants_per_share = (1/float(contract.multiplier))
             expiry = datetime.datetime.strptime(
                 contract.lastTradeDateOrContractMonth, '%Y%m%d').strftime('%m-%d-%Y')
+            headers.append('%s %s' % (str(contract.strike), expiry))
+            strikes.append(contract.strike)
+            years.append(bs.years_until(expiry))
+            warrants_per_share.append(1/float(contract.multiplier))
+        if not headers:
+            continue
 
-            # TODO: Get this from t-bill near expiry date?
-            risk = .03
-
-            prices = []
-            for vol in vols:
-                bs = BlackScholes(strike, underlying_price, risk, vol,
-                                  expiry, div, shares_out, warrants_out,
-                                  warrants_per_share)
-                prices.append('$' + str(round(bs.price_euro_call(), 5)))
-            header = ('%s %s' % (str(strike), expiry))
-            data[header] = prices
+        # Price every vol x warrant combination at once, vols down the rows
+        grid = bs.price_warrants(underlying_price, numpy.array(strikes)[None, :],
+                                 numpy.array(vols)[:, None], numpy.array(years)[None, :],
+                                 risk, div, shares_out, warrants_out,
+                                 numpy.array(warrants_per_share)[None, :])
+        if shares_out is not None and warrants_out is not None:
+            print('Black Scholes calculation WITH share dilution:')
+        else:
+            print('Black Scholes calculation with no share dilution:')
+
+        # Market implied vol of every warrant in one call
+        market_prices = []
+        for fut in price_futures:
+            try:
+                price = fut.result()
+            except ib.RequestError:
+                price = None
+            market_prices.append(numpy.nan if price is None else price)
+        implied, converged = bs.implied_vols(numpy.array(market_prices), underlying_price,
+                                             numpy.array(strikes), numpy.array(years), risk, div,
+                                             shares_out, warrants_out,
+                                             numpy.array(warrants_per_share))
+
+        for j, header in enumerate(headers):
+            data[header] = ['$' + str(round(float(price), 5)) for price in grid[:, j]]
+            data[header].append('$' + str(market_prices[j]))
+            data[header].append(round(float(implied[j]), 4) if converged[j] else None)
         df = pandas.DataFrame(data=data)
         print(df)
 
@@ -294,7 +336,9 @@ def factorSort(app, tickers, rank, input_f, out_f):
         print("Error: Must provide file of tickers by '-i' option")
         return
 
-    fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers)
+    with Financials.ParsePool(app.parse_workers) as parser:
+        fund_ticker_data, data_issue_tickers = getFundamentalData(app, tickers, parser)
+        reports = parser.results()
     datas = []
     for ticker in tickers:
         if type(ticker) is list and ticker[0] in fund_ticker_data:
@@ -309,17 +353,8 @@ def factorSort(app, tickers, rank, input_f, out_f):
             'Debt to Equity': None, 'ROIC': None}
     df = pandas.DataFrame(data=data).dropna(subset=['Data'])
 
-    for i, row in df.iterrows():
-        print(row['Symbol'])
-        qtr1, qtr2, qtr3, qtr4 = app.parseFinancials(
-            row['Data'], quarterly=True)
-        current_annual, prev_annual = app.parseFinancials(row['Data'])
-        df.at[i, 'Change in NOA'] = Ratios.calcChangeInNOA(
-            current_annual, prev_annual)
-        df.at[i, 'Debt to Equity'] = Ratios.calcDebtToEquity(qtr1)
-        df.at[i, 'ROIC'] = Ratios.calcROIC(qtr1, qtr2, qtr3, qtr4)
-        df.at[i, '1yr Debt Change'] = Ratios.calcDebtChange(
-            current_annual, prev_annual)
+    # Foreign stocks are [symbol, exchange, ...]
+    setRatios(df, reports, [s[0] if type(s) is list else s for s in df['Symbol']])
 
     df = df.drop(columns=['Data'])
     print(df)
@@ -352,28 +387,60 @@ def factorSort(app, tickers, rank, input_f, out_f):
             saveResults(df, out_f + '_ranked')
 
 
-def movingAvgCross(app, positions, orders, tickers, buy):
+def movingAvgCross(app, positions, orders, tickers, buy, state_f=None):
     """
     MA Cross
+
+    Moving averages are kept per ticker in an algo.MovingAverageCross saved
+    to state_f, so only the bars since the last run are requested for tickers
+    we have seen before (a year of history for new ones)
     """
 
     if tickers is None:
         print("Error: Must provide file of tickers by '-i' option")
         return
 
-    hist_data, hist_issue_tickers = getHistData(app, tickers, "1 Y")
+    states = loadMAState(state_f)
+    today = datetime.datetime.today()
+    new_tickers = []
+    gaps = []
+    for ticker in tickers:
+        if ticker in states and states[ticker].last_date:
+            gap = (today - datetime.datetime.strptime(states[ticker].last_date[:8], '%Y%m%d')).days
+            if gap <= 365:
+                gaps.append(gap)
+                continue
+        # New ticker, or too old to catch up on so start over
+        states.pop(ticker, None)
+        new_tickers.append(ticker)
+    known_tickers = [t for t in tickers if t in states]
+
+    hist_data = {}
+    hist_issue_tickers = {}
+    if new_tickers:
+        hist_data, hist_issue_tickers = getHistData(app, new_tickers, "1 Y")
+    if known_tickers:
+        # +1 so we see the last bar we have again, in case it was updated since
+        data, issues = getHistData(app, known_tickers, "%d D" % (max(gaps) + 1))
+        hist_data.update(data)
+        hist_issue_tickers.update(issues)
+
     for ticker in tickers:
         # Ensure we got hist data for this ticker
         if ticker not in hist_data:
             continue
+        ma = states.setdefault(ticker, algo.MovingAverageCross())
+        for date, price in zip(hist_data[ticker]['date'], hist_data[ticker]['price']):
+            event = ma.update(date, price)
+            if event:
+                print('%s cross on %s for: %s' % (event.title(), date, ticker))
         # Only process if no open orders with this ticker
         if orders.empty or not orders['symbol'].str.contains(ticker).any():
             # Golden Cross and not in portfolio -> buy
-            if algo.movingAvgCross(hist_data[ticker]) and not app.portfolioCheck(ticker, positions):
+            if ma.isGolden() and not app.portfolioCheck(ticker, positions):
                 print('Placing Buy Order for: ' + ticker)
                 if buy:
-                    amt = app.calcOrderSize(
-                        float(hist_data[ticker].tail(1)['price']), 1000)
+                    amt = app.calcOrderSize(ma.prices[-1], 1000)
                     contract = app.createContract(
                         ticker, "STK", "USD", "SMART", "ISLAND")
                     order = ib.Order()
@@ -382,16 +449,48 @@ def movingAvgCross(app, positions, orders, tickers, buy):
                     order.totalQuantity = amt
                     app.place_order(contract, order)
             # Death cross and in portfolio -> sell
-            elif (app.portfolioCheck(ticker, positions) and not algo.movingAvgCross(hist_data[ticker])):
+            elif (app.portfolioCheck(ticker, positions) and not ma.isGolden()):
                 print('Placing Sell Order for: ' + ticker)
                 if buy:
                     app.sellPosition(ticker, 'STK', orders, positions)
 
+    saveMAState(states, state_f)
     print('Completed MA Cross Algo')
     print('Tickers missing historical data: (%s)' % len(hist_issue_tickers))
     print(hist_issue_tickers)
 
 
+def loadMAState(state_f):
+    """ Load MA State
+
+    Arguments:
+        state_f {str} -- JSON file written by saveMAState, None for no state
+
+    Returns:
+        dict -- tickers as keys and algo.MovingAverageCross as values
+    """
+    if state_f is None or not pathlib.Path(state_f).exists():
+        return {}
+    with open(state_f) as f:
+        return {ticker: algo.MovingAverageCross.from_dict(state)
+                for ticker, state in json.load(f).items()}
+
+
+def saveMAState(states, state_f):
+    """ Save MA State
+
+    Arguments:
+        states {dict} -- tickers as keys and algo.MovingAverageCross as values
+        state_f {str} -- JSON file to save to, None to not save
+    """
+    if state_f is None:
+        return
+    tmp_f = state_f + '.tmp'
+    with open(tmp_f, 'w') as f:
+        json.dump({ticker: ma.to_dict() for ticker, ma in states.items()}, f)
+    pathlib.Path(tmp_f).replace(state_f)
+
+
 def saveResults(df, output_f):
     """ Save Results
 
@@ -404,20 +503,23 @@ def saveResults(df, output_f):
     df.to_pickle(output_f)
 
 
-def processQueue(q, tickers, app, q2=None):
+def processQueue(q, tickers, app, timeout=None, on_data=None):
     """ Process Queue
 
     Processes a data queue from IB class
+    Blocks on app.data_event between passes, so we sleep until IB sends
+    us something instead of spinning on the queues
 
     Arguments:
         q {queue} -- the main queue to process
         tickers {list} -- list of strings of tickers
         app {ib.App} -- ib App object. Needed to reference IB.reqId_map
                         to link up a reqId to a ticker
-        q2 {queue} -- (optional) secondary queue to process in the case
-                       that a ticker is missing from q. This can be useful
-                       for reqMktData when there are no trades today so we
-                       want to just use previous day close price, so use q2
+        timeout {float} -- (optional) overall deadline in seconds. Tickers
+                           still missing once it passes are reported as issues.
+                           Defaults to app.data_timeout (None waits forever)
+        on_data {function} -- (optional) called with (ticker, data) as soon as
+                              each ticker's data is taken off the queue
 
     Returns:
         dict -- tickers as keys and data as values
@@ -425,52 +527,126 @@ def processQueue(q, tickers, app, q2=None):
     """
     data_map = {}
     issues = {}
+    if timeout is None:
+        timeout = app.data_timeout
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def drain(data_q):
+        items = []
+        while True:
+            try:
+                data, reqId = data_q.get(block=False)
+            except queue.Empty:
+                return items
+            if reqId in app.reqId_map:
+                items.append((data, app.reqId_map[reqId]))
 
     while True:
-        if q.empty():
-            # Once our queue is empty and we have processed all tickers
-            # we can break out of this loop
-            if (len(data_map) + len(issues) >= len(tickers)):
-                break
-            elif q2 is not None:
-                # Live price data queue is empty but haven't processed all tickers
-                # Lets use last close price as maybe no shares have traded today
-                while True:
-                    try:
-                        data, reqId = q2.get(block=False)
-                        symbol = app.reqId_map[reqId]
-                        if symbol not in data_map and symbol not in issues:
-                            print("Using Backup Queue for: " + symbol)
-                            data_map[symbol] = data
-                    except queue.Empty:
-                        break
-        try:
-            # Symbol caused an error i.e. No security definition for the symbol
-            error, reqId = app.data_errors_q.get(block=False)
-            symbol = app.reqId_map[reqId]
+        # Clear before draining so anything that shows up while we are
+        # draining wakes up the wait below right away
+        app.data_event.clear()
+
+        # Symbol caused an error i.e. No security definition for the symbol
+        for error, symbol in drain(app.data_errors_q):
             print('Bad Symbol: ' + symbol)
             print("Error: " + error)
             issues[symbol] = error
 
-        except queue.Empty:
-            pass
-
-        try:
-            # Get data from queue
-            data, reqId = q.get(block=False)
-            symbol = app.reqId_map[reqId]
+        for data, symbol in drain(q):
             data_map[symbol] = data
-        except queue.Empty:
-            continue
+            if on_data is not None:
+                on_data(symbol, data)
+
+        # Once we have processed all tickers we can stop waiting
+        if (len(data_map) + len(issues) >= len(tickers)):
+            break
+
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for ticker in tickers:
+                    symbol = ticker[0] if type(ticker) is list else ticker
+                    if symbol not in data_map and symbol not in issues:
+                        print('Timed out waiting for: ' + symbol)
+                        issues[symbol] = 'Timed out waiting for data'
+                break
+        app.data_event.wait(remaining)
 
     return data_map, issues
 
 
+def setRatios(df, reports, keys=None):
+    """ Set Ratios
+
+    Fills in the ratio columns of df (any of Ratios.batchRatios' columns
+    that df has) for every row at once from a Financials.FundamentalsMatrix.
+    Missing ratios are None, same as the per ticker Ratios functions give
+
+    Arguments:
+        df {pandas.DataFrame} -- dataframe with a 'Symbol' column and
+                                 optionally a 'Price' column
+        reports {dict} -- tickers as keys and Financials objects as values
+        keys {list} -- (optional) reports key of each row, if not df['Symbol']
+    """
+    keys = list(df['Symbol']) if keys is None else keys
+    if 'Price' in df.columns:
+        price_map = dict(zip(keys, df['Price']))
+    else:
+        price_map = {}
+    symbols = list(dict.fromkeys(keys))
+    fm = Financials.FundamentalsMatrix.fromReports({key: reports[key] for key in symbols})
+    prices = [price_map.get(key, numpy.nan) for key in symbols]
+    results = Ratios.batchRatios(prices, fm).loc[keys]
+    for column in results.columns:
+        if column in df.columns:
+            values = [None if pandas.isnull(v) else v for v in results[column]]
+            df[column] = pandas.Series(values, index=df.index, dtype=object)
+
+
+def resolveContracts(app, tickers):
+    """ Resolve Contracts
+
+    Looks up the conId and primary exchange of every ticker that isn't
+    already in app.contract_cache, storing them there so createContract
+    sends later requests for these tickers by conId
+
+    Arguments:
+        app {ib.App} -- ib App object
+        tickers {list} -- list of strings of tickers (or [symbol, currency])
+
+    Returns:
+        dict -- tickers as keys and Cache.ContractInfo as values
+        dict -- tickers as keys and errors as values (if any occured)
+    """
+    resolved = {}
+    missing = []
+    for ticker in tickers:
+        symbol, currency = ticker if type(ticker) is list else (ticker, 'USD')
+        info = None
+        if app.contract_cache is not None:
+            info = app.contract_cache.get(symbol, 'STK', currency)
+        if info is None:
+            missing.append((symbol, currency))
+        else:
+            resolved[symbol] = info
+
+    q = ib.DataQueue(app.data_event)
+    for symbol, currency in missing:
+        print('Contract Req: ' + str(symbol))
+        fut = app.resolveContractFuture(symbol, 'STK', currency)
+        fut.add_done_callback(app.queueResult(q))
+
+    ticker_data, issue_tickers = processQueue(q, missing, app)
+    resolved.update(ticker_data)
+    return resolved, issue_tickers
+
+
 def getPriceData(app, tickers):
     """ Get Price Data
 
     Gets price data for a given list of tickers
-    Tries to do max requests per sec w/o causing any errors
+    Requests go out as fast as app.scheduler allows w/o causing any errors
 
     Arguments:
         app {ib.App} -- ib App object
@@ -480,60 +656,71 @@ def getPriceData(app, tickers):
         dict -- tickers as keys and xml fundamental data as values
         dict -- tickers as keys and errors as values (if any occured)
     """
-    # Max number of requests that can be made per second for reqmktdata = 100
-    tickers_chunked = chunkTickers(tickers, 100)
-
-    # Request price data for all symbols
-    for chunk in tickers_chunked:
-        for ticker in chunk:
-            print('Price Data Req: ' + str(ticker))
-            contract = app.createContract(
-                ticker, "STK", "USD", "SMART", "ISLAND")
-            app.getPrice(contract)
-        time.sleep(1)
+    # Request price data for all symbols, app.scheduler paces
+    # the requests to IB's reqMktData limit
+    for ticker in tickers:
+        print('Price Data Req: ' + str(ticker))
+        contract = app.createContract(
+            ticker, "STK", "USD", "SMART", "ISLAND")
+        app.getPrice(contract)
 
     # Process Price data
-    ticker_data, issue_tickers = processQueue(
-        app.price_queue, tickers, app, q2=app.close_price_queue)
+    ticker_data, issue_tickers = processQueue(app.price_queue, tickers, app)
     return ticker_data, issue_tickers
 
 
-def getFundamentalData(app, tickers):
+def getFundamentalData(app, tickers, parser=None):
     """ Get Fundamental Data
 
     Gets fundamental data for a given list of tickers
-    Tries to do max requests per sec w/o causing any errors
+    Reports still fresh in app.fund_cache (if set) are used as is, the
+    rest are requested from IB and stored back in the cache
+    app.scheduler paces the requests to IB's fundamental data limit
     If we face a pacing error, we try to slow down and attempt
     to try again since these are not real errors and can most
     of the time be resolved
+    If a parser is given, each report is submitted to it as soon as we
+    have it so parsing overlaps with waiting on IB for the rest
 
     Arguments:
         app {ib.App} -- ib App object
         tickers {list} -- list of strings of tickers
+        parser {Financials.ParsePool} -- (optional) pool to parse the reports on
 
     Returns:
         dict -- tickers as keys and xml fundamental data as values
         dict -- tickers as keys and errors as values (if any occured)
     """
-    # 2 req/s seem to avoid pacing errors
-    tickers_chunked = chunkTickers(tickers, 2)
-
-    # Request fundamental data
-    for chunk in tickers_chunked:
-        if app.slowdown:
-            print('Taking 10 second nap to hoepfully fix pacing violation')
-            time.sleep(10)
-            app.slowdown = False
-        for ticker in chunk:
-            print('Fundamental Data Req: ' + str(ticker))
-            contract = app.createContract(
-                ticker, "STK", "USD", "SMART", "ISLAND")
-            app.getFinStatements(contract, "ReportsFinStatements")
-        time.sleep(1)
+    report_type = "ReportsFinStatements"
+    cache = app.fund_cache
+    contracts = {}
+    cached_data = {}
+    to_request = []
+    on_data = parser.submit if parser is not None else None
+    for ticker in tickers:
+        contract = app.createContract(
+            ticker, "STK", "USD", "SMART", "ISLAND")
+        contracts[contract.symbol] = contract
+        data = cache.get(contract, report_type) if cache is not None else None
+        if data is not None:
+            cached_data[contract.symbol] = data
+            if parser is not None:
+                parser.submit(contract.symbol, data)
+        else:
+            to_request.append(contract)
+    if cache is not None:
+        print('Fundamental Data from cache: %s, requesting: %s' %
+              (len(cached_data), len(to_request)))
+
+    # Request fundamental data, app.scheduler paces the requests
+    for contract in to_request:
+        checkPacing(app, 'reqFundamentalData')
+        print('Fundamental Data Req: ' + contract.symbol)
+        app.getFinStatements(contract, report_type)
 
     # Process Fundamental data
     fund_ticker_data, data_issue_tickers = processQueue(
-        app.fundamental_data_q, tickers, app)
+        app.fundamental_data_q, [c.symbol for c in to_request], app, on_data=on_data)
 
     # Re-request fundamental data for any tickers that gave
     # us a pacing error
@@ -543,20 +730,12 @@ def getFundamentalData(app, tickers):
             try_agains.append(key)
     if try_agains:
         print('Retrying some tickers due to pacing violations')
-        tickers_chunked = chunkTickers(try_agains, 2)
-        for chunk in tickers_chunked:
-            if app.slowdown:
-                print('Taking 10 second nap to hoepfully fix pacing violation')
-                time.sleep(10)
-                app.slowdown = False
-            for ticker in chunk:
-                print(ticker)
-                contract = app.createContract(
-                    ticker, "STK", "USD", "SMART", "ISLAND")
-                app.getFinStatements(contract, "ReportsFinStatements")
-            time.sleep(1)
+        for ticker in try_agains:
+            checkPacing(app, 'reqFundamentalData')
+            print(ticker)
+            app.getFinStatements(contracts[ticker], report_type)
         try_again_data, try_again_issues = processQueue(
-            app.fundamental_data_q, try_agains, app)
+            app.fundamental_data_q, try_agains, app, on_data=on_data)
 
         # Update our two lists
         for key, val in try_again_data.items():
@@ -565,6 +744,20 @@ def getFundamentalData(app, tickers):
         for key, val in try_again_issues.items():
             if val != data_issue_tickers[key]:
                 data_issue_tickers[key] = val
+
+    if cache is not None:
+        for key, val in fund_ticker_data.items():
+            cache.put(contracts[key], report_type, val)
+        # Rather use an old report than nothing if IB didn't give us one
+        for key in list(data_issue_tickers):
+            data = cache.get(contracts[key], report_type, stale=True)
+            if data is not None:
+                print('Using stale cached Fundamental Data for: ' + key)
+                fund_ticker_data[key] = data
+                if parser is not None:
+                    parser.submit(key, data)
+                del data_issue_tickers[key]
+    fund_ticker_data.update(cached_data)
     return fund_ticker_data, data_issue_tickers
 
 
@@ -572,7 +765,7 @@ def getHistData(app, tickers, duration):
     """Get Historical Data
 
     Gets historical data for a given list of tickers
-    Tries to do max requests per sec w/o causing any errors
+    Paced by app.scheduler to stay under the reqHistoricalData limit
     Duration should match format of IB.reqHistoricalData
 
     Arguments:
@@ -584,39 +777,34 @@ def getHistData(app, tickers, duration):
         dict -- tickers as keys and dataframe of hist data as values
         dict -- tickers as keys and errors as values (if any occured)
     """
-    # Max number of requests that can be made per second for reqHistoricalData = 50
-    # Doing 40/sec just to be safe
-    tickers_chunked = chunkTickers(tickers, 40)
-
-    # Request price data for all symbols
-    for chunk in tickers_chunked:
-        for ticker in chunk:
-            print('Hist Data Req: ' + str(ticker))
-            contract = app.createContract(
-                ticker, "STK", "USD", "SMART", "ISLAND")
-            app.getHistoricalData(contract, duration)
-        time.sleep(1)
+    # Request historical data for all symbols, app.scheduler paces
+    # the requests to IB's reqHistoricalData limit
+    for ticker in tickers:
+        checkPacing(app, 'reqHistoricalData')
+        print('Hist Data Req: ' + str(ticker))
+        contract = app.createContract(
+            ticker, "STK", "USD", "SMART", "ISLAND")
+        app.getHistoricalData(contract, duration)
 
     # Process Price data
     ticker_data, issue_tickers = processQueue(app.hist_data_q, tickers, app)
     return ticker_data, issue_tickers
 
 
-def chunkTickers(tickers, n):
-    """ Chunk Tickers
+def checkPacing(app, endpoint):
+    """ Check Pacing
 
-    Given a list tickers, split into sublists of length n
-    This is used as different IB functions can only take
-    so many request per second before throwing an error
+    If IB reported a pacing violation, back off the endpoint for
+    10 seconds before sending any more requests to it
 
     Arguments:
-        tickers {list} -- list of str of tickers
-        n {int} -- how long each sublist should be
-
-    Returns:
-        list -- list of sublists containing tickers
+        app {ib.App} -- ib App object
+        endpoint {str} -- name of the IB request e.g. 'reqFundamentalData'
     """
-    return [tickers[i * n:(i + 1) * n] for i in range((len(tickers) + n - 1) // n)]
+    if app.slowdown:
+        print('Taking 10 second nap to hopefully fix pacing violation')
+        app.scheduler.pause(endpoint, 10)
+        app.slowdown = False
 
 
 def loadTickers(ticker_file):
@@ -646,7 +834,18 @@ def loadTickers(ticker_file):
 
 
 def main(args):
-    app = ib.App("127.0.0.1", args.port, clientId=1)
+    if args.clients > 1:
+        app = ib.AppPool("127.0.0.1", args.port, clientId=1, size=args.clients)
+    else:
+        app = ib.App("127.0.0.1", args.port, clientId=1)
+    app.data_timeout = args.timeout
+    app.parse_workers = args.workers
+    if not args.no_cache:
+        app.fund_cache = Cache.FundamentalCache(args.cache)
+        app.bar_cache = Cache.BarCache(args.cache)
+        app.contract_cache = Cache.ContractCache(args.cache)
+    if args.stream:
+        app.market_data = MarketData.MarketDataManager(app, args.stream)
     print("serverVersion:%s connectionTime:%s" % (app.client.serverVersion(),
                                                   app.client.twsConnectionTime()))
     account = app.getAccounts()
@@ -667,9 +866,15 @@ def main(args):
     elif args.ticker:
         tickers = [args.ticker]
 
+    if args.resolve and tickers:
+        if app.contract_cache is None:
+            app.contract_cache = Cache.ContractCache(':memory:')
+        resolved, issues = resolveContracts(app, tickers)
+        print('Resolved %d contracts, %d failed' % (len(resolved), len(issues)))
+
     if args.moving_avg:
         print('Performing Moving Avg Cross')
-        movingAvgCross(app, positions, orders, tickers, args.buy)
+        movingAvgCross(app, positions, orders, tickers, args.buy, args.ma_state)
         print("Completed MA Cross Daily Calculations")
 
     if args.factor:
@@ -693,7 +898,7 @@ def main(args):
 
     if args.ratios:
         print('Calculating Ratios')
-        ratios(app, tickers, args.output)
+        ratios(app, tickers, args.output, args.all_periods)
         print('Calculating Ratios Completed')
 
     if args.factor_alpha:
@@ -723,6 +928,8 @@ def main(args):
     print("Time")
     print(time.time()-start)
     print('Shutting down!')
+    if app.market_data is not None:
+        app.market_data.close()
     app.client.disconnect()
 
 
@@ -757,4 +964,31 @@ if __name__ == '__main__':
     parser.add_argument('--test', action='store_true')
     parser.add_argument(
         '--output', help='Output file to save to', default=None)
+    parser.add_argument(
+        '--all_periods', help='Show every annual and interim period of the financials (for Ratios)',
+        action='store_true')
+    parser.add_argument(
+        '--cache', help='SQLite file caching fundamental data and historical bars (default=data/cache.db)',
+        default='data/cache.db')
+    parser.add_argument(
+        '--no_cache', help='Always request fundamental and historical data from IB', action='store_true')
+    parser.add_argument(
+        '--timeout', help='Seconds to wait for IB to answer a batch of requests (default: no limit)',
+        default=None, type=float)
+    parser.add_argument(
+        '--ma_state', help='JSON file keeping moving averages between runs (default=data/ma_state.json)',
+        default='data/ma_state.json')
+    parser.add_argument(
+        '--workers', help='Processes parsing fundamental data (default: one per cpu, 0 parses in this process)',
+        default=None, type=int)
+    parser.add_argument(
+        '--clients', help='Connections to TWS, with clientIds 1 to CLIENTS, to spread requests over (default=1)',
+        default=1, type=int)
+    parser.add_argument(
+        '--resolve', help='Look up the IB contract of every ticker first (kept in --cache for 30 days) '
+        'so requests go out by conId', action='store_true')
+    parser.add_argument(
+        '--stream', help='Get prices from streaming market data, keeping up to STREAM subscriptions '
+        '(default=%d, your market data lines) open instead of requesting snapshots' % MarketData.MAX_LINES,
+        nargs='?', const=MarketData.MAX_LINES, default=None, type=int)
     main(parser.parse_args())
@@ -0,0 +1,97 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import json
+
+import Algorithms
+import numpy
+import pandas
+import pytest
+
+
+class Test_CompositeValueRank(object):
+    @pytest.fixture
+    def df(self):
+        rng = numpy.random.RandomState(0)
+        df = pandas.DataFrame({'Symbol': ['T%s' % i for i in range(250)]})
+        for factor in Algorithms.VALUE_FACTORS:
+            df[factor] = pandas.Series([None if rng.rand() < .2 else rng.rand() * 30
+                                        for _ in range(250)], dtype=object)
+        return df
+
+    def test_scores(self, df):
+        ranked = Algorithms.compositeValueRank(df.copy())
+        for factor in Algorithms.VALUE_FACTORS:
+            good = df[df[factor].notnull()]
+            buckets = pandas.qcut(good[factor], 100, labels=False)
+            for i in df.index:
+                expected = 50 if i not in good.index else 100 - buckets[i]
+                assert ranked.at[i, factor + ' Score'] == expected
+        scores = ranked[[f + ' Score' for f in Algorithms.VALUE_FACTORS]]
+        assert (ranked['Value Score'] == scores.sum(axis=1) / 4).all()
+        assert ranked['Value Score'].is_monotonic_decreasing
+
+    def test_weights(self, df):
+        ranked = Algorithms.compositeValueRank(df.copy(), factors=['P/E', 'EV/S'], weights=[3, 1])
+        assert 'EV/EBITDA Score' not in ranked
+        expected = (3 * ranked['P/E Score'] + ranked['EV/S Score']) / 4.0
+        assert (ranked['Value Score'] == expected).all()
+        with pytest.raises(ValueError):
+            Algorithms.compositeValueRank(df.copy(), factors=['P/E'], weights=[1, 2])
+
+    def test_all_missing(self, df):
+        df['P/E'] = None
+        ranked = Algorithms.compositeValueRank(df)
+        assert (ranked['P/E Score'] == 50).all()
+
+
+class Test_MovingAverageCross(object):
+    @pytest.fixture
+    def bars(self):
+        rng = numpy.random.RandomState(0)
+        prices = 100 + numpy.cumsum(rng.randn(600))
+        dates = ['%08d' % (20100101 + i) for i in range(600)]
+        return dates, prices
+
+    def test_matches_rolling(self, bars):
+        dates, prices = bars
+        ma = Algorithms.MovingAverageCross()
+        for i, (date, price) in enumerate(zip(dates, prices)):
+            ma.update(date, price)
+            if i in (10, 199, 300, 599):
+                df = pandas.DataFrame({'price': prices[:i + 1]})
+                assert ma.isGolden() == Algorithms.movingAvgCross(df)
+        assert ma.longMA() == pytest.approx(prices[-200:].mean())
+        assert ma.shortMA() == pytest.approx(prices[-50:].mean())
+
+    def test_events(self, bars):
+        dates, prices = bars
+        ma = Algorithms.MovingAverageCross()
+        events = [(i, ma.update(d, p)) for i, (d, p) in enumerate(zip(dates, prices))]
+        events = [(i, e) for i, e in events if e]
+        assert events
+        for i, event in events:
+            df = pandas.DataFrame({'price': prices[:i + 1]})
+            assert Algorithms.movingAvgCross(df) == (event == 'golden')
+            assert Algorithms.movingAvgCross(df[:-1]) == (event == 'death')
+
+    def test_same_and_old_bars(self, bars):
+        dates, prices = bars
+        ma = Algorithms.MovingAverageCross(short=2, long=3)
+        for date, price in zip(dates[:3], [1, 2, 3]):
+            ma.update(date, price)
+        ma.update(dates[2], 6)  # revised last bar
+        ma.update(dates[0], 100)  # old bar is ignored
+        assert list(ma.prices) == [1, 2, 6]
+        assert ma.shortMA() == 4
+        assert ma.longMA() == 3
+
+    def test_serialize(self, bars):
+        dates, prices = bars
+        ma = Algorithms.MovingAverageCross()
+        for date, price in zip(dates[:400], prices[:400]):
+            ma.update(date, price)
+        restored = Algorithms.MovingAverageCross.from_dict(json.loads(json.dumps(ma.to_dict())))
+        for date, price in zip(dates[400:], prices[400:]):
+            assert restored.update(date, price) == ma.update(date, price)
+        assert restored.longMA() == pytest.approx(ma.longMA())
+        assert restored.last_date == dates[-1]
@@ -0,0 +1,239 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import datetime
+import math
+
+import Black_Scholes as bs
+import numpy
+import pandas
+import pytest
+import scipy.stats
+
+
+def scalarCall(stock_price, strike, vol, years, rate, div):
+    d1 = (math.log(stock_price/strike) + (rate - div + vol**2/2) * years) / (vol * years**.5)
+    d2 = d1 - vol * years**.5
+    return (stock_price * math.exp(-div*years) * scipy.stats.norm.cdf(d1) -
+            strike * math.exp(-rate*years) * scipy.stats.norm.cdf(d2))
+
+
+def scalarWarrant(stock_price, strike, vol, years, rate, div, shares_out, warrants_out,
+                  warrants_per_share):
+    '''
+    The scalar fixed point loop price_warrants replaced
+    '''
+    call_price = scalarCall(stock_price, strike, vol, years, rate, div)
+    if shares_out is None:
+        return call_price/warrants_per_share
+    count = warrants_out/warrants_per_share
+    while True:
+        last = call_price
+        adj = (stock_price*shares_out + count*call_price)/(shares_out + count)
+        call_price = scalarCall(adj, strike, vol, years, rate, div)
+        if round(call_price, 2) == round(last, 2):
+            return call_price
+
+
+class Test_PriceEuroCalls(object):
+    def test_textbook(self):
+        # Hull: S=100, K=100, r=5%, vol=20%, 1 year
+        assert bs.price_euro_calls(100, 100, .2, 1, .05, 0) == pytest.approx(10.4506, abs=1e-4)
+
+    def test_broadcast(self):
+        vols = numpy.array([.2, .3, .5])[:, None]
+        strikes = numpy.array([80., 100., 120.])[None, :]
+        grid = bs.price_euro_calls(100, strikes, vols, 2, .03, .01)
+        assert grid.shape == (3, 3)
+        for i, vol in enumerate([.2, .3, .5]):
+            for j, strike in enumerate([80., 100., 120.]):
+                assert grid[i, j] == bs.price_euro_calls(100, strike, vol, 2, .03, .01)
+        # Higher vol is worth more, higher strike less
+        assert (numpy.diff(grid, axis=0) > 0).all()
+        assert (numpy.diff(grid, axis=1) < 0).all()
+
+    def test_expired(self):
+        prices = bs.price_euro_calls(10, numpy.array([8., 12.]), .3, 0, .03, 0)
+        assert list(prices) == [2., 0.]
+
+
+class Test_PriceWarrants(object):
+    @pytest.fixture
+    def expiry(self):
+        return (datetime.date.today() + datetime.timedelta(days=900)).strftime('%m-%d-%Y')
+
+    @pytest.mark.parametrize('shares_out,warrants_out', [(None, None), (30, 4), (100, 40)])
+    @pytest.mark.parametrize('warrants_per_share', [1, 2])
+    def test_matches_scalar(self, expiry, shares_out, warrants_out, warrants_per_share):
+        vols = [.2, .35, .6]
+        years = bs.years_until(expiry)
+        grid = bs.price_warrants(12., numpy.array([7.5, 11.5, 20.])[None, :],
+                                 numpy.array(vols)[:, None], years, .03, .02,
+                                 shares_out, warrants_out, warrants_per_share)
+        for i, vol in enumerate(vols):
+            for j, strike in enumerate([7.5, 11.5, 20.]):
+                expected = scalarWarrant(12., strike, vol, years, .03, .02, shares_out,
+                                         warrants_out, warrants_per_share)
+                if shares_out is None:
+                    assert grid[i, j] == pytest.approx(expected, rel=1e-12)
+                else:
+                    # The scalar loop stops once the price repeats to the cent
+                    assert grid[i, j] == pytest.approx(expected, abs=.005)
+                assert bs.BlackScholes(strike, 12., .03, vol, expiry, .02, shares_out, warrants_out,
+                                       warrants_per_share).price_euro_call() == grid[i, j]
+
+    def test_dilution_lowers_value(self, expiry):
+        years = bs.years_until(expiry)
+        assert bs.price_warrants(12., 10., .4, years, .03, 0, 30, 10) < \
+            bs.price_warrants(12., 10., .4, years, .03, 0)
+
+    def test_solve_dilution(self, expiry):
+        years = bs.years_until(expiry)
+        vols = numpy.linspace(.1, 1, 10)[:, None]
+        strikes = numpy.linspace(2, 30, 15)[None, :]
+        prices, converged = bs.solve_dilution(12., strikes, vols, years, .03, .01, 30, 12, 2)
+        assert prices.shape == converged.shape == (10, 15)
+        assert converged.all()
+        # Fixed point: the warrant is worth a call on the diluted stock price
+        k = 12 / 2.
+        adj_stock_price = (12. * 30 + k * prices) / (30 + k)
+        residual = prices - bs.price_euro_calls(adj_stock_price, strikes, vols, years, .03, .01)
+        assert numpy.abs(residual).max() < 1e-9
+
+    def test_not_converged(self, expiry):
+        years = bs.years_until(expiry)
+        prices, converged = bs.solve_dilution(12., numpy.array([10., 11.]), .4, years, .03, 0,
+                                              30, 10, max_iter=1)
+        assert not converged.any()
+        assert (prices > 0).all()
+
+
+class Test_ImpliedVols(object):
+    @pytest.fixture
+    def contracts(self):
+        rng = numpy.random.RandomState(0)
+        n = 2000
+        stock = rng.uniform(5, 50, n)
+        return stock, stock * rng.uniform(.7, 1.3, n), rng.uniform(.5, 5, n), rng.uniform(.1, 1.5, n)
+
+    @pytest.mark.parametrize('shares_out,warrants_out', [(None, None), (30., 6.)])
+    def test_round_trip(self, contracts, shares_out, warrants_out):
+        stock, strikes, years, vols = contracts
+        prices = bs.price_warrants(stock, strikes, vols, years, .03, .01, shares_out, warrants_out, 2)
+        implied, converged = bs.implied_vols(prices, stock, strikes, years, .03, .01,
+                                             shares_out, warrants_out, 2)
+        assert converged.all()
+        numpy.testing.assert_allclose(implied, vols, atol=1e-5)
+
+    def test_unsolvable(self):
+        # Below intrinsic value, above the stock price, and no price at all
+        prices = numpy.array([1., 10.5, numpy.nan, 3.])
+        implied, converged = bs.implied_vols(prices, 10., numpy.array([8., 8., 8., 8.]), 2, .03, 0)
+        assert numpy.isnan(implied[:3]).all()
+        assert not converged[:3].any()
+        assert converged[3]
+        assert bs.price_euro_calls(10., 8., implied[3], 2, .03, 0) == pytest.approx(3.)
+
+    def test_scalar(self):
+        price = bs.price_euro_calls(100, 100, .25, 1, .05, 0)
+        vol, converged = bs.implied_vols(price, 100, 100, 1, .05, 0)
+        assert converged
+        assert vol == pytest.approx(.25)
+
+
+class Test_Greeks(object):
+    def finiteDifferences(self, price, stock_price, vol, years, rate, h=1e-4):
+        return {'delta': (price(stock_price + h, vol, years, rate) -
+                          price(stock_price - h, vol, years, rate))/(2*h),
+                'gamma': (price(stock_price + h, vol, years, rate) - 2*price(stock_price, vol, years, rate) +
+                          price(stock_price - h, vol, years, rate))/h**2,
+                'vega': (price(stock_price, vol + h, years, rate) -
+                         price(stock_price, vol - h, years, rate))/(2*h),
+                'theta': -(price(stock_price, vol, years + h, rate) -
+                           price(stock_price, vol, years - h, rate))/(2*h),
+                'rho': (price(stock_price, vol, years, rate + h) -
+                        price(stock_price, vol, years, rate - h))/(2*h)}
+
+    def test_textbook(self):
+        # Hull: S=49, K=50, r=5%, vol=20%, 20 weeks
+        greeks = bs.call_greeks(49, 50, .2, .3846, .05, 0)
+        assert greeks['delta'] == pytest.approx(.522, abs=1e-3)
+        assert greeks['gamma'] == pytest.approx(.066, abs=1e-3)
+        assert greeks['vega'] == pytest.approx(12.1, abs=.1)
+        assert greeks['theta'] == pytest.approx(-4.31, abs=.01)
+        assert greeks['rho'] == pytest.approx(8.91, abs=.01)
+
+    @pytest.mark.parametrize('shares_out,warrants_out', [(None, None), (30., 6.), (10., 8.)])
+    def test_finite_differences(self, shares_out, warrants_out):
+        def price(stock_price, vol, years, rate):
+            return bs.solve_dilution(stock_price, strike, vol, years, rate, .01, shares_out,
+                                     warrants_out, 2, tol=1e-14)[0] if shares_out else \
+                bs.price_euro_calls(stock_price, strike, vol, years, rate, .01)/2
+        strike = numpy.array([6., 10., 15.])
+        greeks = bs.warrant_greeks(10., strike, .4, 2., .03, .01, shares_out, warrants_out, 2)
+        assert greeks['converged'].all()
+        assert greeks['price'] == pytest.approx(price(10., .4, 2., .03))
+        expected = self.finiteDifferences(price, 10., .4, 2., .03)
+        for name, value in expected.items():
+            tol = 1e-3 if name == 'gamma' else 1e-6
+            numpy.testing.assert_allclose(greeks[name], value, rtol=tol, err_msg=name)
+
+    def test_expired(self):
+        greeks = bs.call_greeks(10, numpy.array([8., 12.]), .3, 0, .03, 0)
+        assert list(greeks['delta']) == [1., 0.]
+        for name in ('gamma', 'vega', 'theta', 'rho'):
+            assert list(greeks[name]) == [0., 0.]
+
+    def test_class(self):
+        expiry = (datetime.date.today() + datetime.timedelta(days=900)).strftime('%m-%d-%Y')
+        greeks = bs.BlackScholes(10., 12., .03, .4, expiry, .02, 30, 4).greeks()
+        assert greeks['converged'] is True
+        assert 0 < greeks['delta'] < 1
+        assert greeks['price'] == bs.BlackScholes(10., 12., .03, .4, expiry, .02, 30, 4).price_euro_call()
+
+
+class Test_Batch(object):
+    @pytest.fixture
+    def contracts(self):
+        return pandas.DataFrame({'strike': [10., 11.5, 20., 7.5],
+                                 'stock': [12., 12., 12., 8.],
+                                 'vol': [.4, .3, .6, .5],
+                                 'date': ['01-15-2030', '01-15-2030', '06-15-2031', '01-15-2030'],
+                                 'shares_out': [30., None, 100., None],
+                                 'warrants_out': [4., None, 40., None],
+                                 'warrants_per_share': [1., 2., 1., None]})
+
+    def test_matches_class(self, contracts):
+        priced = bs.price_batch(contracts, {'risk': .03, 'div': .02}, greeks=True)
+        assert list(priced.columns[-6:]) == ['price'] + bs.GREEKS
+        for row in priced.itertuples():
+            shares_out = None if numpy.isnan(row.shares_out) else row.shares_out
+            warrants_out = None if numpy.isnan(row.warrants_out) else row.warrants_out
+            greeks = bs.BlackScholes(row.strike, row.stock, .03, row.vol, row.date, .02, shares_out,
+                                     warrants_out, row.warrants_per_share).greeks()
+            for name in ['price'] + bs.GREEKS:
+                assert getattr(row, name) == pytest.approx(greeks[name], rel=1e-9)
+
+    def test_missing_column(self, contracts):
+        with pytest.raises(ValueError):
+            bs.price_batch(contracts, {'div': .02})
+
+    def test_years_per_expiry(self, contracts, monkeypatch):
+        calls = []
+        years_until = bs.years_until
+        monkeypatch.setattr(bs, 'years_until', lambda *a: calls.append(a[0]) or years_until(*a))
+        year_cache = {}
+        bs.price_batch(contracts, {'risk': .03, 'div': .02}, year_cache=year_cache)
+        bs.price_batch(contracts, {'risk': .03, 'div': .02}, year_cache=year_cache)
+        assert sorted(calls) == ['01-15-2030', '06-15-2031']
+
+    def test_streams_csv(self, contracts, tmpdir):
+        path, out = str(tmpdir.join('contracts.csv')), str(tmpdir.join('priced.csv'))
+        contracts.assign(risk=.03, div=.02).to_csv(path, index=False)
+        args = argparse.Namespace(batch=path, out=out, chunksize=3, greeks=False,
+                                  **{name: None for name in bs.BATCH_COLUMNS})
+        bs.batch(args)
+        priced = pandas.read_csv(out)
+        assert len(priced) == 4
+        expected = bs.price_batch(contracts, {'risk': .03, 'div': .02})['price']
+        numpy.testing.assert_allclose(priced['price'], expected, rtol=1e-12)
@@ -0,0 +1,133 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import datetime
+import Cache
+from ibapi.contract import Contract
+import pandas
+import pytest
+
+
+def report(modified, body='x'):
+    return ('<ReportFinancialStatements><CoGeneralInfo><LastModified>%s</LastModified>'
+            '</CoGeneralInfo>%s</ReportFinancialStatements>' % (modified, body))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Test_FundamentalCache(object):
+    @pytest.fixture
+    def setup(self):
+        clock = FakeClock()
+        cache = Cache.FundamentalCache(':memory:', ttl=100, clock=clock)
+        contract = Contract()
+        contract.symbol = 'AAPL'
+        contract.secType = 'STK'
+        contract.currency = 'USD'
+        return cache, contract, clock
+
+    def test_lastModified(self):
+        assert Cache.lastModified(report('2018-09-26')) == '2018-09-26'
+        assert Cache.lastModified('<xml/>') is None
+
+    def test_get_put(self, setup):
+        cache, contract, clock = setup
+        assert cache.get(contract, 'ReportsFinStatements') is None
+        cache.put(contract, 'ReportsFinStatements', report('2018-09-26'))
+        assert cache.get(contract, 'ReportsFinStatements') == report('2018-09-26')
+        assert cache.get(contract, 'ReportSnapshot') is None
+
+    def test_ttl(self, setup):
+        cache, contract, clock = setup
+        cache.put(contract, 'ReportsFinStatements', report('2018-09-26'))
+        clock.now += 101
+        assert cache.get(contract, 'ReportsFinStatements') is None
+        assert cache.get(contract, 'ReportsFinStatements', stale=True) == report('2018-09-26')
+
+    def test_revalidate(self, setup):
+        cache, contract, clock = setup
+        cache.put(contract, 'ReportsFinStatements', report('2018-09-26', 'old'))
+        clock.now += 101
+        # Same LastModified, keep what we have but it is fresh again
+        cache.put(contract, 'ReportsFinStatements', report('2018-09-26', 'new'))
+        assert cache.get(contract, 'ReportsFinStatements') == report('2018-09-26', 'old')
+        cache.put(contract, 'ReportsFinStatements', report('2018-12-26', 'new'))
+        assert cache.get(contract, 'ReportsFinStatements') == report('2018-12-26', 'new')
+
+    def test_evict(self, setup):
+        cache, contract, clock = setup
+        data = report('2018-09-26')
+        cache.max_bytes = 2 * len(data)
+        for symbol in ['A', 'B', 'C']:
+            contract.symbol = symbol
+            cache.put(contract, 'ReportsFinStatements', data)
+            clock.now += 1
+        assert cache.size() == 2 * len(data)
+        contract.symbol = 'A'
+        assert cache.get(contract, 'ReportsFinStatements') is None
+        contract.symbol = 'C'
+        assert cache.get(contract, 'ReportsFinStatements') == data
+
+
+class Test_BarCache(object):
+    @pytest.fixture
+    def setup(self):
+        clock = FakeClock()
+        cache = Cache.BarCache(':memory:', ttl=100, clock=clock)
+        contract = Contract()
+        contract.symbol = 'AAPL'
+        contract.secType = 'STK'
+        contract.currency = 'USD'
+        return cache, contract, clock
+
+    def test_durations(self):
+        today = datetime.date(2019, 3, 15)
+        assert Cache.durationStart('1 Y', today) == '20180315'
+        assert Cache.durationStart('2 W', today) == '20190301'
+        assert Cache.gapDuration('20190311', today) == '5 D'
+        assert Cache.gapDuration('20190315', today) == '1 D'
+        assert Cache.gapDuration('20170101', today) is None
+
+    def test_put_get(self, setup):
+        cache, contract, clock = setup
+        assert cache.series(contract, '1 day', 'MIDPOINT') is None
+        cache.put(contract, '1 day', 'MIDPOINT',
+                  pandas.DataFrame({'date': ['20190312', '20190311', '20190313'],
+                                    'price': [2., 1., 3.]}), covered_from='20190301')
+        series = cache.series(contract, '1 day', 'MIDPOINT')
+        assert series == ('20190301', '20190311', '20190313', 1000.0)
+        assert cache.fresh(series)
+        df = cache.get(contract, '1 day', 'MIDPOINT', '20190312')
+        assert list(df['date']) == ['20190312', '20190313']
+        assert list(df['price']) == [2., 3.]
+        assert cache.get(contract, '1 day', 'TRADES').empty
+        clock.now += 101
+        assert not cache.fresh(cache.series(contract, '1 day', 'MIDPOINT'))
+
+    def test_merge(self, setup):
+        cache, contract, clock = setup
+        cache.put(contract, '1 day', 'MIDPOINT',
+                  pandas.DataFrame({'date': ['20190311', '20190312'], 'price': [1., 2.]}),
+                  covered_from='20190301')
+        # The last bar was still forming, the gap request replaces it
+        cache.put(contract, '1 day', 'MIDPOINT',
+                  pandas.DataFrame({'date': ['20190312', '20190313'], 'price': [2.5, 3.]}))
+        assert list(cache.get(contract, '1 day', 'MIDPOINT')['price']) == [1., 2.5, 3.]
+        assert cache.series(contract, '1 day', 'MIDPOINT').covered_from == '20190301'
+
+
+class Test_ContractCache(object):
+    def test_get_put(self):
+        clock = FakeClock()
+        cache = Cache.ContractCache(':memory:', ttl=100, clock=clock)
+        assert cache.get('BOL', 'STK', 'EUR') is None
+        cache.put('BOL', 'STK', 'EUR', 1234, 'SBF')
+        assert cache.get('BOL', 'STK', 'EUR') == Cache.ContractInfo(1234, 'SBF', 1000.0)
+        assert cache.get('BOL', 'STK', 'USD') is None
+        clock.now += 101
+        assert cache.get('BOL', 'STK', 'EUR') is None
@@ -0,0 +1,237 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asyncio
+import time
+
+import pandas
+
+import Cache
+import Financials
+import InteractiveBrokers as ib
+import main
+import MarketData
+import Pacing
+import pytest
+from tools import fake_tws
+
+
+TICKERS = ['T%03d' % i for i in range(200)]
+
+
+def unpaced():
+    return Pacing.Scheduler(rates={}, global_rate=10000)
+
+
+@pytest.fixture
+def tws():
+    with fake_tws.FakeTWS(latency=.001, jitter=.002, unknown=['BAD']) as tws:
+        yield tws
+
+
+@pytest.fixture
+def app(tws):
+    app = ib.App('127.0.0.1', tws.port, 1)
+    app.data_timeout = 10
+    app.scheduler = unpaced()
+    yield app
+    app.client.disconnect()
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(.005)
+
+
+class Test_FakeTWS(object):
+    def test_bars(self):
+        bars = fake_tws.bars('AAPL', '1 Y')
+        assert len(bars) == 261
+        assert bars[-1][4] == round(fake_tws.lastPrice('AAPL'), 2)
+        assert bars == fake_tws.bars('AAPL', '1 Y')
+
+    def test_price_data(self, tws, app):
+        data, issues = main.getPriceData(app, TICKERS + ['BAD'])
+        assert data == {t: fake_tws.lastPrice(t) for t in TICKERS}
+        assert list(issues) == ['BAD']
+        assert tws.requests['reqMktData'] == len(TICKERS) + 1
+
+    def test_fundamental_data(self, tws, app):
+        data, issues = main.getFundamentalData(app, TICKERS[:50])
+        assert not issues
+        assert len(data) == 50
+        reports = Financials.parseMany(data, workers=0)
+        assert all(r.quarters()[0] for r in reports.values())
+
+    def test_hist_data(self, app):
+        data, issues = main.getHistData(app, TICKERS[:20], '3 M')
+        assert not issues
+        assert all(len(df) == 64 for df in data.values())
+        df = data[TICKERS[0]]
+        bars = fake_tws.bars(TICKERS[0], '3 M')
+        assert list(df.columns) == ['date', 'price', 'open', 'high', 'low', 'close', 'volume']
+        assert list(df['date']) == [b[0] for b in bars]
+        assert df[['open', 'high', 'low', 'close', 'volume']].values.tolist() == [list(b[1:]) for b in bars]
+        assert (df['price'] == df['close']).all()
+
+    def test_bar_cache(self, tws, app):
+        app.bar_cache = Cache.BarCache(':memory:', ttl=0)
+        contract = app.createContract('AAPL', 'STK', 'USD', 'SMART', 'ISLAND')
+        full = app.getHistoricalDataFuture(contract, '1 Y').result(10)
+        assert len(full) > 250
+        # Only the last bar is requested again and merged in
+        assert app.getHistoricalDataFuture(contract, '1 Y').result(10).equals(full)
+        half = app.getHistoricalDataFuture(contract, '6 M').result(10)
+        assert half.equals(full[full['date'] >= Cache.durationStart('6 M')].reset_index(drop=True))
+        assert tws.requests['reqHistoricalData'] == 3
+        app.bar_cache.ttl = 3600
+        assert app.getHistoricalDataFuture(contract, '1 Y').result(10).equals(full)
+        assert tws.requests['reqHistoricalData'] == 3
+
+    def test_bar_cache_empty_range(self, tws, app):
+        app.bar_cache = Cache.BarCache(':memory:')
+        contract = app.createContract('AAPL', 'STK', 'USD', 'SMART', 'ISLAND')
+        old = pandas.DataFrame({'date': ['20000103'], 'price': [10.0]})
+        app.bar_cache.put(contract, ib.HIST_BAR_SIZE, ib.HIST_WHAT_TO_SHOW, old, '19000101')
+        # The series is fresh but has nothing in the last month, so IB is asked
+        df = app.getHistoricalDataFuture(contract, '1 M').result(10)
+        assert len(df) > 0 and df['date'].iloc[0] >= Cache.durationStart('1 M')
+        assert tws.requests['reqHistoricalData'] == 1
+
+    def test_resolve_contracts(self, tws, app):
+        app.contract_cache = Cache.ContractCache(':memory:')
+        resolved, issues = main.resolveContracts(app, TICKERS[:20] + [['BOL', 'EUR'], 'BAD'])
+        assert list(issues) == ['BAD']
+        assert resolved['BOL'].conId == fake_tws.conId('BOL')
+        assert all(resolved[t].conId == fake_tws.conId(t) for t in TICKERS[:20])
+        assert tws.requests['reqContractDetails'] == 22
+        # Already resolved, nothing is requested again
+        resolved, issues = main.resolveContracts(app, TICKERS[:20])
+        assert len(resolved) == 20 and not issues
+        assert tws.requests['reqContractDetails'] == 22
+        contract = app.createContract(TICKERS[0], 'STK', 'USD', 'SMART', 'ISLAND')
+        assert contract.conId == fake_tws.conId(TICKERS[0])
+        assert contract.primaryExchange == 'NASDAQ'
+        data, issues = main.getPriceData(app, TICKERS[:20])
+        assert data == {t: fake_tws.lastPrice(t) for t in TICKERS[:20]}
+
+    def test_account(self, app):
+        assert app.getAccounts() == 'DU0000000'
+        positions = app.getPositions('DU0000000')
+        assert list(positions['symbol']) == ['AAPL']
+        details = app.getContractDetails('MSFT', 'STK')
+        assert details[0].contract.conId == fake_tws.conId('MSFT')
+
+    def test_pacing_violation(self, tws, app):
+        tws.rates['reqFundamentalData'] = 10
+        contract = app.createContract('AAPL', 'STK', 'USD', 'SMART', 'ISLAND')
+        futures = [app.getFinStatementsFuture(contract, 'ReportsFinStatements')
+                   for _ in range(20)]
+        errors = [f.exception(timeout=10) for f in futures]
+        failed = [e for e in errors if e is not None]
+        assert len(failed) == tws.pacing_violations['reqFundamentalData'] == 10
+        assert all('pacing violation' in e.errorString for e in failed)
+        assert app.slowdown
+
+    def test_async_app(self, tws):
+        async def prices():
+            app = await ib.AsyncApp.create('127.0.0.1', tws.port, 1)
+            app.scheduler = unpaced()
+            contracts = [app.createContract(t, 'STK', 'USD', 'SMART', 'ISLAND') for t in TICKERS]
+            result = await asyncio.gather(*[app.getPrice(c) for c in contracts])
+            app.disconnect()
+            return result
+        assert asyncio.run(prices()) == [fake_tws.lastPrice(t) for t in TICKERS]
+
+
+class Test_AppPool(object):
+    @pytest.fixture
+    def tws(self):
+        with fake_tws.FakeTWS(latency=.001, unknown=['BAD'], rates={'reqFundamentalData': 10},
+                              tick_interval=.005, max_lines=3) as tws:
+            yield tws
+
+    @pytest.fixture
+    def pool(self, tws):
+        pool = ib.AppPool('127.0.0.1', tws.port, 1, size=3)
+        pool.data_timeout = 10
+        pool.scheduler = Pacing.SchedulerPool(3, rates={'reqFundamentalData': 10}, global_rate=10000)
+        yield pool
+        pool.client.disconnect()
+
+    def test_clients(self, tws, monkeypatch):
+        built = []
+
+        class Client(ib.Client):
+            def __init__(self, wrapper):
+                super().__init__(wrapper)
+                built.append(self)
+        monkeypatch.setattr(ib, 'Client', Client)
+        pool = ib.AppPool('127.0.0.1', tws.port, 1, size=3)
+        # One client per connection and no spare one from App.setup
+        assert built == pool.client.clients
+        assert [c.clientId for c in built] == [1, 2, 3]
+        pool.client.disconnect()
+
+    def test_spreads_by_budget(self, tws, pool):
+        # 10 per second per connection, so 30 go out at once without violations
+        data, issues = main.getFundamentalData(pool, TICKERS[:30])
+        assert len(data) == 30 and not issues
+        assert not tws.pacing_violations
+        assert tws.client_requests == {1: 10, 2: 10, 3: 10}
+
+    def test_requests(self, tws, pool):
+        data, issues = main.getPriceData(pool, TICKERS[:30] + ['BAD'])
+        assert data == {t: fake_tws.lastPrice(t) for t in TICKERS[:30]}
+        assert list(issues) == ['BAD']
+        data, issues = main.getHistData(pool, TICKERS[:30], '3 M')
+        assert len(data) == 30 and not issues
+        assert pool.getAccounts() == 'DU0000000'
+        assert len([c for c in tws.client_requests if c]) == 3
+        # Nothing left open, so no connections are tracked
+        assert pool.client.owners == {}
+
+    def test_cancels_follow_requests(self, tws, pool):
+        sent = []
+        for i, client in enumerate(pool.client.clients):
+            client.cancelHistoricalData = lambda reqId, i=i: sent.append((reqId, i))
+        contract = pool.createContract('AAPL', 'STK', 'USD', 'SMART', 'ISLAND')
+        reqIds = [pool.getReqId() for _ in range(6)]
+        for reqId in reqIds:
+            # keepUpToDate requests stay open until cancelled
+            pool.client.reqHistoricalData(reqId, contract, '', '1 D', '1 day', 'MIDPOINT',
+                                          1, 1, True, [])
+        owners = dict(pool.client.owners)
+        assert set(owners.values()) == {0, 1, 2}
+        for reqId in reqIds:
+            pool.client.cancelHistoricalData(reqId)
+        assert sent == [(reqId, owners[reqId]) for reqId in reqIds]
+        assert pool.client.owners == {}
+
+    def test_cancels_after_replies(self, tws, pool):
+        sent = []
+        for i, client in enumerate(pool.client.clients):
+            client.cancelFundamentalData = lambda reqId, i=i: sent.append(('fundamental', reqId, i))
+            client.cancelMktData = lambda reqId, i=i: sent.append(('mktData', reqId, i))
+        data, issues = main.getFundamentalData(pool, TICKERS[:30])
+        assert len(data) == 30 and not issues
+        assert len([c for c in tws.client_requests if c]) == 3
+        # Reports are one-off, there's nothing to cancel once they arrive
+        assert sent == []
+        # The yield subscription is cancelled on the connection it went out on
+        contract = pool.createContract('AAPL', 'STK', 'USD', 'SMART', 'ISLAND')
+        fut = pool.getYieldFuture(contract)
+        assert fut.result(5) > 0
+        waitFor(lambda: sent)
+        assert sent == [('mktData', fut.reqId, 0)]
+        assert pool.client.owners == {}
+
+    def test_streaming(self, tws, pool):
+        # Rotating 3 lines through 30 tickers
+        pool.market_data = MarketData.MarketDataManager(pool, max_lines=3)
+        data, issues = main.getPriceData(pool, TICKERS[:30])
+        assert len(data) == 30 and not issues
+        assert tws.openLines() <= 3
+        # Subscriptions and their cancels all went out on the first connection
+        assert set(pool.client.owners.values()) == {0}
@@ -0,0 +1,120 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Financials
+import numpy
+import pytest
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'data', 'sample_financialStatement.xml')
+
+
+class Test_Parse(object):
+    @pytest.fixture
+    def report(self):
+        with open(SAMPLE) as f:
+            return Financials.parse(f.read())
+
+    def test_periods(self, report):
+        assert [p.end_date for p in report.annuals] == [
+            '2018-06-30', '2017-06-30', '2016-06-30', '2015-06-30', '2014-06-30', '2013-06-30']
+        assert [p.end_date for p in report.interims] == [
+            '2018-06-30', '2018-03-31', '2017-12-31', '2017-09-30', '2017-06-30']
+        assert report.interims[1].source == '10-Q'
+        assert report.annuals[0].headers['INC']['source_date'] == '2018-09-25'
+
+    def test_quarters(self, report):
+        qtr1, qtr2, qtr3, qtr4 = report.quarters()
+        assert qtr1['total_revenue'] == 8.24056
+        assert qtr1['total_common_shares_outstanding'] == 8.28866
+        assert qtr4 is report.interims[3].items
+        assert len(report.quarters(6)) == 6
+        assert report.quarters(6)[5] is None
+
+    def test_years(self, report):
+        current_annual, prev_annual = report.years()
+        assert current_annual['diluted_eps_excluding_extraord_items'] == 0.24169
+        assert prev_annual['total_revenue'] == 25.86114
+        assert report.annuals[0].statements['INC']['RTLR'] == 28.69762
+
+    def test_records(self, report):
+        with open(SAMPLE) as f:
+            records = list(Financials.records(f.read()))
+        assert len(records) == sum(len(codes) for p in report.annuals + report.interims
+                                   for codes in p.statements.values())
+        period, statement_type, code, value = records[0]
+        assert (period.end_date, statement_type, code, value) == ('2018-06-30', 'INC', 'SREV', 28.69762)
+
+    def test_chunks(self):
+        with open(SAMPLE) as f:
+            data = f.read()
+        small = [(e, el.tag) for e, el in Financials.iterEvents(data, chunk_size=7)]
+        assert small == [(e, el.tag) for e, el in Financials.iterEvents(data)]
+
+    def test_no_data(self):
+        report = Financials.parse('<ReportFinancialStatements><FinancialStatements/>'
+                                  '</ReportFinancialStatements>')
+        assert report.quarters() == (None, None, None, None)
+        assert report.years() == (None, None)
+
+
+class Test_ParsePool(object):
+    @pytest.fixture
+    def data(self):
+        with open(SAMPLE) as f:
+            return f.read()
+
+    @pytest.mark.parametrize('workers', [0, 2])
+    def test_parseMany(self, data, workers):
+        datas = {'A%s' % i: data for i in range(5)}
+        datas['BAD'] = '<ReportFinancialStatements>'
+        reports = Financials.parseMany(datas, workers=workers, batch_size=2)
+        assert sorted(reports) == sorted(datas)
+        assert reports['A4'].years()[1]['total_revenue'] == 25.86114
+        assert reports['BAD'].years() == (None, None)
+
+    def test_submit_as_data_arrives(self, data):
+        with Financials.ParsePool(workers=0, batch_size=2) as pool:
+            pool.submit('A', data)
+            assert not pool.batches
+            pool.submit('B', data)
+            assert len(pool.batches) == 1
+            pool.submit('C', data)
+            reports = pool.results()
+        assert sorted(reports) == ['A', 'B', 'C']
+
+
+class Test_FundamentalsMatrix(object):
+    @pytest.fixture
+    def report(self):
+        with open(SAMPLE) as f:
+            return Financials.parse(f.read())
+
+    @pytest.fixture
+    def matrix(self, report):
+        return Financials.FundamentalsMatrix.fromReports({'A': report, 'EMPTY': Financials.Financials()})
+
+    def test_matches_items(self, report, matrix):
+        assert matrix.values.shape == (2, 6, len(Financials.COA_CODES))
+        for p, items in enumerate(report.quarters() + report.years()):
+            for name in Financials.ITEM_COLUMNS:
+                value = matrix.item(name)[0, p]
+                if name in items:
+                    assert value == items[name]
+                else:
+                    assert numpy.isnan(value)
+        assert numpy.isnan(matrix.row('EMPTY')).all()
+
+    def test_helpers(self, matrix):
+        assert matrix.quarter('total_revenue')[0] == 8.24056
+        assert matrix.year('total_revenue', 2)[0] == 25.86114
+        assert matrix.code('RTLR')[0, 4] == 28.69762
+        assert str(matrix.end_dates[0, 1]) == '2018-03-31'
+
+    def test_save_load(self, matrix, tmpdir):
+        path = str(tmpdir.join('fundamentals'))
+        matrix.save(path)
+        loaded = Financials.FundamentalsMatrix.load(path)
+        assert isinstance(loaded.values, numpy.memmap)
+        assert loaded.symbols == ['A', 'EMPTY']
+        numpy.testing.assert_array_equal(loaded.values, matrix.values)
+        numpy.testing.assert_array_equal(loaded.end_dates, matrix.end_dates)
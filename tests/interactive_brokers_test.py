@@ -0,0 +1,312 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import asyncio
+import queue
+import socket
+import struct
+import threading
+import time
+
+import Cache
+import InteractiveBrokers as ib
+import Pacing
+import pandas as pd
+import pytest
+from ibapi.contract import Contract
+from ibapi.wrapper import EWrapper
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeClient(object):
+    '''
+    Stands in for EClient, answering each price request from another
+    thread like EClient.run does
+    '''
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.sent = []
+
+    def reqMktData(self, reqId, contract, genericTickList, snapshot,
+                   regulatorySnapshot, mktDataOptions):
+        self.sent.append(('reqMktData', reqId))
+        if genericTickList == '258':
+            answer, args = self.wrapper.tickString, (reqId, 47, 'YIELD=2.5;')
+        else:
+            answer, args = self.wrapper.tickPrice, (reqId, 4, 10.0, None)
+        threading.Thread(target=answer, args=args).start()
+
+    def cancelMktData(self, reqId):
+        self.sent.append(('cancelMktData', reqId))
+
+    def reqMarketDataType(self, marketDataType):
+        self.sent.append(('reqMarketDataType', marketDataType))
+
+
+class AsyncFakeClient(FakeClient):
+    '''
+    FakeClient answering on the event loop, like AsyncApp's reader does
+    '''
+
+    def reqMktData(self, reqId, contract, genericTickList, snapshot,
+                   regulatorySnapshot, mktDataOptions):
+        self.sent.append(('reqMktData', reqId))
+        asyncio.get_running_loop().call_soon(self.wrapper.tickPrice, reqId, 4, 10.0, None)
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(.005)
+
+
+def createContract(symbol, currency='USD'):
+    contract = Contract()
+    contract.symbol = symbol
+    contract.secType = 'STK'
+    contract.currency = currency
+    return contract
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def app(clock):
+    # A threaded App short of connecting
+    app = ib.App.__new__(ib.App)
+    app.setup('127.0.0.1', 7497, 1)
+    app._reqId = 1
+    app.client = FakeClient(app.wrapper)
+    app.scheduler = Pacing.Scheduler({'reqMktData': 1}, global_rate=100,
+                                     clock=clock, sleep=clock.sleep)
+    return app
+
+
+class Recorder(object):
+    '''
+    Wrapper method recording its calls, named after the callback it handles
+    '''
+
+    def __init__(self, name):
+        self.__name__ = name
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+
+
+class Test_Router(object):
+    @pytest.fixture
+    def router(self):
+        return ib.Router()
+
+    def test_dispatch_by_reqId(self, router):
+        first, second = Recorder('tickPrice'), Recorder('tickPrice')
+        router.register(first, 1)
+        router.register(second, 2)
+        router.tickPrice(1, 4, 10.0, None)
+        router.tickPrice(2, 4, 20.0, None)
+        assert first.calls == [(1, 4, 10.0, None)]
+        assert second.calls == [(2, 4, 20.0, None)]
+
+    def test_global_fallback(self, router):
+        handler = Recorder('tickPrice')
+        accounts = Recorder('managedAccounts')
+        router.register(handler)
+        router.register(accounts)
+        router.register(Recorder('tickSnapshotEnd'), 1)
+        # No tickPrice handler for reqId 1, so the global one gets it
+        router.tickPrice(1, 4, 10.0, None)
+        router.tickPrice(7, 4, 11.0, None)
+        # Callbacks without a reqId only ever go to the global handlers
+        router.managedAccounts('DU0000000')
+        assert handler.calls == [(1, 4, 10.0, None), (7, 4, 11.0, None)]
+        assert accounts.calls == [('DU0000000',)]
+
+    def test_ewrapper_default(self, router, monkeypatch):
+        calls = []
+        monkeypatch.setattr(EWrapper, 'tickSize', lambda self, *args: calls.append(args))
+        router.tickSize(1, 0, 100)
+        assert calls == [(1, 0, 100)]
+
+    def test_unregister(self, router):
+        handler, fallback = Recorder('tickPrice'), Recorder('tickPrice')
+        router.register(handler, 1)
+        router.register(fallback)
+        router.unregister(1)
+        router.unregister(2)
+        router.tickPrice(1, 4, 10.0, None)
+        assert handler.calls == []
+        assert fallback.calls == [(1, 4, 10.0, None)]
+
+    def test_error_goes_to_both(self, router):
+        handler, request = Recorder('error'), Recorder('error')
+        router.register(handler)
+        router.register(request, 1)
+        router.error(1, 200, 'No security definition')
+        router.error(2, 200, 'No security definition')
+        assert handler.calls == [(1, 200, 'No security definition'),
+                                 (2, 200, 'No security definition')]
+        assert request.calls == [(1, 200, 'No security definition')]
+
+    def test_error_without_global_handler(self, router, monkeypatch):
+        calls = []
+        monkeypatch.setattr(EWrapper, 'error', lambda self, *args: calls.append(args))
+        request = Recorder('error')
+        router.register(request, 1)
+        router.error(1, 200, 'No security definition')
+        assert calls == [(1, 200, 'No security definition')]
+        assert request.calls == [(1, 200, 'No security definition')]
+
+
+class Test_App(object):
+    def test_paced_request(self, app, clock):
+        futures = [app.getPriceFuture(createContract('AAPL')) for _ in range(3)]
+        assert [fut.result(5) for fut in futures] == [10.0] * 3
+        assert app.client.sent == [('reqMktData', 1), ('reqMktData', 2), ('reqMktData', 3)]
+        # 1 per second, so the 2nd and 3rd waited on the scheduler
+        assert clock.now == pytest.approx(2.0)
+
+    def test_yield_cancel_paced(self, app):
+        assert app.getYieldFuture(createContract('AAPL')).result(5) == .025
+        # Cancelled from the sender thread, and it counts as a message
+        waitFor(lambda: len(app.client.sent) == 2)
+        assert app.client.sent == [('reqMktData', 1), ('cancelMktData', 1)]
+        assert app.scheduler.global_bucket.tokens == 98
+
+
+class Test_AsyncApp(object):
+    @pytest.fixture
+    def app(self, clock):
+        # An AsyncApp short of connecting, run() sets its loop
+        app = ib.AsyncApp()
+        app._reqId = 1
+        app.client = AsyncFakeClient(app.wrapper)
+        app.scheduler = Pacing.Scheduler({'reqMktData': 5}, global_rate=10, clock=clock)
+        return app
+
+    def run(self, app, coro):
+        async def main():
+            app.loop = asyncio.get_running_loop()
+            return await coro
+        return asyncio.run(main())
+
+    def tokens(self, app):
+        return (app.scheduler.global_bucket.tokens,
+                app.scheduler.buckets['reqMktData'].tokens)
+
+    def test_token_per_message(self, app):
+        assert self.run(app, app.getPrice(createContract('AAPL'))) == 10.0
+        assert self.tokens(app) == (9, 4)
+        # reqMarketDataType before and after count against the global cap
+        assert self.run(app, app.getPrice(createContract('SAP', 'EUR'))) == 10.0
+        assert app.client.sent[1:] == [('reqMarketDataType', 3), ('reqMktData', 2),
+                                       ('reqMarketDataType', 2)]
+        assert self.tokens(app) == (6, 3)
+
+    def test_debt_is_waited_out(self, app):
+        app.scheduler = Pacing.Scheduler({}, global_rate=2)
+        self.run(app, app.getPrice(createContract('SAP', 'EUR')))
+        # Three messages on a budget of two leaves the global bucket in debt
+        assert app.scheduler.delay() > 0
+
+    def test_cache_hit_is_free(self, app):
+        app.bar_cache = Cache.BarCache(':memory:')
+        contract = createContract('AAPL')
+        bars = pd.DataFrame({'date': ['20240102', '20240103'], 'price': [10.0, 11.0]})
+        app.bar_cache.put(contract, ib.HIST_BAR_SIZE, ib.HIST_WHAT_TO_SHOW, bars, '19000101')
+        df = self.run(app, app.getHistoricalData(contract, '100 Y'))
+        assert list(df['price']) == [10.0, 11.0]
+        assert app.client.sent == []
+        assert self.tokens(app) == (10, 5)
+
+
+def frame(payload):
+    return struct.pack('!I', len(payload)) + payload
+
+
+class FakeSocket(object):
+    '''
+    Socket returning the given reads in turn, an exception in the list is
+    raised instead (e.g. socket.timeout when nothing more has arrived)
+    '''
+
+    def __init__(self, reads):
+        self.reads = list(reads)
+
+    def recv(self, size):
+        read = self.reads.pop(0)
+        if isinstance(read, Exception):
+            raise read
+        assert len(read) <= size
+        return read
+
+
+class FakeConnection(object):
+    '''
+    Hands the Reader one chunk per recvMsg, then reports being disconnected
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def isConnected(self):
+        return bool(self.chunks)
+
+    def recvMsg(self):
+        return self.chunks.pop(0)
+
+
+class Test_Transport(object):
+    def read(self, chunks):
+        q = queue.Queue()
+        ib.Reader(FakeConnection(chunks), q).run()
+        return [q.get() for _ in range(q.qsize())]
+
+    def test_framing(self):
+        data = frame(b'1\x002\x00') + frame(b'') + frame(b'abc\x00' * 1000)
+        assert self.read([data]) == [b'1\x002\x00', b'', b'abc\x00' * 1000]
+
+    def test_partial_reads(self):
+        messages = [b'first\x00', b'second\x00' * 50, b'third\x00']
+        data = b''.join(frame(m) for m in messages)
+        # Split everywhere, including inside the 4 byte size prefixes
+        for size in [1, 3, 5, 7, 64]:
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            assert self.read(chunks) == messages
+
+    def test_trailing_partial_message(self):
+        data = frame(b'whole\x00') + frame(b'cut off\x00')[:6]
+        assert self.read([data]) == [b'whole\x00']
+
+    def test_recv_joins_full_reads(self, monkeypatch):
+        monkeypatch.setattr(ib, 'RECV_SIZE', 4)
+        conn = ib.Connection('127.0.0.1', 0)
+        # Full reads mean more is waiting, a short one ends the message
+        conn.socket = FakeSocket([b'abcd', b'efgh', b'ij', b'next'])
+        assert conn._recvAllMsg() == b'abcdefghij'
+
+    def test_recv_timeout(self, monkeypatch):
+        monkeypatch.setattr(ib, 'RECV_SIZE', 4)
+        conn = ib.Connection('127.0.0.1', 0)
+        # Timing out after a full read returns what we have
+        conn.socket = FakeSocket([b'abcd', socket.timeout()])
+        assert conn._recvAllMsg() == b'abcd'
+        # With nothing read the timeout goes to recvMsg like in ibapi
+        conn.socket = FakeSocket([socket.timeout()])
+        with pytest.raises(socket.timeout):
+            conn._recvAllMsg()
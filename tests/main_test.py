@@ -0,0 +1,95 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import threading
+import time
+
+import pandas
+
+import Algorithms
+import Financials
+import InteractiveBrokers as ib
+import main
+import pytest
+import Ratios
+
+SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'data', 'sample_financialStatement.xml')
+
+
+class FakeApp(object):
+    def __init__(self):
+        self.data_timeout = None
+        self.reqId_map = {1: 'AAPL', 2: 'MSFT', 3: 'BAD'}
+        self.data_event = threading.Event()
+        self.price_queue = ib.DataQueue(self.data_event)
+        self.data_errors_q = ib.DataQueue(self.data_event)
+
+
+class Test_ProcessQueue(object):
+    @pytest.fixture
+    def app(self):
+        return FakeApp()
+
+    def test_processQueue(self, app):
+        app.price_queue.put((10.0, 1))
+        app.price_queue.put((20.0, 2))
+        app.data_errors_q.put(('No security definition', 3))
+        data, issues = main.processQueue(app.price_queue, ['AAPL', 'MSFT', 'BAD'], app)
+        assert data == {'AAPL': 10.0, 'MSFT': 20.0}
+        assert issues == {'BAD': 'No security definition'}
+
+    def test_processQueue_waits(self, app):
+        def answer():
+            time.sleep(.1)
+            app.price_queue.put((10.0, 1))
+        threading.Thread(target=answer).start()
+        data, issues = main.processQueue(app.price_queue, ['AAPL'], app)
+        assert data == {'AAPL': 10.0}
+
+    def test_processQueue_timeout(self, app):
+        app.price_queue.put((10.0, 1))
+        data, issues = main.processQueue(app.price_queue, ['AAPL', 'MSFT'], app,
+                                         timeout=.1)
+        assert data == {'AAPL': 10.0}
+        assert list(issues) == ['MSFT']
+
+    def test_processQueue_on_data(self, app):
+        app.price_queue.put((10.0, 1))
+        app.price_queue.put((20.0, 2))
+        seen = []
+        main.processQueue(app.price_queue, ['AAPL', 'MSFT'], app,
+                          on_data=lambda symbol, data: seen.append((symbol, data)))
+        assert seen == [('AAPL', 10.0), ('MSFT', 20.0)]
+
+
+class Test_SetRatios(object):
+    def test_setRatios(self):
+        with open(SAMPLE) as f:
+            report = Financials.parse(f.read())
+        reports = {'A': report, 'B': Financials.Financials()}
+        df = pandas.DataFrame({'Symbol': ['A', 'B', 'A'], 'Price': [10.0, 5.0, 10.0],
+                               'P/E': None, 'Enterprise Value': None, 'ROIC': None})
+        main.setRatios(df, reports)
+
+        qtr1, qtr2, qtr3, qtr4 = report.quarters()
+        ev = Ratios.getCompanyValues(10.0, qtr1)[2]
+        assert df.at[0, 'P/E'] == Ratios.getP_E(10.0, qtr1, qtr2, qtr3, qtr4)
+        assert df.at[2, 'Enterprise Value'] == ev
+        assert df.at[0, 'ROIC'] == Ratios.calcROIC(qtr1, qtr2, qtr3, qtr4)
+        assert df.at[1, 'P/E'] is None
+        assert df['P/E'].dtype == 'object'
+        assert list(df.columns) == ['Symbol', 'Price', 'P/E', 'Enterprise Value', 'ROIC']
+
+
+class Test_MAState(object):
+    def test_save_load(self, tmpdir):
+        state_f = str(tmpdir.join('ma_state.json'))
+        assert main.loadMAState(state_f) == {}
+        ma = Algorithms.MovingAverageCross(short=1, long=2)
+        ma.update('20190102', 10.0)
+        ma.update('20190103', 12.0)
+        main.saveMAState({'AAPL': ma}, state_f)
+        states = main.loadMAState(state_f)
+        assert list(states) == ['AAPL']
+        assert states['AAPL'].to_dict() == ma.to_dict()
+        assert states['AAPL'].isGolden()
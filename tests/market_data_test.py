@@ -0,0 +1,161 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import threading
+import time
+
+import InteractiveBrokers as ib
+import main
+import MarketData
+import Pacing
+import pytest
+from tools import fake_tws
+
+
+TICKERS = ['T%03d' % i for i in range(20)]
+
+
+@pytest.fixture
+def tws():
+    with fake_tws.FakeTWS(latency=.001, unknown=['BAD'], tick_interval=.005, max_lines=5) as tws:
+        yield tws
+
+
+@pytest.fixture
+def app(tws):
+    app = ib.App('127.0.0.1', tws.port, 1)
+    app.data_timeout = 10
+    app.scheduler = Pacing.Scheduler(rates={}, global_rate=10000)
+    yield app
+    app.client.disconnect()
+
+
+class RecordingScheduler(Pacing.Scheduler):
+    '''
+    Unpaced scheduler remembering the endpoint of every message
+    '''
+
+    def __init__(self):
+        super().__init__(rates={}, global_rate=10000)
+        self.paced = []
+
+    def wait(self, endpoint=None):
+        self.paced.append(endpoint)
+        super().wait(endpoint)
+
+
+def contract(app, symbol):
+    return app.createContract(symbol, 'STK', 'USD', 'SMART', 'ISLAND')
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(.005)
+
+
+class Test_MarketDataManager(object):
+    def test_price_from_memory(self, tws, app):
+        md = MarketData.MarketDataManager(app, max_lines=5)
+        app.market_data = md
+        c = contract(app, 'AAPL')
+        assert app.getPriceFuture(c).result(5) == fake_tws.lastPrice('AAPL')
+        assert md.quote(c)['close'] == round(fake_tws.lastPrice('AAPL') * .99, 2)
+        start = time.perf_counter()
+        for _ in range(1000):
+            assert app.getPriceFuture(c).result(0) is not None
+        assert (time.perf_counter() - start)/1000 < .001
+        assert tws.requests['reqMktData'] == 1
+
+    def test_bid_before_last(self, tws, app):
+        # The fake sends bid and ask ahead of last like TWS, neither is a price
+        md = MarketData.MarketDataManager(app)
+        c = contract(app, 'AAPL')
+        assert md.priceFuture(c).result(5) == fake_tws.lastPrice('AAPL')
+        quote = md.quote(c)
+        assert quote['bid'] < quote['last'] < quote['ask']
+
+    def test_streaming_updates(self, tws, app):
+        md = MarketData.MarketDataManager(app)
+        c = contract(app, 'AAPL')
+        md.watch([c])
+        waitFor(lambda: md.price(c) is not None)
+        first = md.quote(c)
+        waitFor(lambda: md.quote(c)['last'] != first['last'])
+
+    def test_rotation(self, tws, app):
+        md = MarketData.MarketDataManager(app, max_lines=5)
+        app.market_data = md
+        data, issues = main.getPriceData(app, TICKERS)
+        assert not issues
+        assert set(data) == set(TICKERS)
+        assert len(md.live) <= 5 and not md.backlog
+        assert tws.requests['reqMktData'] == len(TICKERS)
+        # Least recently used went first, the rest are still served from memory
+        assert md.price(contract(app, TICKERS[0])) is None
+        assert md.price(contract(app, TICKERS[-1])) == fake_tws.lastPrice(TICKERS[-1])
+        waitFor(lambda: tws.openLines() <= 5)
+
+    def test_cancels_paced(self, tws, app):
+        app.scheduler = RecordingScheduler()
+        md = MarketData.MarketDataManager(app, max_lines=2)
+        for symbol in ['A', 'B', 'C']:
+            md.priceFuture(contract(app, symbol)).result(5)
+        md.close()
+        waitFor(lambda: len(app.scheduler.paced) == 6)
+        # A rotated out to make room for C, then B and C closed, each
+        # cancel counts as a message
+        assert app.scheduler.paced == ['reqMktData', 'reqMktData', None, 'reqMktData',
+                                       None, None]
+        waitFor(lambda: tws.openLines() == 0)
+
+    def test_ticks_dont_wait_on_pacing(self, tws, app):
+        # One line and two subscriptions a second, so each first tick lets
+        # a backlogged contract in that has to wait for its token
+        app.scheduler = Pacing.Scheduler(rates={'reqMktData': 2}, global_rate=10000)
+        md = MarketData.MarketDataManager(app, max_lines=1)
+        futures = [md.priceFuture(contract(app, s)) for s in ['A', 'B', 'C', 'D']]
+        # B's tick used the second token, C now waits half a second for one
+        futures[1].result(5)
+        # Replies to other requests still come straight through meanwhile
+        start = time.monotonic()
+        assert app.getAccountsFuture().result(5) == 'DU0000000'
+        assert time.monotonic() - start < .3
+        assert [f.result(5) for f in futures] == [fake_tws.lastPrice(s) for s in 'ABCD']
+
+    def test_lru(self, tws, app):
+        md = MarketData.MarketDataManager(app, max_lines=2)
+        a, b, c = [contract(app, s) for s in ['A', 'B', 'C']]
+        md.priceFuture(a).result(5)
+        md.priceFuture(b).result(5)
+        md.price(a)
+        md.priceFuture(c).result(5)
+        assert list(md.live) == [md.key(a), md.key(c)]
+
+    def test_bad_symbol(self, tws, app):
+        md = MarketData.MarketDataManager(app, max_lines=1)
+        with pytest.raises(ib.RequestError):
+            md.priceFuture(contract(app, 'BAD')).result(5)
+        # Its line is free again
+        assert md.priceFuture(contract(app, 'AAPL')).result(5) == fake_tws.lastPrice('AAPL')
+
+    def test_concurrent_lookups(self, tws, app):
+        md = MarketData.MarketDataManager(app, max_lines=5)
+        contracts = [contract(app, t) for t in TICKERS[:5]]
+        for c in contracts:
+            md.priceFuture(c).result(5)
+        errors = []
+
+        def lookups():
+            try:
+                for _ in range(2000):
+                    for c in contracts:
+                        assert md.price(c) > 0
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=lookups) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors
@@ -0,0 +1,85 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Pacing
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Test_Scheduler(object):
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    def test_burst_then_rate(self, clock):
+        sched = Pacing.Scheduler({'reqFundamentalData': 2}, global_rate=100,
+                                 clock=clock, sleep=clock.sleep)
+        for _ in range(10):
+            sched.wait('reqFundamentalData')
+        # 2 right away, then 2 per second for the remaining 8
+        assert clock.now == pytest.approx(4.0)
+
+    def test_global_cap(self, clock):
+        sched = Pacing.Scheduler({'reqMktData': 100}, global_rate=50,
+                                 clock=clock, sleep=clock.sleep)
+        for _ in range(100):
+            sched.wait('reqMktData')
+        assert clock.now == pytest.approx(1.0)
+
+    def test_unknown_endpoint_only_global(self, clock):
+        sched = Pacing.Scheduler({'reqFundamentalData': 2}, global_rate=10,
+                                 clock=clock, sleep=clock.sleep)
+        for _ in range(10):
+            assert sched.tryAcquire('reqContractDetails') == 0
+        assert sched.tryAcquire('reqContractDetails') > 0
+
+    def test_pause(self, clock):
+        sched = Pacing.Scheduler({'reqFundamentalData': 2}, global_rate=100,
+                                 clock=clock, sleep=clock.sleep)
+        sched.pause('reqFundamentalData', 10)
+        sched.wait('reqFundamentalData')
+        assert clock.now >= 10
+        # Other endpoints are not affected
+        before = clock.now
+        sched.wait('reqMktData')
+        assert clock.now == before
+
+
+class Test_SchedulerPool(object):
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    def test_spreads_requests(self, clock):
+        pool = Pacing.SchedulerPool(3, {'reqFundamentalData': 2}, global_rate=100,
+                                    clock=clock, sleep=clock.sleep)
+        used = [pool.acquire('reqFundamentalData') for _ in range(6)]
+        # Round robin while every connection has budget
+        assert used == [0, 1, 2, 0, 1, 2]
+        assert clock.now == 0
+        for _ in range(6):
+            pool.acquire('reqFundamentalData')
+        # 3 connections at 2 per second each
+        assert clock.now == pytest.approx(1.0)
+
+    def test_skips_exhausted(self, clock):
+        pool = Pacing.SchedulerPool(2, {'reqFundamentalData': 2}, global_rate=100,
+                                    clock=clock, sleep=clock.sleep)
+        pool.schedulers[0].pause('reqFundamentalData', 10)
+        assert [pool.acquire('reqFundamentalData') for _ in range(2)] == [1, 1]
+
+    def test_pause(self, clock):
+        pool = Pacing.SchedulerPool(2, {'reqFundamentalData': 2}, global_rate=100,
+                                    clock=clock, sleep=clock.sleep)
+        pool.pause('reqFundamentalData', 10)
+        pool.wait('reqFundamentalData')
+        assert clock.now >= 10
@@ -1,7 +1,10 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Financials
+import numpy
 import Ratios
 import pytest
+from coaCodes import coaCode_map
 
 
 class Test_GetCompanyValues(object):
@@ -223,3 +226,96 @@ class Test_GetDivPayout(object):
         qtr1 = None
         qtr3 = None
         assert Ratios.getDivPayout(qtr1, qtr2, qtr3, qtr4) == .48
+
+
+ITEMS = ['total_common_shares_outstanding', 'total_debt', 'minority_interest', 'cash&equivalents',
+         'cash', 'diluted_eps_excluding_extraord_items', 'operating_income',
+         'depreciation/amortization', 'depreciation/depletion', 'amortization', 'total_equity',
+         'redeemable_preferred_stock', 'preferred_stock_non_redeemable', 'total_revenue',
+         'cash_from_operating_activities', 'capital_expenditures', 'dps_common_stock_primary_issue',
+         'total_assets', 'short_term_investments', 'long_term_investments', 'total_liabilities',
+         'notes_payable/short_term_debt', 'current_port_of_lt_debt/capital_leases',
+         'total_long_term_debt', 'net_income_before_taxes', 'net_income_after_taxes',
+         'cash_and_short_term_investments']
+CODES = {}
+for code, name in coaCode_map.items():
+    CODES.setdefault(name, code)
+
+
+def randomReport(rng):
+    report = Financials.Financials()
+    for periods, n in ((report.interims, 4), (report.annuals, 2)):
+        for _ in range(n):
+            if rng.rand() < .1:
+                break
+            period = Financials.Period('Interim', None, None)
+            for name in ITEMS:
+                if rng.rand() < .75:
+                    value = float(rng.choice([0, -1, 1, 1, 1]) * rng.randint(1, 1000) / 7.0)
+                    period.statements.setdefault('INC', {})[CODES[name]] = value
+                    period.items[name] = value
+            periods.append(period)
+    return report
+
+
+class Items(dict):
+    '''
+    Line items where a missing key reads as None instead of raising KeyError,
+    which is how the batch functions treat missing line items
+    '''
+
+    def __missing__(self, key):
+        return None
+
+
+def scalar(func, *args):
+    '''
+    Scalar ratio as the batch functions compute it: NaN for None or a division by zero
+    '''
+    try:
+        value = func(*args)
+    except ZeroDivisionError:
+        return numpy.nan
+    return numpy.nan if value is None else value
+
+
+class Test_Batch(object):
+    @pytest.fixture
+    def universe(self):
+        rng = numpy.random.RandomState(0)
+        reports = {'T%s' % i: randomReport(rng) for i in range(400)}
+        reports['EMPTY'] = Financials.Financials()
+        prices = rng.randint(1, 100, len(reports)) / 3.0
+        return prices, reports, Financials.FundamentalsMatrix.fromReports(reports)
+
+    def test_matches_scalar(self, universe):
+        prices, reports, fm = universe
+        batch = Ratios.batchRatios(prices, fm)
+        expected = {column: [] for column in batch.columns}
+        for price, symbol in zip(prices, fm.symbols):
+            qtr1, qtr2, qtr3, qtr4 = [q and Items(q) for q in reports[symbol].quarters()]
+            annual, prev_annual = [y and Items(y) for y in reports[symbol].years()]
+            mkt_cap, firm_val, ev = Ratios.getCompanyValues(price, qtr1)
+            expected['Market Cap'].append(scalar(lambda: mkt_cap))
+            expected['Firm Value'].append(scalar(lambda: firm_val))
+            expected['Enterprise Value'].append(scalar(lambda: ev))
+            expected['P/E'].append(scalar(Ratios.getP_E, price, qtr1, qtr2, qtr3, qtr4))
+            expected['EV/EBITDA'].append(scalar(Ratios.getEV_EBITDA, ev, qtr1, qtr2, qtr3, qtr4))
+            expected['EV/S'].append(scalar(Ratios.getEV_S, ev, qtr1, qtr2, qtr3, qtr4))
+            expected['EV/FCF'].append(scalar(Ratios.getEV_FCF, ev, qtr1, qtr2, qtr3, qtr4))
+            expected['P/B'].append(scalar(Ratios.getP_B, price, qtr1))
+            expected['Dividend'].append(scalar(Ratios.getDivPayout, qtr1, qtr2))
+            expected['Change in NOA'].append(scalar(Ratios.calcChangeInNOA, annual, prev_annual))
+            expected['EPS Growth'].append(scalar(Ratios.calcOneYearGrowth, annual, prev_annual))
+            expected['Debt to Equity'].append(scalar(Ratios.calcDebtToEquity, qtr1))
+            expected['1yr Debt Change'].append(scalar(Ratios.calcDebtChange, annual, prev_annual))
+            expected['ROIC'].append(scalar(Ratios.calcROIC, qtr1, qtr2, qtr3, qtr4))
+        for column in batch.columns:
+            numpy.testing.assert_array_equal(batch[column].values, numpy.array(expected[column]),
+                                             err_msg=column)
+
+    def test_empty_report(self, universe):
+        prices, reports, fm = universe
+        batch = Ratios.batchRatios(prices, fm)
+        assert batch.loc['EMPTY', 'Dividend'] == 0
+        assert batch.loc['EMPTY'].drop('Dividend').isnull().all()
@@ -0,0 +1,518 @@
+'''
+Fake TWS / IB Gateway for testing and benchmarking without a live account
+
+Speaks enough of the socket protocol ibapi's EClient uses (handshake,
+startApi, nextValidId) to answer the requests main.py makes:
+    reqMktData (snapshots, streaming ticks and the 258 yield ticks),
+    reqHistoricalData, reqFundamentalData (variants of
+    data/sample_financialStatement.xml), reqContractDetails,
+    reqPositionsMulti, reqOpenOrders, reqManagedAccts and reqIds
+
+Replies can be delayed (latency + random jitter), requests over a per
+endpoint rate get IB's pacing violation errors, and symbols can be made
+unknown or answer with any error code, so the pipelines can be load tested
+reproducibly at thousands of tickers.
+
+Run it standalone (then point main.py at it with -p):
+    $ python tools/fake_tws.py --port 7497 --latency .05 --fundamental_rate 2
+or in-process:
+    with FakeTWS(latency=.01) as tws:
+        app = ib.App('127.0.0.1', tws.port, 1)
+'''
+import argparse
+import asyncio
+import collections
+import datetime
+import os
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+
+from ibapi.message import IN, OUT
+from ibapi.server_versions import (MAX_CLIENT_VER, MIN_SERVER_VER_AGG_GROUP,
+                                   MIN_SERVER_VER_ENCODE_MSG_ASCII7,
+                                   MIN_SERVER_VER_MARKET_RULES,
+                                   MIN_SERVER_VER_MD_SIZE_MULTIPLIER,
+                                   MIN_SERVER_VER_REAL_EXPIRATION_DATE,
+                                   MIN_SERVER_VER_STOCK_TYPE,
+                                   MIN_SERVER_VER_UNDERLYING_INFO)
+
+
+SAMPLE_XML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'data', 'sample_financialStatement.xml')
+LINE_ITEM_RE = re.compile(r'(<lineItem coaCode="[^"]*">)([^<]*)(</lineItem>)')
+TICKER_RE = re.compile(r'<IssueID Type="Ticker">[^<]*</IssueID>')
+# Distinct fundamental reports handed out, picked by symbol
+VARIANTS = 16
+
+# Tick types
+BID = 1
+ASK = 2
+LAST = 4
+CLOSE = 9
+FUNDAMENTAL_RATIOS = 47
+
+# Errors sent back for requests over an endpoint's rate
+PACING_ERRORS = {
+    'reqHistoricalData': (162, 'Historical Market Data Service error message:'
+                               'Historical data request pacing violation'),
+    'reqFundamentalData': (430, 'Fundamentals data request pacing violation'),
+    'reqMktData': (100, 'Max rate of messages per second has been exceeded'),
+}
+NO_SECURITY = (200, 'No security definition has been found for the request')
+MAX_TICKERS = (101, 'Max number of tickers has been reached')
+
+DURATION_DAYS = {'S': 1/86400, 'D': 1, 'W': 7, 'M': 30, 'Y': 365}
+
+
+def makeField(value):
+    '''
+    Null terminated field like ibapi.comm.make_field. bytes are taken as
+    already encoded and terminated
+    '''
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, bool):
+        value = int(value)
+    return str(value).encode() + b'\0'
+
+
+def makeMsg(*fields):
+    '''
+    Length prefixed message of fields, like ibapi.comm.make_msg
+    '''
+    text = b''.join(makeField(f) for f in fields)
+    return struct.pack('!I', len(text)) + text
+
+
+def symbolHash(symbol):
+    return zlib.crc32(symbol.encode())
+
+
+def lastPrice(symbol):
+    '''
+    Deterministic price for a symbol, between 5 and 95
+    '''
+    return 5 + (symbolHash(symbol) % 9000)/100
+
+
+def conId(symbol):
+    return 100000 + symbolHash(symbol) % 900000000
+
+
+def businessDays(end, count):
+    '''
+    The last count weekdays up to and including end, oldest first
+    '''
+    days = []
+    day = end
+    while len(days) < count:
+        if day.weekday() < 5:
+            days.append(day)
+        day -= datetime.timedelta(days=1)
+    return days[::-1]
+
+
+def durationDays(duration):
+    '''
+    Trading days in an IB duration string, e.g. "1 Y" or "30 D"
+    '''
+    amount, unit = duration.split()
+    return max(1, int(round(int(amount) * DURATION_DAYS[unit] * 5/7)))
+
+
+def bars(symbol, duration, end=None):
+    '''
+    Daily OHLC bars of a random walk ending at lastPrice(symbol), walked
+    back from the last day so every request of a symbol gets the same bar
+    for the same day whatever its duration
+    '''
+    end = datetime.date.today() if end is None else end
+    days = businessDays(end, durationDays(duration))
+    rng = random.Random(symbolHash(symbol))
+    close = lastPrice(symbol)
+    result = []
+    for day in reversed(days):
+        open_ = round(close * (1 + rng.gauss(0, .005)), 2)
+        rounded = round(close, 2)
+        result.append((day.strftime('%Y%m%d'), open_, max(open_, rounded) + .01,
+                       max(.01, min(open_, rounded) - .01), rounded, rng.randint(1000, 1000000)))
+        close = max(.01, close * (1 + rng.gauss(0, .02)))
+    result.reverse()
+    return result
+
+
+def fundamentalVariants(path=SAMPLE_XML, count=VARIANTS):
+    '''
+    count copies of the sample report with every line item scaled
+    by a different factor so not every symbol has the same financials
+    '''
+    with open(path) as f:
+        xml = f.read()
+    variants = []
+    for i in range(count):
+        factor = 1 + i * .15
+
+        def scale(match):
+            try:
+                value = '%f' % (float(match.group(2)) * factor)
+            except ValueError:
+                value = match.group(2)
+            return match.group(1) + value + match.group(3)
+        variants.append(LINE_ITEM_RE.sub(scale, xml))
+    return variants
+
+
+class RateWindow:
+    '''
+    Counts requests in the last second to spot pacing violations
+    '''
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = rate
+        self.clock = clock
+        self.times = collections.deque()
+
+    def allow(self):
+        now = self.clock()
+        while self.times and now - self.times[0] >= 1:
+            self.times.popleft()
+        if len(self.times) >= self.rate:
+            return False
+        self.times.append(now)
+        return True
+
+
+class FakeTWS:
+    '''
+    The fake server, running its own event loop on a background thread
+
+    Arguments:
+        host {str} -- interface to listen on
+        port {int} -- port to listen on, 0 picks a free one (see .port)
+        latency {float} -- seconds before each reply is sent
+        jitter {float} -- up to this many extra random seconds per reply
+        rates {dict} -- max requests per second for reqMktData,
+                        reqHistoricalData or reqFundamentalData on each
+                        connection, over it the request gets a pacing
+                        violation error
+        unknown {iterable} -- symbols answered with error 200 (no security definition)
+        errors {dict} -- symbol -> (errorCode, errorString) sent back for any
+                         request on that symbol
+        positions {list} -- (symbol, position, avgCost) for reqPositionsMulti
+        tick_interval {float} -- seconds between ticks of streaming (non snapshot)
+                                 reqMktData, None to only send the first one
+        max_lines {int} -- streaming reqMktData allowed at once across all
+                           connections (IB's market data lines are per account),
+                           over it the request gets error 101. None for no limit
+        server_version {int} -- version announced in the handshake
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, rates=None,
+                 unknown=(), errors=None, positions=None, tick_interval=None, max_lines=None,
+                 account='DU0000000', server_version=MAX_CLIENT_VER, fundamental_xml=SAMPLE_XML):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.rates = {} if rates is None else dict(rates)
+        self.unknown = set(unknown)
+        self.errors = {} if errors is None else dict(errors)
+        self.positions = [('AAPL', 100, 150.0)] if positions is None else positions
+        self.tick_interval = tick_interval
+        self.max_lines = max_lines
+        self.account = account
+        self.server_version = server_version
+        self.reports = fundamentalVariants(fundamental_xml)
+        # Requests seen per endpoint, handy for benchmarks and tests
+        self.requests = collections.Counter()
+        self.pacing_violations = collections.Counter()
+        # Requests seen per clientId
+        self.client_requests = collections.Counter()
+        self.client_ids = {}
+        self.windows = {}
+        # Open streaming subscriptions, writer -> reqIds
+        self.lines = collections.defaultdict(set)
+        self.streams = {}
+        self.rng = random.Random(0)
+        self.loop = None
+        self.server = None
+        self._thread = None
+        self._started = threading.Event()
+        self._next_order_id = 1
+
+    ### Server lifecycle ###
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self._started.set()
+        self.loop.run_forever()
+        self.server.close()
+        # Drop the connections still open so their handlers finish before the loop closes
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        if self.loop is not None and self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serveForever(self):
+        self._run()
+
+    ### Connection handling ###
+
+    async def handle(self, reader, writer):
+        try:
+            prefix = await reader.readexactly(4)
+            if prefix != b'API\0':
+                writer.close()
+                return
+            await self.readFields(reader)
+            now = datetime.datetime.now().strftime('%Y%m%d %H:%M:%S EST')
+            writer.write(makeMsg(self.server_version, now))
+            while True:
+                fields = await self.readFields(reader)
+                if fields:
+                    self.dispatch(writer, fields)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            for key in [k for k in self.streams if k[0] is writer]:
+                self.streams.pop(key).cancel()
+            self.lines.pop(writer, None)
+            self.client_ids.pop(writer, None)
+            for key in [k for k in self.windows if k[0] is writer]:
+                del self.windows[key]
+            writer.close()
+
+    async def readFields(self, reader):
+        size = struct.unpack('!I', await reader.readexactly(4))[0]
+        return (await reader.readexactly(size)).split(b'\0')[:-1]
+
+    def send(self, writer, *msgs):
+        '''
+        Sends messages together after the configured latency
+        '''
+        data = b''.join(msgs)
+        delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            self.loop.call_later(delay, self.write, writer, data)
+        else:
+            self.write(writer, data)
+
+    def write(self, writer, data):
+        if not writer.is_closing():
+            writer.write(data)
+
+    def error(self, reqId, code, msg):
+        return makeMsg(IN.ERR_MSG, 2, reqId, code, msg)
+
+    def checkRequest(self, writer, endpoint, reqId, symbol):
+        '''
+        Counts the request and sends back any pacing violation or injected
+        error. Returns False if the request shouldn't be answered
+        '''
+        self.requests[endpoint] += 1
+        self.client_requests[self.client_ids.get(writer)] += 1
+        if endpoint in self.rates:
+            window = self.windows.setdefault((writer, endpoint), RateWindow(self.rates[endpoint]))
+            if not window.allow():
+                self.pacing_violations[endpoint] += 1
+                self.send(writer, self.error(reqId, *PACING_ERRORS[endpoint]))
+                return False
+        if symbol in self.unknown:
+            self.send(writer, self.error(reqId, *NO_SECURITY))
+            return False
+        if symbol in self.errors:
+            self.send(writer, self.error(reqId, *self.errors[symbol]))
+            return False
+        return True
+
+    def dispatch(self, writer, fields):
+        msgId = int(fields[0])
+        handler = self.handlers.get(msgId)
+        if handler is not None:
+            handler(self, writer, [f.decode() for f in fields])
+
+    ### Requests ###
+    # Field positions follow ibapi's EClient for the announced server version
+
+    def startApi(self, writer, fields):
+        self.client_ids[writer] = int(fields[2])
+        self.send(writer, makeMsg(IN.NEXT_VALID_ID, 1, self._next_order_id),
+                  makeMsg(IN.MANAGED_ACCTS, 1, self.account))
+
+    def reqIds(self, writer, fields):
+        self.send(writer, makeMsg(IN.NEXT_VALID_ID, 1, self._next_order_id))
+
+    def reqManagedAccts(self, writer, fields):
+        self.send(writer, makeMsg(IN.MANAGED_ACCTS, 1, self.account))
+
+    def reqMktData(self, writer, fields):
+        reqId, symbol = int(fields[2]), fields[4]
+        generic_ticks, snapshot = fields[16], fields[17] == '1'
+        if not self.checkRequest(writer, 'reqMktData', reqId, symbol):
+            return
+        price = lastPrice(symbol)
+        if '258' in generic_ticks.split(','):
+            ratios = 'NPRICE=%.2f;YIELD=%.4f;' % (price, (symbolHash(symbol) % 500)/100)
+            self.send(writer, makeMsg(IN.TICK_STRING, 6, reqId, FUNDAMENTAL_RATIOS, ratios))
+            return
+        if not snapshot:
+            if self.max_lines is not None and self.openLines() >= self.max_lines:
+                self.send(writer, self.error(reqId, *MAX_TICKERS))
+                return
+            self.lines[writer].add(reqId)
+        # Bid and ask, then last, then close, in the order TWS sends them
+        msgs = [makeMsg(IN.TICK_PRICE, 6, reqId, BID, round(price - .01, 2), 100, 0),
+                makeMsg(IN.TICK_PRICE, 6, reqId, ASK, round(price + .01, 2), 100, 0),
+                makeMsg(IN.TICK_PRICE, 6, reqId, LAST, price, 100, 0),
+                makeMsg(IN.TICK_PRICE, 6, reqId, CLOSE, round(price * .99, 2), 0, 0)]
+        if snapshot:
+            msgs.append(makeMsg(IN.TICK_SNAPSHOT_END, 1, reqId))
+        self.send(writer, *msgs)
+        if not snapshot and self.tick_interval:
+            self.streams[(writer, reqId)] = self.loop.call_later(
+                self.tick_interval, self.tick, writer, reqId, price)
+
+    def openLines(self):
+        return sum(len(reqIds) for reqIds in self.lines.values())
+
+    def tick(self, writer, reqId, price):
+        price = round(max(.01, price * (1 + self.rng.gauss(0, .001))), 2)
+        self.send(writer, makeMsg(IN.TICK_PRICE, 6, reqId, LAST, price, 100, 0))
+        self.streams[(writer, reqId)] = self.loop.call_later(
+            self.tick_interval, self.tick, writer, reqId, price)
+
+    def cancelMktData(self, writer, fields):
+        self.lines[writer].discard(int(fields[2]))
+        stream = self.streams.pop((writer, int(fields[2])), None)
+        if stream is not None:
+            stream.cancel()
+
+    def reqHistoricalData(self, writer, fields):
+        reqId, symbol, duration = int(fields[1]), fields[3], fields[17]
+        if not self.checkRequest(writer, 'reqHistoricalData', reqId, symbol):
+            return
+        data = bars(symbol, duration)
+        start = data[0][0] + '  00:00:00'
+        end = data[-1][0] + '  00:00:00'
+        bar_fields = []
+        for date, open_, high, low, close, volume in data:
+            bar_fields += [date, open_, high, low, close, volume, round((high + low)/2, 2), 1]
+        self.send(writer, makeMsg(IN.HISTORICAL_DATA, reqId, start, end, len(data), *bar_fields))
+
+    def reqFundamentalData(self, writer, fields):
+        reqId, symbol = int(fields[2]), fields[4]
+        if not self.checkRequest(writer, 'reqFundamentalData', reqId, symbol):
+            return
+        report = self.reports[symbolHash(symbol) % len(self.reports)]
+        report = TICKER_RE.sub('<IssueID Type="Ticker">%s</IssueID>' % symbol, report, 1)
+        if self.server_version >= MIN_SERVER_VER_ENCODE_MSG_ASCII7:
+            data = report.encode('unicode-escape') + b'\0'
+        else:
+            data = report.encode() + b'\0'
+        self.send(writer, makeMsg(IN.FUNDAMENTAL_DATA, 1, reqId, data))
+
+    def reqContractDetails(self, writer, fields):
+        reqId, symbol, secType = int(fields[2]), fields[4], fields[5]
+        exchange, primary, currency = fields[10], fields[11], fields[12]
+        if not self.checkRequest(writer, 'reqContractDetails', reqId, symbol):
+            return
+        details = [IN.CONTRACT_DATA, 8, reqId, symbol, secType or 'STK', '', 0.0, '',
+                   exchange or 'SMART', currency or 'USD', symbol, 'NMS', 'NMS',
+                   conId(symbol), .01]
+        if self.server_version >= MIN_SERVER_VER_MD_SIZE_MULTIPLIER:
+            details.append(100)
+        details += ['', 'LMT,MKT', 'SMART,ISLAND', 1, 0, '%s Inc' % symbol,
+                    primary or 'NASDAQ', '', 'Technology', 'Computers', 'Software',
+                    'US/Eastern', '', '', '', 0, 0]
+        if self.server_version >= MIN_SERVER_VER_AGG_GROUP:
+            details.append(1)
+        if self.server_version >= MIN_SERVER_VER_UNDERLYING_INFO:
+            details += ['', '']
+        if self.server_version >= MIN_SERVER_VER_MARKET_RULES:
+            details.append('26')
+        if self.server_version >= MIN_SERVER_VER_REAL_EXPIRATION_DATE:
+            details.append('')
+        if self.server_version >= MIN_SERVER_VER_STOCK_TYPE:
+            details.append('COMMON')
+        self.send(writer, makeMsg(*details), makeMsg(IN.CONTRACT_DATA_END, 1, reqId))
+
+    def reqPositionsMulti(self, writer, fields):
+        reqId, account = int(fields[2]), fields[3]
+        self.requests['reqPositionsMulti'] += 1
+        msgs = [makeMsg(IN.POSITION_MULTI, 1, reqId, account or self.account, conId(symbol),
+                        symbol, 'STK', '', 0.0, '', '', 'NASDAQ', 'USD', symbol, 'NMS',
+                        position, avg_cost, '')
+                for symbol, position, avg_cost in self.positions]
+        msgs.append(makeMsg(IN.POSITION_MULTI_END, 1, reqId))
+        self.send(writer, *msgs)
+
+    def reqOpenOrders(self, writer, fields):
+        self.send(writer, makeMsg(IN.OPEN_ORDER_END, 1))
+
+    handlers = {OUT.START_API: startApi,
+                OUT.REQ_IDS: reqIds,
+                OUT.REQ_MANAGED_ACCTS: reqManagedAccts,
+                OUT.REQ_MKT_DATA: reqMktData,
+                OUT.CANCEL_MKT_DATA: cancelMktData,
+                OUT.REQ_HISTORICAL_DATA: reqHistoricalData,
+                OUT.REQ_FUNDAMENTAL_DATA: reqFundamentalData,
+                OUT.REQ_CONTRACT_DATA: reqContractDetails,
+                OUT.REQ_POSITIONS_MULTI: reqPositionsMulti,
+                OUT.REQ_OPEN_ORDERS: reqOpenOrders,
+                OUT.REQ_ALL_OPEN_ORDERS: reqOpenOrders}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake TWS/IB Gateway for offline testing and benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=7497)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra random seconds per reply')
+    parser.add_argument('--mkt_rate', type=float, help='reqMktData per second before pacing violations')
+    parser.add_argument('--hist_rate', type=float, help='reqHistoricalData per second before pacing violations')
+    parser.add_argument('--fundamental_rate', type=float, help='reqFundamentalData per second before pacing violations')
+    parser.add_argument('--unknown', nargs='*', default=[], help='Symbols without a security definition')
+    parser.add_argument('--tick_interval', type=float, help='Seconds between streaming ticks')
+    parser.add_argument('--max_lines', type=int, help='Streaming market data lines')
+    args = parser.parse_args()
+    rates = {endpoint: rate for endpoint, rate in (('reqMktData', args.mkt_rate),
+                                                   ('reqHistoricalData', args.hist_rate),
+                                                   ('reqFundamentalData', args.fundamental_rate))
+             if rate is not None}
+    tws = FakeTWS(args.host, args.port, args.latency, args.jitter, rates, args.unknown,
+                  tick_interval=args.tick_interval, max_lines=args.max_lines)
+    print('Fake TWS listening on %s:%s' % (args.host, args.port))
+    try:
+        tws.serveForever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()